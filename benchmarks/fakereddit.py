@@ -0,0 +1,475 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Offline stand-in for the parts of the PRAW API used by Subber
+
+The fake serves a social graph stored as a dictionary:
+
+    {'users': {name: {'comments': [{'id': ..., 'subreddit': ...,
+                                    'parent_author': ...}],
+                      'submissions': [{'id': ..., 'subreddit': ...,
+                                       'commenters': [...]}]}},
+     'subs': {name: {'display_name_prefixed': ..., 'title': ..., ...}}}
+
+Graphs are generated with synthetic_graph, or recorded from live Reddit
+with record and replayed from JSON fixtures. FakeClient serves the same
+graph to the async backend as Reddit API JSON.
+"""
+
+import bisect
+import collections
+import itertools
+import json
+import random
+import threading
+import time
+
+import praw
+import prawcore
+
+
+class FakeAPIError(Exception):
+    """Injected API failure"""
+
+
+class _Response(object):
+    status_code = 404
+
+
+def synthetic_graph(users=200, subs=100, comments=5, submissions=5,
+                    commenters=3, seed=0):
+    """Return a random social graph with Zipf-like sub popularity
+
+    Keyword arguments:
+    users       -- number of redditors
+    subs        -- number of subreddits
+    comments    -- comments per redditor
+    submissions -- submissions per redditor
+    commenters  -- commenters per submission
+    seed        -- random seed, the same seed gives the same graph
+    """
+    rng = random.Random(seed)
+
+    user_names = ['user{}'.format(i) for i in range(users)]
+    sub_names = ['sub{}'.format(i) for i in range(subs)]
+    popularity = list(itertools.accumulate(1.0 / (rank + 1)
+                                           for rank in range(subs)))
+
+    def pick_sub():
+        rank = bisect.bisect(popularity, rng.random() * popularity[-1])
+        return 'r/' + sub_names[min(rank, subs - 1)]
+
+    def pick_user(exclude):
+        name = exclude
+        while name == exclude:
+            name = rng.choice(user_names)
+        return name
+
+    graph = {'users': {}, 'subs': {}}
+    post_id = 0
+
+    for name in user_names:
+        activity = {'comments': [], 'submissions': []}
+
+        for i in range(comments):
+            post_id += 1
+            activity['comments'].append(
+                {'id': 't1_{:x}'.format(post_id),
+                 'subreddit': pick_sub(),
+                 'parent_author': pick_user(name)})
+
+        for i in range(submissions):
+            post_id += 1
+            activity['submissions'].append(
+                {'id': 't3_{:x}'.format(post_id),
+                 'subreddit': pick_sub(),
+                 'commenters': [pick_user(name)
+                                for j in range(commenters)]})
+
+        graph['users'][name] = activity
+
+    for rank, name in enumerate(sub_names):
+        graph['subs'][name] = {
+            'display_name_prefixed': 'r/' + name,
+            'title': 'Subreddit {}'.format(rank),
+            'created': 1199145600 + rank * 86400,
+            'subscribers': int(1000000 / (rank + 1)),
+            'over18': rank % 10 == 9,
+            'public_description': 'Synthetic subreddit {}'.format(rank)}
+
+    return graph
+
+
+def load_fixture(path):
+    """Return a graph recorded to a JSON fixture"""
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_fixture(graph, path):
+    """Write a graph to a JSON fixture"""
+    with open(path, 'w') as f:
+        json.dump(graph, f, indent=1, sort_keys=True)
+
+
+def record(session, users, limit=5):
+    """Return a graph recorded from live Reddit covering the listings and
+    subreddits the pipeline reads for a list of users
+
+    Keyword arguments:
+    session -- instance of the Reddit api
+    users   -- usernames to record, typically a seed user and its neighbors
+    limit   -- listing limit
+    """
+    graph = {'users': {}, 'subs': {}}
+
+    def author(post):
+        return post.author.name if post.author else None
+
+    for name in users:
+        activity = {'comments': [], 'submissions': []}
+
+        comments = list(session.redditor(name).comments.new(limit=limit))
+
+        # Parent authors are looked up in one request
+        parents = {}
+        if comments:
+            parents = {p.fullname: author(p) for p in session.info(
+                [c.parent_id for c in comments])}
+
+        for c in comments:
+            activity['comments'].append(
+                {'id': c.fullname,
+                 'subreddit': c.subreddit_name_prefixed,
+                 'parent_author': parents.get(c.parent_id)})
+
+        for s in session.redditor(name).submissions.top(limit=limit):
+            activity['submissions'].append(
+                {'id': s.fullname,
+                 'subreddit': s.subreddit_name_prefixed,
+                 'commenters': [author(c) for c in s.comments[:limit]
+                                if hasattr(c, 'author')]})
+
+        graph['users'][name] = activity
+
+    subs = set(post['subreddit'][2:]
+               for activity in graph['users'].values()
+               for kind in ('comments', 'submissions')
+               for post in activity[kind])
+
+    for name in subs:
+        subreddit = session.subreddit(name)
+        graph['subs'][name] = {
+            'display_name_prefixed': subreddit.display_name_prefixed,
+            'title': subreddit.title,
+            'created': subreddit.created,
+            'subscribers': subreddit.subscribers,
+            'over18': subreddit.over18,
+            'public_description': subreddit.public_description}
+
+    return graph
+
+
+class FakeReddit(object):
+    """PRAW-compatible session serving a social graph, with per-call latency
+    and failure injection. Every simulated API request is counted."""
+
+    def __init__(self, graph, latency=0.0, failure_rate=0.0, seed=0):
+        """Keyword arguments:
+        graph        -- social graph dictionary
+        latency      -- seconds each API request takes
+        failure_rate -- fraction of API requests that raise FakeAPIError
+        seed         -- random seed for failure injection
+        """
+        self.graph = graph
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.calls = collections.Counter()
+
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._users = {name.lower(): name for name in graph['users']}
+        self._subs = {name.lower(): name for name in graph['subs']}
+
+        # Posts by id, for lookups by parent id or submission id
+        self._posts = {post['id']: post
+                       for activity in graph['users'].values()
+                       for kind in ('comments', 'submissions')
+                       for post in activity[kind]}
+
+    @property
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    def reset(self):
+        """Reset call counters"""
+        with self._lock:
+            self.calls.clear()
+
+    def _call(self, kind):
+        with self._lock:
+            self.calls[kind] += 1
+            fail = self._rng.random() < self.failure_rate
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if fail:
+            raise FakeAPIError('Injected failure for {} request'.format(kind))
+
+    def _user(self, name):
+        key = self._users.get(name.lower())
+        return None if key is None else self.graph['users'][key]
+
+    def _sub_fields(self, name):
+        key = self._subs.get(name.lower())
+        return None if key is None else self.graph['subs'][key]
+
+    def redditor(self, name):
+        return FakeRedditor(self, name)
+
+    def subreddit(self, name):
+        return FakeSubreddit(self, name)
+
+    def info(self, fullnames):
+        """Serve the parents of comments, 100 per request like PRAW"""
+        for i in range(0, len(fullnames), 100):
+            self._call('parent')
+
+            for fullname in fullnames[i:i + 100]:
+                post = self._posts.get('t1_' + fullname[4:])
+
+                if fullname.startswith('t1_p') and post is not None:
+                    yield FakeComment(self, {
+                        'id': fullname,
+                        'subreddit': post['subreddit'],
+                        'author': post.get('parent_author')})
+
+    def submission(self, id):
+        post = self._posts.get('t3_' + id)
+        if post is None:
+            raise prawcore.exceptions.NotFound(_Response())
+
+        return FakeSubmission(self, post)
+
+    def get(self, path, params=None):
+        """Serve /api/info?sr_name= batch subreddit lookups"""
+        if path != '/api/info' or 'sr_name' not in (params or {}):
+            raise FakeAPIError('Unsupported request {}'.format(path))
+
+        self._call('info')
+
+        return [FakeSubreddit(self, name, fields)
+                for name in params['sr_name'].split(',')
+                for fields in [self._sub_fields(name)] if fields is not None]
+
+
+class FakeClient(object):
+    """aioreddit client serving a FakeReddit's graph as Reddit API JSON, so
+    both backends can be run against the same Reddit"""
+
+    def __init__(self, reddit):
+        """Keyword arguments:
+        reddit -- FakeReddit whose graph is served and calls counted
+        """
+        self._reddit = reddit
+
+    async def get(self, lane, path, **params):
+        from subber import aioreddit
+
+        reddit = self._reddit
+        parts = path.split('/')
+        limit = params.get('limit', 100)
+
+        def listing(children):
+            return {'data': {'children': children}}
+
+        if parts[1] == 'user':
+            kind = {'comments': 'comments', 'submitted': 'submissions',
+                    'about': 'redditor'}[parts[3]]
+            reddit._call(kind)
+
+            user = reddit._user(parts[2])
+            if user is None:
+                raise aioreddit.NotFound(path)
+
+            if kind == 'redditor':
+                return {'data': {'name': parts[2]}}
+
+            if kind == 'comments':
+                return listing([
+                    {'kind': 't1',
+                     'data': {'name': post['id'],
+                              'subreddit_name_prefixed': post['subreddit'],
+                              'parent_id': 't1_p' + post['id'][3:]}}
+                    for post in user['comments'][:limit]])
+
+            return listing([
+                {'kind': 't3',
+                 'data': {'name': post['id'], 'id': post['id'][3:],
+                          'subreddit_name_prefixed': post['subreddit']}}
+                for post in user['submissions'][:limit]])
+
+        if path == '/api/info' and 'id' in params:
+            reddit._call('parent')
+
+            children = []
+            for fullname in params['id'].split(','):
+                post = reddit._posts.get('t1_' + fullname[4:])
+
+                if fullname.startswith('t1_p') and post is not None:
+                    children.append({'kind': 't1', 'data': {
+                        'name': fullname,
+                        'author': post.get('parent_author') or '[deleted]'}})
+
+            return listing(children)
+
+        if path == '/api/info':
+            reddit._call('info')
+
+            return listing([{'kind': 't5', 'data': fields}
+                            for name in params['sr_name'].split(',')
+                            for fields in [reddit._sub_fields(name)]
+                            if fields is not None])
+
+        if parts[1] == 'comments':
+            reddit._call('submission_comments')
+
+            post = reddit._posts.get('t3_' + parts[2])
+            if post is None:
+                raise aioreddit.NotFound(path)
+
+            return [listing([{'kind': 't3', 'data': {'name': post['id']}}]),
+                    listing([{'kind': 't1',
+                              'data': {'author': author or '[deleted]'}}
+                             for author in post['commenters'][:limit]])]
+
+        if parts[1] == 'r' and parts[3] == 'about':
+            reddit._call('subreddit')
+
+            fields = reddit._sub_fields(parts[2])
+            if fields is None:
+                raise aioreddit.NotFound(path)
+
+            return {'data': fields}
+
+        raise FakeAPIError('Unsupported request {}'.format(path))
+
+
+class FakeRedditor(object):
+    def __init__(self, reddit, name):
+        self._reddit = reddit
+        self.name = name
+        self.comments = FakeSubListing(reddit, name, 'comments')
+        self.submissions = FakeSubListing(reddit, name, 'submissions')
+
+    @property
+    def created(self):
+        self._reddit._call('redditor')
+
+        if self._reddit._user(self.name) is None:
+            raise prawcore.exceptions.NotFound(_Response())
+
+        return 1199145600
+
+
+class FakeSubListing(object):
+    def __init__(self, reddit, name, kind):
+        self._reddit = reddit
+        self._name = name
+        self._kind = kind
+
+    def _listing(self, limit):
+        # Listings are lazy, the request happens on iteration like PRAW
+        self._reddit._call(self._kind)
+
+        user = self._reddit._user(self._name)
+        if user is None:
+            raise prawcore.exceptions.NotFound(_Response())
+
+        for post in user[self._kind][:limit]:
+            if self._kind == 'comments':
+                yield FakeComment(self._reddit, post)
+            else:
+                yield FakeSubmission(self._reddit, post)
+
+    def new(self, limit=100):
+        return self._listing(limit)
+
+    def top(self, limit=100):
+        return self._listing(limit)
+
+
+class FakeAuthor(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeComment(object):
+    def __init__(self, reddit, post):
+        self._reddit = reddit
+        self._post = post
+        self.fullname = post['id']
+        self.subreddit_name_prefixed = post['subreddit']
+
+        # Parents aren't in the graph, so they are named after the comment
+        if post['id'] is not None:
+            self.parent_id = 't1_p' + post['id'][3:]
+
+    @property
+    def author(self):
+        name = self._post.get('author')
+        return FakeAuthor(name) if name else None
+
+
+class FakeSubmission(object):
+    def __init__(self, reddit, post):
+        self._reddit = reddit
+        self._post = post
+        self.fullname = post['id']
+        self.subreddit_name_prefixed = post['subreddit']
+
+    @property
+    def comments(self):
+        self._reddit._call('submission_comments')
+
+        # Real PRAW comments, as the pipeline skips anything else in the
+        # comment forest
+        return [praw.models.Comment(None, _data={
+            'id': '{}c{}'.format(self.fullname[3:], i),
+            'author': author or '[deleted]'})
+            for i, author in enumerate(self._post['commenters'])]
+
+
+class FakeSubreddit(object):
+    def __init__(self, reddit, name, fields=None):
+        self._reddit = reddit
+        self._name = name
+        self._fields = fields
+
+    def __getattr__(self, attribute):
+        if attribute.startswith('_'):
+            raise AttributeError(attribute)
+
+        # Subreddits load lazily on first attribute access like PRAW
+        if self._fields is None:
+            self._reddit._call('subreddit')
+            self._fields = self._reddit._sub_fields(self._name)
+
+            if self._fields is None:
+                raise prawcore.exceptions.NotFound(_Response())
+
+        try:
+            return self._fields[attribute]
+        except KeyError:
+            raise AttributeError(attribute)
@@ -0,0 +1,185 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark the recommendation pipeline and the /user endpoint offline
+
+    python -m benchmarks.run --users 500 --latency 0.05 --workers 8
+    python -m benchmarks.run --fixture recorded.json --target flask
+"""
+
+import argparse
+import json
+import random
+import sys
+import time
+import tracemalloc
+from unittest import mock
+
+from benchmarks import fakereddit
+from subber import cache, fanout, reddit
+
+
+def configure(workers, caches=True):
+    """Reset the pipeline's shared components for a benchmark run
+
+    Keyword arguments:
+    workers -- size of the pipeline worker pool
+    caches  -- whether sub metadata and redditor activity are cached
+    """
+    reddit.executor = fanout.FanOut(workers=workers)
+    reddit.sub_cache = cache.SubInfoCache() if caches else None
+    reddit.activity_backend = cache.MemoryBackend() if caches else None
+    reddit.api_scheduler = None
+    reddit.flights = reddit.SingleFlight()
+
+
+def load_app(session):
+    """Return a Flask test client for the Subber app serving a fake session
+
+    Keyword arguments:
+    session -- FakeReddit instance
+    """
+    from subber import subber
+
+    with mock.patch('subber.config.get_config'), \
+            mock.patch('subber.reddit.Reddit'):
+        subber.create_app()
+
+    subber.session = session
+
+    return subber.app.test_client()
+
+
+def percentile(samples, p):
+    """Return the p-th percentile of a list of samples"""
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def run(target, session, users, args):
+    """Return benchmark results for recommending subs to a list of users
+
+    Keyword arguments:
+    target  -- 'pipeline' or 'flask'
+    session -- FakeReddit instance
+    users   -- usernames to request, one request per user
+    args    -- parsed command line arguments
+    """
+    configure(args.workers)
+
+    client = load_app(session) if target == 'flask' else None
+    configure(args.workers)
+
+    samples = []
+    calls = []
+    errors = 0
+
+    tracemalloc.start()
+
+    for user in users:
+        if not args.warm:
+            configure(args.workers)
+
+        session.reset()
+        start = time.perf_counter()
+
+        if client is None:
+            reddit.get_user_recommendations(session, user)
+        else:
+            response = client.post('/user', data={'username': user})
+            if response.status_code != 200:
+                errors += 1
+
+        samples.append(time.perf_counter() - start)
+        calls.append(session.total_calls)
+
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {'target': target,
+            'requests': len(users),
+            'errors': errors,
+            'p50_ms': percentile(samples, 50) * 1000,
+            'p90_ms': percentile(samples, 90) * 1000,
+            'p99_ms': percentile(samples, 99) * 1000,
+            'max_ms': max(samples) * 1000,
+            'calls_mean': sum(calls) / float(len(calls)),
+            'calls_max': max(calls),
+            'peak_kib': peak / 1024.0}
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--target', choices=('pipeline', 'flask', 'all'),
+                        default='all')
+    parser.add_argument('--fixture', help='replay a recorded JSON graph')
+    parser.add_argument('--save', help='write the graph used to a fixture')
+    parser.add_argument('--users', type=int, default=200,
+                        help='synthetic graph size in redditors')
+    parser.add_argument('--subs', type=int, default=100,
+                        help='synthetic graph size in subreddits')
+    parser.add_argument('--requests', type=int, default=20,
+                        help='recommendation requests per target')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds per simulated API request')
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help='fraction of API requests that fail')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='pipeline worker pool size')
+    parser.add_argument('--warm', action='store_true',
+                        help='keep caches between requests')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true',
+                        help='print results as JSON lines')
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.fixture:
+        graph = fakereddit.load_fixture(args.fixture)
+    else:
+        graph = fakereddit.synthetic_graph(users=args.users, subs=args.subs,
+                                           seed=args.seed)
+
+    if args.save:
+        fakereddit.save_fixture(graph, args.save)
+
+    session = fakereddit.FakeReddit(graph, latency=args.latency,
+                                    failure_rate=args.failure_rate,
+                                    seed=args.seed)
+
+    rng = random.Random(args.seed)
+    names = sorted(graph['users'])
+    users = [rng.choice(names) for i in range(args.requests)]
+
+    targets = ('pipeline', 'flask') if args.target == 'all' else (
+        args.target,)
+
+    for target in targets:
+        result = run(target, session, users, args)
+
+        if args.json:
+            print(json.dumps(result, sort_keys=True))
+        else:
+            print('{target:8} requests={requests} errors={errors} '
+                  'p50={p50_ms:.1f}ms p90={p90_ms:.1f}ms p99={p99_ms:.1f}ms '
+                  'max={max_ms:.1f}ms calls/request={calls_mean:.1f} '
+                  '(max {calls_max}) peak={peak_kib:.0f}KiB'.format(**result))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
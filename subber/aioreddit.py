@@ -0,0 +1,619 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""asyncio backend for the recommendation pipeline
+
+Crawls Reddit with aiohttp over one pooled keep-alive connection set instead
+of PRAW and threads, so a single process can run many crawls at once. Sub
+scoring, ranking, caches, weights and crawl policy are shared with the sync
+pipeline in subber.reddit, so both backends recommend the same subs.
+"""
+
+import asyncio
+import collections
+import logging
+import threading
+import time
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from subber import metrics, reddit, scheduler, util
+
+logger = logging.getLogger(__name__)
+
+API_URL = 'https://oauth.reddit.com'
+TOKEN_URL = 'https://www.reddit.com/api/v1/access_token'
+USER_AGENT = 'web app'
+
+
+class NotFound(Exception):
+    """Requested Reddit resource does not exist"""
+
+
+class Client(object):
+    """Reddit API client authenticating with a script app's password grant
+    and sending every request through one pooled aiohttp session"""
+
+    def __init__(self, client_id, client_secret, password, username,
+                 pool_size=100, timeout=30, clock=time.time):
+        """Keyword arguments:
+        client_id     -- Reddit app id
+        client_secret -- Reddit app secret
+        password      -- password of the Reddit account
+        username      -- name of the Reddit account
+        pool_size     -- max open connections
+        timeout       -- seconds before a request is abandoned
+        clock         -- callable returning the current time in seconds
+        """
+        if aiohttp is None:
+            raise RuntimeError('aiohttp is required for the async backend')
+
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.password = password
+        self.username = username
+        self.pool_size = pool_size
+        self.timeout = timeout
+
+        self._clock = clock
+        self._session = None
+        self._token = None
+        self._expires = 0
+        self._token_lock = None
+
+    def _http(self):
+        # The aiohttp session belongs to the event loop it is created on, so
+        # it is created on first use inside the loop
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size,
+                                               keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={'User-Agent': USER_AGENT})
+            self._token_lock = asyncio.Lock()
+
+        return self._session
+
+    async def _authorize(self, force=False):
+        http = self._http()
+
+        async with self._token_lock:
+            if not force and self._token and self._clock() < self._expires:
+                return self._token
+
+            async with http.post(
+                    TOKEN_URL,
+                    auth=aiohttp.BasicAuth(self.client_id,
+                                           self.client_secret),
+                    data={'grant_type': 'password',
+                          'username': self.username,
+                          'password': self.password}) as response:
+                body = await response.json()
+
+            if 'access_token' not in body:
+                logger.critical('Unable to initialize Reddit API session. '
+                                'Verify the credentials in the Subber '
+                                'config file are correct.')
+                raise RuntimeError('Unable to initialize Reddit API '
+                                   'session.')
+
+            self._token = body['access_token']
+
+            # Renew a minute early so requests in flight don't expire
+            self._expires = self._clock() + body.get('expires_in', 3600) - 60
+
+            return self._token
+
+    async def get(self, lane, path, **params):
+        """Return the decoded JSON response to a GET request, within the API
+        scheduler's budget if one is configured
+
+        Keyword arguments:
+        lane   -- scheduler priority lane of the request
+        path   -- API path, such as /api/info
+        params -- query parameters
+        """
+        await _acquire(lane)
+        metrics.count('praw_calls')
+
+        params['raw_json'] = 1
+        token = await self._authorize()
+
+        for attempt in range(2):
+            async with self._http().get(
+                    API_URL + path, params=params,
+                    headers={'Authorization': 'bearer ' + token}) \
+                    as response:
+                _update_rate_limit(response.headers)
+
+                if response.status == 401 and attempt == 0:
+                    token = await self._authorize(force=True)
+                    continue
+
+                if response.status in (403, 404):
+                    raise NotFound(path)
+
+                response.raise_for_status()
+
+                return await response.json()
+
+    async def close(self):
+        """Close pooled connections"""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+async def _acquire(lane):
+    """Wait for the API scheduler to allow a request without blocking the
+    event loop"""
+    if reddit.api_scheduler is None:
+        return
+
+    while True:
+        wait = reddit.api_scheduler.try_acquire(lane)
+        if not wait:
+            return
+
+        await asyncio.sleep(wait)
+
+
+def _update_rate_limit(headers):
+    if reddit.api_scheduler is None:
+        return
+
+    try:
+        remaining = float(headers['x-ratelimit-remaining'])
+        reset = float(headers['x-ratelimit-reset'])
+    except (KeyError, ValueError):
+        return
+
+    reddit.api_scheduler.update(remaining, reset)
+
+
+class SingleFlight(object):
+    """Coalesce concurrent coroutines for the same key into one call whose
+    result is shared by every caller"""
+
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+
+        self._in_flight = {}
+
+    async def do(self, key, func, *args):
+        """Return await func(*args), waiting on the call already in flight
+        for key if there is one
+
+        Keyword arguments:
+        key  -- hashable identifying the request
+        func -- coroutine function making the request
+        """
+        future = self._in_flight.get(key)
+
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future)
+
+        self.calls += 1
+        future = self._in_flight[key] = asyncio.ensure_future(func(*args))
+
+        try:
+            return await asyncio.shield(future)
+        finally:
+            if future.done():
+                self._in_flight.pop(key, None)
+            else:
+                future.add_done_callback(
+                    lambda f: self._in_flight.pop(key, None))
+
+
+# Coalesces identical Reddit requests made concurrently on the event loop
+flights = SingleFlight()
+
+
+class Crawler(object):
+    """Recommendation request for one user, charging listing requests to
+    its crawl budget"""
+
+    def __init__(self, client, budget=None):
+        """Keyword arguments:
+        client -- Client making Reddit requests
+        budget -- reddit.CrawlBudget for the request
+        """
+        self.client = client
+        self.budget = budget
+
+        # Listings fetched during the request, reused by every stage
+        self._listings = {}
+
+    def _charge(self, lane):
+        if self.budget is not None and lane == scheduler.LISTING:
+            self.budget.charge()
+
+    async def _get(self, lane, path, charge=True, **params):
+        if charge:
+            self._charge(lane)
+
+        return await self.client.get(lane, path, **params)
+
+    async def _cached(self, kind, user, func):
+        """Return func(user) through reddit.activity_backend, sharing
+        entries with the sync pipeline"""
+        if reddit.activity_backend is None:
+            return await func(user)
+
+        key = '{}:{}:{}'.format(kind, reddit.listing_limit, user.lower())
+        result = reddit.activity_backend.get(key)
+
+        if result is not None:
+            metrics.count('cache_hits', cache='activity')
+            return result
+
+        metrics.count('cache_misses', cache='activity')
+        result = await func(user)
+
+        # Empty results are usually failed requests and results found after
+        # the crawl budget ran out may be partial, so they are left uncached
+        if result and (self.budget is None or not self.budget.exhausted()):
+            reddit.activity_backend.set(key, result, reddit.activity_ttl)
+
+        return result
+
+    async def _listing(self, kind, user, path, **params):
+        """Return the post data of a user listing, or None on error"""
+        key = (kind, user.lower())
+        if key in self._listings:
+            metrics.count('cache_hits', cache='listing')
+            return self._listings[key]
+
+        metrics.count('cache_misses', cache='listing')
+
+        async def fetch():
+            logger.debug('Async %s request made for user %s', kind, user)
+            body = await self._get(scheduler.LISTING, path, charge=False,
+                                   limit=reddit.listing_limit, **params)
+            return [child['data'] for child in body['data']['children']]
+
+        # Charged here so crawls sharing the request are each charged
+        self._charge(scheduler.LISTING)
+
+        try:
+            posts = await flights.do((kind, user.lower(),
+                                      reddit.listing_limit), fetch)
+        except Exception:
+            logger.error('Error retrieving %s for user %s', kind, user)
+            return None
+
+        self._listings[key] = posts
+
+        return posts
+
+    async def user_comments(self, user):
+        """Return a list of a user's listing_limit newest comments"""
+        return await self._listing('comments', user,
+                                   '/user/{}/comments'.format(user),
+                                   sort='new')
+
+    async def user_submissions(self, user):
+        """Return a list of a user's listing_limit top submissions"""
+        return await self._listing('submissions', user,
+                                   '/user/{}/submitted'.format(user),
+                                   sort='top')
+
+    async def parent_authors(self, user):
+        """Return a list of the authors of posts a user has commented on"""
+        return await self._cached('parent_authors', user,
+                                  self._parent_authors)
+
+    async def _parent_authors(self, user):
+        comments = await self.user_comments(user)
+        if not comments:
+            return []
+
+        # Look up parents in batches, like the sync pipeline
+        parents = [c['parent_id'] for c in comments]
+        unique = list(collections.OrderedDict.fromkeys(parents))
+        authors = {}
+
+        for i in range(0, len(unique), reddit.SUB_BATCH_SIZE):
+            body = await self._get(
+                scheduler.LISTING, '/api/info',
+                id=','.join(unique[i:i + reddit.SUB_BATCH_SIZE]))
+            authors.update((child['data']['name'],
+                            child['data'].get('author'))
+                           for child in body['data']['children'])
+
+        # Deleted or missing authors are skipped
+        return [authors[p] for p in parents
+                if authors.get(p) not in (None, '[deleted]')]
+
+    async def submission_commenters(self, user):
+        """Return a list of the first submission_comments commenters on each
+        of a user's top submissions"""
+        return await self._cached('submission_commenters', user,
+                                  self._submission_commenters)
+
+    async def _submission_commenters(self, user):
+        submissions = await self.user_submissions(user)
+        if not submissions:
+            return []
+
+        threads = await asyncio.gather(*[
+            self._get(scheduler.LISTING, '/comments/' + s['id'],
+                      limit=reddit.submission_comments, sort='confidence')
+            for s in submissions], return_exceptions=True)
+
+        authors = []
+        for submission, thread in zip(submissions, threads):
+            if isinstance(thread, reddit.BudgetExceeded):
+                raise thread
+
+            # Each submission is skipped alone, as in the sync pipeline
+            if isinstance(thread, Exception):
+                logger.debug('Skipping comments of submission %s',
+                             submission['id'])
+                continue
+
+            for child in thread[1]['data']['children'][
+                    :reddit.submission_comments]:
+                # Skip collapsed comments and deleted authors
+                if (child['kind'] == 't1' and child['data'].get('author')
+                        not in (None, '[deleted]')):
+                    authors.append(child['data']['author'])
+
+        return authors
+
+    async def active_subs(self, user):
+        """Return a list of subs a user is active in"""
+        return await self._cached('active_subs', user, self._active_subs)
+
+    async def _active_subs(self, user):
+        comments, submissions = await asyncio.gather(
+            self.user_comments(user), self.user_submissions(user))
+
+        # Merge the subs of both listings in the order they are first found
+        subs = list(collections.OrderedDict.fromkeys(
+            p['subreddit_name_prefixed']
+            for posts in (comments, submissions) if posts is not None
+            for p in posts))
+
+        logger.debug('%s active subs found for user %s', len(subs), user)
+
+        return subs
+
+    async def similar_users(self, user):
+        """Return an ordered dictionary of users connected to a user mapped
+        to the strength of their connection, crawled as the sync pipeline
+        does"""
+        similar_users = collections.OrderedDict()
+        lookups = ((self.parent_authors, reddit.parent_weight),
+                   (self.submission_commenters, reddit.commenter_weight))
+
+        frontier = [user]
+        for depth in range(reddit.crawl_depth):
+            if depth and self.budget is not None and self.budget.exhausted():
+                break
+
+            jobs = [(u, lookup, weight) for u in frontier
+                    for lookup, weight in lookups]
+            results = await asyncio.gather(
+                *[lookup(u) for u, lookup, weight in jobs],
+                return_exceptions=True)
+
+            connections = []
+            for (crawled, lookup, weight), result in zip(jobs, results):
+                if isinstance(result, Exception):
+                    # Only a failure to crawl the user themself is fatal
+                    if depth == 0:
+                        raise result
+
+                    logger.debug('Skipping similar users of %s', crawled)
+                    continue
+
+                connections.append((weight, result))
+
+            frontier = reddit._add_connections(similar_users, user,
+                                               connections, depth)
+
+            if not frontier:
+                break
+
+        return reddit._strongest(similar_users)
+
+    async def sub_infos(self, subs):
+        """Return an ordered dictionary of subreddit to reddit.SubInfo,
+        looking up subs missing from the cache in batches"""
+        if reddit.prefetcher is not None:
+            reddit.prefetcher.record_subs(subs)
+
+        fields = collections.OrderedDict(
+            (sub, reddit._get_cached_fields(sub)) for sub in subs)
+
+        missing = [sub for sub, f in fields.items() if f is None]
+        chunks = [missing[i:i + reddit.SUB_BATCH_SIZE]
+                  for i in range(0, len(missing), reddit.SUB_BATCH_SIZE)]
+
+        batches = await asyncio.gather(
+            *[self._get(scheduler.METADATA, '/api/info',
+                        sr_name=','.join(chunk)) for chunk in chunks],
+            return_exceptions=True)
+
+        for chunk, body in zip(chunks, batches):
+            if isinstance(body, Exception):
+                logger.error('Unable to retrieve sub info for %s',
+                             util.sample(chunk))
+                continue
+
+            found = {}
+            for child in body['data']['children']:
+                name = child['data']['display_name_prefixed'][2:]
+                found[name.lower()] = self._store_fields(name, child['data'])
+
+            for sub in chunk:
+                fields[sub] = found.get(sub.lower())
+
+        # Fall back to single lookups for subs missing from batches
+        missing = [sub for sub, f in fields.items() if f is None]
+        found = await asyncio.gather(
+            *[self._get(scheduler.METADATA, '/r/{}/about'.format(sub))
+              for sub in missing],
+            return_exceptions=True)
+
+        for sub, body in zip(missing, found):
+            if isinstance(body, Exception):
+                logger.debug('Unable to retrieve sub info for %s', sub)
+            else:
+                fields[sub] = self._store_fields(sub, body['data'])
+
+        infos = collections.OrderedDict()
+        for sub, f in fields.items():
+            try:
+                infos[sub] = reddit._sub_info(f) if f is not None else None
+            except Exception:
+                logger.debug('Unable to build sub info for %s', sub)
+                infos[sub] = None
+
+        return infos
+
+    def _store_fields(self, sub, data):
+        """Return the subreddit fields in an API response, caching them
+        if the sub cache is enabled"""
+        fields = {f: data.get(f) for f in reddit.cache.SUB_FIELDS}
+
+        if reddit.sub_cache is not None:
+            reddit.sub_cache.set(sub, fields)
+
+        return fields
+
+    async def recommendations(self, user):
+        """Return a list of recommended subs for a user in rank order"""
+        if reddit.prefetcher is not None:
+            reddit.prefetcher.record_user(user)
+
+        try:
+            similar_users = await self.similar_users(user)
+        except Exception as e:
+            logger.error('Unable to get recommendations for user %s. Error '
+                         'retrieving similar users.', user)
+            logger.exception(e)
+
+            return []
+
+        # Strongest connections first so they are found if the budget runs
+        # out
+        neighbors = sorted(similar_users, key=lambda u: -similar_users[u])
+        results = await asyncio.gather(
+            *[self.active_subs(u) for u in [user] + neighbors],
+            return_exceptions=True)
+
+        # Without the user's own subs, subs they are already active in can't
+        # be left out, so nothing is recommended
+        if isinstance(results[0], Exception):
+            logger.error('Unable to get recommendations for user %s. Error '
+                         'retrieving active subs of the user.', user)
+
+            return []
+
+        user_subs = results[0]
+        found = {u: subs for u, subs in zip(neighbors, results[1:])
+                 if not isinstance(subs, Exception)}
+
+        weighted_subs = [(weight, found[u])
+                         for u, weight in similar_users.items()
+                         if u in found]
+
+        top_subs = reddit._top_subs(
+            reddit._score_subs(user_subs, weighted_subs),
+            reddit.max_recommendations)
+
+        try:
+            infos = await self.sub_infos([sub[2:] for sub in top_subs])
+        except Exception as e:
+            logger.error('Unable to get recommendations for user %s. Error '
+                         'retrieving sub info.', user)
+            logger.exception(e)
+
+            return []
+
+        subs = []
+        seen = set()
+        for sub_info in infos.values():
+            if sub_info is not None and sub_info.name not in seen:
+                seen.add(sub_info.name)
+                subs.append(sub_info)
+
+        if not subs:
+            logger.warning('No recommendations found for user %s', user)
+
+        return subs
+
+
+async def get_user_recommendations(client, user):
+    """Return a list of recommended subs for a user
+
+    Keyword arguments:
+    client -- Client making Reddit requests
+    user   -- username to retrieve recommendations for
+    """
+    budget = reddit.CrawlBudget(reddit.crawl_seconds, reddit.crawl_calls)
+
+    return await Crawler(client, budget).recommendations(user)
+
+
+async def user_exists(client, user):
+    """Return whether a reddit user exists
+
+    Keyword arguments:
+    client -- Client making Reddit requests
+    user   -- username to look up
+    """
+    try:
+        await client.get(scheduler.LISTING, '/user/{}/about'.format(user))
+    except NotFound:
+        logger.error('Unable to fetch recommendations for %s - user does not '
+                     'exist', user)
+        return False
+
+    return True
+
+
+class LoopThread(object):
+    """Event loop running on a background thread, for calling the async
+    backend from the sync Flask app"""
+
+    def __init__(self):
+        self._loop = None
+        self._lock = threading.Lock()
+
+    def run(self, coro):
+        """Run a coroutine on the loop and return its result"""
+        with self._lock:
+            # Threads don't survive a fork, so the loop is started on first
+            # use inside the worker process
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+
+                thread = threading.Thread(target=self._loop.run_forever,
+                                          name='subber-asyncio')
+                thread.daemon = True
+                thread.start()
+
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+
+# Loop serving the async backend to the Flask app
+loop_thread = LoopThread()
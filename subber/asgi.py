@@ -0,0 +1,188 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""ASGI entry point serving the Subber Flask app from an event loop
+
+Every request is handled by the views of the Flask app in subber.subber, so
+the response cache, conditional requests, streamed pages, jobs and batches
+behave as under a WSGI server. Views run on a thread pool and streamed
+responses are sent as each chunk is rendered. With the async backend the
+crawls themselves run on the event loop of aioreddit.loop_thread. Run it
+with any ASGI server, e.g.
+
+    uvicorn subber.asgi:app
+
+The app is configured from subber.cfg.
+"""
+
+import asyncio
+import io
+import logging
+import sys
+import threading
+
+from subber import aioreddit, subber
+
+logger = logging.getLogger(__name__)
+
+# Chunks of a streamed response rendered ahead of the client
+STREAM_BUFFER = 16
+
+subber.create_app()
+
+
+async def app(scope, receive, send):
+    """ASGI application"""
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+
+    if scope['type'] != 'http':
+        return
+
+    environ = _environ(scope, await _read_body(receive))
+    loop = asyncio.get_event_loop()
+    chunks = asyncio.Queue(STREAM_BUFFER)
+
+    # The whole response is rendered on one thread, as streamed templates
+    # keep their request context on the thread that started them
+    thread = threading.Thread(target=_respond,
+                              args=(environ, loop, chunks))
+    thread.daemon = True
+    thread.start()
+
+    status, headers = await chunks.get()
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': headers})
+
+    while True:
+        chunk = await chunks.get()
+        if chunk is None:
+            break
+
+        await send({'type': 'http.response.body', 'body': chunk,
+                    'more_body': True})
+
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+def _respond(environ, loop, chunks):
+    """Run the Flask app for a request, putting the status and headers then
+    each body chunk on an asyncio queue, and None once the body is done"""
+    def put(item):
+        asyncio.run_coroutine_threadsafe(chunks.put(item), loop).result()
+
+    started = []
+
+    def start_response(status, headers, exc_info=None):
+        started[:] = [(int(status.split(' ', 1)[0]),
+                       [(name.lower().encode('latin-1'),
+                         value.encode('latin-1'))
+                        for name, value in headers])]
+
+    try:
+        body = subber.app(environ, start_response)
+    except Exception:
+        logger.exception('Unhandled exception serving %s',
+                         environ['PATH_INFO'])
+        put((500, [(b'content-type', b'text/plain')]))
+        put(None)
+        return
+
+    sent = False
+    try:
+        for chunk in body:
+            if not sent:
+                put(started[0])
+                sent = True
+
+            if chunk:
+                put(chunk)
+    except Exception:
+        logger.exception('Unhandled exception streaming %s',
+                         environ['PATH_INFO'])
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+
+        if not sent:
+            put(started[0])
+
+        put(None)
+
+
+def _environ(scope, body):
+    """Return the WSGI environ of an ASGI HTTP request"""
+    server = scope.get('server') or ('localhost', 80)
+
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode(
+            'utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False}
+
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name != 'CONTENT_LENGTH':
+            key = 'HTTP_' + name
+            environ[key] = (environ[key] + ',' + value
+                            if key in environ else value)
+
+    return environ
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            # The async client belongs to the loop its crawls run on
+            if subber.async_client is not None:
+                await asyncio.get_event_loop().run_in_executor(
+                    None, aioreddit.loop_thread.run,
+                    subber.async_client.close())
+
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def _read_body(receive):
+    body = b''
+
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+
+        if not message.get('more_body'):
+            return body
@@ -0,0 +1,218 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Recommendations for many users at once, written as JSON Lines
+
+Users in a batch run through the same pipeline as single requests, so
+neighbor activity and subreddit metadata fetched for one user are served
+from the pipeline caches for every later user sharing them.
+
+    python -m subber.batch users.txt -o results.jsonl
+
+Rerunning the command with the same output file resumes a stopped run,
+skipping users already written except those that failed.
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import json
+import logging
+import os
+import sys
+
+from subber import metrics
+
+logger = logging.getLogger(__name__)
+
+DONE = 'done'
+NOT_FOUND = 'not_found'
+FAILED = 'failed'
+
+
+def read_users(lines):
+    """Return the usernames listed one per line, skipping blank lines and
+    lines starting with #
+
+    Keyword arguments:
+    lines -- iterable of lines
+    """
+    users = []
+    for line in lines:
+        user = line.strip()
+
+        if user and not user.startswith('#'):
+            users.append(user)
+
+    return users
+
+
+def iter_results(users, recommend, exists=None, done=(), workers=4):
+    """Yield a result dictionary for each user in input order, skipping
+    repeated users and users already done
+
+    Keyword arguments:
+    users     -- list of usernames
+    recommend -- callable returning the list of reddit.SubInfo recommended
+                 for a user
+    exists    -- optional callable returning whether a user exists
+    done      -- lowercased usernames to skip
+    workers   -- users processed concurrently
+    """
+    def run(user):
+        try:
+            if exists is not None and not exists(user):
+                return {'user': user, 'status': NOT_FOUND,
+                        'recommendations': []}
+
+            return {'user': user, 'status': DONE,
+                    'recommendations': [sub_info._asdict()
+                                        for sub_info in recommend(user)]}
+        except Exception as e:
+            logger.exception('Batch recommendations failed for user %s', user)
+
+            return {'user': user, 'status': FAILED, 'error': str(e),
+                    'recommendations': []}
+
+    skip = set(done)
+    pending = []
+    for user in users:
+        if user.lower() not in skip:
+            skip.add(user.lower())
+            pending.append(user)
+
+    logger.info('Starting batch of %s users, skipping %s', len(pending),
+                len(users) - len(pending))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        # Keep a bounded window of users in flight so results stream out
+        # as the batch progresses
+        window = collections.deque()
+        for user in pending:
+            window.append(pool.submit(run, user))
+
+            if len(window) >= workers * 2:
+                yield _finish(window.popleft())
+
+        while window:
+            yield _finish(window.popleft())
+
+
+def _finish(future):
+    result = future.result()
+    metrics.registry.inc('subber_batch_users_total', status=result['status'])
+
+    return result
+
+
+class Checkpoint(object):
+    """JSON Lines results file recording which users are done, so a batch
+    writing to it can resume after a crash"""
+
+    def __init__(self, path):
+        """Keyword arguments:
+        path -- results file, created if missing and appended to otherwise
+        """
+        self.path = path
+        self.done = set()
+
+        end = 0
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                for line in f:
+                    # A crash may leave the last line partly written
+                    try:
+                        result = json.loads(line.decode('utf-8'))
+                    except ValueError:
+                        break
+
+                    if not line.endswith(b'\n'):
+                        break
+
+                    # Failed users are retried on resume
+                    if result['status'] != FAILED:
+                        self.done.add(result['user'].lower())
+
+                    end += len(line)
+
+        self._file = open(path, 'ab')
+        self._file.truncate(end)
+
+    def write(self, result):
+        """Append a result and flush it to disk"""
+        self._file.write(json.dumps(result).encode('utf-8') + b'\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+        if result['status'] != FAILED:
+            self.done.add(result['user'].lower())
+
+    def close(self):
+        self._file.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Write subreddit recommendations for a list of users as '
+                    'JSON Lines')
+    parser.add_argument('users', help="file listing a username per line, or "
+                                      "'-' for standard input")
+    parser.add_argument('-o', '--output',
+                        help='results file, resumed if it exists; standard '
+                             'output if omitted')
+    parser.add_argument('-c', '--config', default='subber.cfg',
+                        help='Subber config file')
+    parser.add_argument('-w', '--workers', type=int, default=4,
+                        help='users processed concurrently')
+    args = parser.parse_args(argv)
+
+    # Imported here as the app imports this module
+    from subber import subber
+
+    subber.create_app(args.config)
+
+    if args.users == '-':
+        users = read_users(sys.stdin)
+    else:
+        with open(args.users) as f:
+            users = read_users(f)
+
+    checkpoint = Checkpoint(args.output) if args.output else None
+    done = checkpoint.done if checkpoint is not None else ()
+
+    counts = collections.Counter()
+    try:
+        for result in iter_results(users, subber.get_recommendations,
+                                   exists=subber.user_exists, done=done,
+                                   workers=args.workers):
+            counts[result['status']] += 1
+
+            if checkpoint is not None:
+                checkpoint.write(result)
+            else:
+                print(json.dumps(result), flush=True)
+    finally:
+        if checkpoint is not None:
+            checkpoint.close()
+
+    print('Processed {} users: {} done, {} not found, {} failed'.format(
+        sum(counts.values()), counts[DONE], counts[NOT_FOUND],
+        counts[FAILED]), file=sys.stderr)
+
+
+metrics.registry.describe('subber_batch_users_total', 'counter',
+                          'Users processed by batch requests')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,575 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import hashlib
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Subreddit fields grouped by how quickly they go out of date
+FIELD_CLASSES = collections.OrderedDict([
+    ('subscribers', ('subscribers',)),
+    ('profile', ('title', 'over18', 'public_description')),
+    ('identity', ('display_name_prefixed', 'created'))
+])
+
+SUB_FIELDS = tuple(f for fields in FIELD_CLASSES.values() for f in fields)
+
+DEFAULT_TTLS = {'subscribers': 3600,
+                'profile': 86400,
+                'identity': 604800}
+
+
+def _sizeof(key, fields):
+    """Return the approximate memory used by a cache entry in bytes"""
+    return sys.getsizeof(key) + sum(sys.getsizeof(v) for v in fields.values())
+
+
+class Backend(object):
+    """Key/value store for cached Reddit data. Values must be JSON
+    serializable."""
+
+    def get(self, key):
+        """Return the value stored for key, or None if missing or expired"""
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        """Store value for key, expiring after ttl seconds if given"""
+        raise NotImplementedError
+
+    def delete(self, key):
+        """Remove key from the store"""
+        raise NotImplementedError
+
+    def add(self, key, value, ttl=None):
+        """Store value for key unless a live value is stored, and return
+        whether it was stored"""
+        if self.get(key) is not None:
+            return False
+
+        self.set(key, value, ttl)
+
+        return True
+
+    def purge(self):
+        """Remove every expired entry"""
+
+
+class MemoryBackend(Backend):
+    """Backend private to the current process, evicting the least recently
+    used entries beyond max_entries"""
+
+    def __init__(self, clock=time.time, max_entries=10000):
+        """Keyword arguments:
+        clock       -- callable returning the current time in seconds
+        max_entries -- number of entries kept
+        """
+        self.max_entries = max_entries
+
+        self._clock = clock
+        self._values = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._values)
+
+    def get(self, key):
+        with self._lock:
+            value, expires = self._values.get(key, (None, None))
+
+            if expires is not None and expires <= self._clock():
+                del self._values[key]
+                return None
+
+            if value is not None:
+                self._values.move_to_end(key)
+
+        return None if value is None else json.loads(value)
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._store(key, value, ttl)
+
+    def _store(self, key, value, ttl):
+        expires = None if ttl is None else self._clock() + ttl
+
+        self._values.pop(key, None)
+        self._values[key] = (json.dumps(value), expires)
+
+        while len(self._values) > self.max_entries:
+            self._values.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._values.pop(key, None)
+
+    def add(self, key, value, ttl=None):
+        with self._lock:
+            stored, expires = self._values.get(key, (None, None))
+
+            if stored is not None and (expires is None or
+                                       expires > self._clock()):
+                return False
+
+            self._store(key, value, ttl)
+
+        return True
+
+    def purge(self):
+        now = self._clock()
+
+        with self._lock:
+            for key in [key for key, (value, expires) in self._values.items()
+                        if expires is not None and expires <= now]:
+                del self._values[key]
+
+
+class SQLiteBackend(Backend):
+    """Backend stored in a SQLite database in WAL mode, shared by every
+    process on a host that opens the same path. Expired entries are purged
+    every purge_every writes."""
+
+    def __init__(self, path, clock=time.time, timeout=5.0, purge_every=1000):
+        """Keyword arguments:
+        path        -- path to the database file
+        clock       -- callable returning the current time in seconds
+        timeout     -- seconds to wait for a lock held by another process
+        purge_every -- writes by this process between purges, 0 to never
+                       purge
+        """
+        self.path = path
+        self.timeout = timeout
+        self.purge_every = purge_every
+
+        self._clock = clock
+        self._local = threading.local()
+        self._writes = itertools.count(1)
+
+    def _connect(self):
+        # SQLite connections can't be shared between threads or carried
+        # across a fork, so each thread of each process opens its own
+        conn = getattr(self._local, 'conn', None)
+
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS cache ('
+                         'key TEXT PRIMARY KEY, '
+                         'value TEXT NOT NULL, '
+                         'expires REAL)')
+
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+
+        return conn
+
+    def get(self, key):
+        try:
+            row = self._connect().execute(
+                'SELECT value, expires FROM cache WHERE key = ?',
+                (key,)).fetchone()
+        except sqlite3.Error:
+            logger.exception('Unable to read %s from cache '
+                             '%s', key, self.path)
+            return None
+
+        if row is None:
+            return None
+
+        value, expires = row
+        if expires is not None and expires <= self._clock():
+            return None
+
+        return json.loads(value)
+
+    def set(self, key, value, ttl=None):
+        expires = None if ttl is None else self._clock() + ttl
+
+        try:
+            self._connect().execute(
+                'INSERT OR REPLACE INTO cache (key, value, expires) '
+                'VALUES (?, ?, ?)', (key, json.dumps(value), expires))
+        except sqlite3.Error:
+            logger.exception('Unable to write %s to cache '
+                             '%s', key, self.path)
+
+        if self.purge_every and next(self._writes) % self.purge_every == 0:
+            self.purge()
+
+    def delete(self, key):
+        try:
+            self._connect().execute('DELETE FROM cache WHERE key = ?',
+                                    (key,))
+        except sqlite3.Error:
+            logger.exception('Unable to delete %s from cache '
+                             '%s', key, self.path)
+
+    def add(self, key, value, ttl=None):
+        now = self._clock()
+        expires = None if ttl is None else now + ttl
+
+        try:
+            conn = self._connect()
+            with conn:
+                # Take the write lock so no other process adds the key
+                # between the two statements
+                conn.execute('BEGIN IMMEDIATE')
+                conn.execute('DELETE FROM cache WHERE key = ? AND '
+                             'expires <= ?', (key, now))
+                added = conn.execute(
+                    'INSERT OR IGNORE INTO cache (key, value, expires) '
+                    'VALUES (?, ?, ?)',
+                    (key, json.dumps(value), expires)).rowcount == 1
+        except sqlite3.Error:
+            logger.exception('Unable to add %s to cache '
+                             '%s', key, self.path)
+            return False
+
+        return added
+
+    def purge(self):
+        """Remove every expired entry"""
+        try:
+            self._connect().execute('DELETE FROM cache WHERE expires <= ?',
+                                    (self._clock(),))
+        except sqlite3.Error:
+            logger.exception('Unable to purge cache %s', self.path)
+
+
+class SubInfoCache(object):
+    """LRU cache of subreddit metadata with a TTL per field class
+
+    An entry is served only while every field class is fresh. Least
+    recently used entries are evicted once the cache grows past max_bytes.
+    Entries are also written through to an optional shared backend, which
+    is consulted on local misses.
+    """
+
+    def __init__(self, ttls=None, max_bytes=16777216, clock=time.time,
+                 backend=None):
+        """Keyword arguments:
+        ttls      -- dictionary of field class to time to live in seconds
+        max_bytes -- approximate memory cap for cached fields
+        clock     -- callable returning the current time in seconds
+        backend   -- Backend shared with other processes
+        """
+        self.ttls = dict(DEFAULT_TTLS)
+        self.ttls.update(ttls or {})
+        self.max_bytes = max_bytes
+        self.backend = backend
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._clock = clock
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, sub):
+        """Return cached fields for a subreddit, or None if missing or stale
+
+        Keyword arguments:
+        sub -- subreddit name
+        """
+        key = sub.lower()
+        now = self._clock()
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None and not self._is_stale(entry, now):
+                self._entries.move_to_end(key)
+                self.hits += 1
+
+                return dict(entry['fields'])
+
+        # Fall back to entries fetched by other processes
+        if self.backend is not None:
+            entry = self.backend.get('sub:' + key)
+
+            if entry is not None and not self._is_stale(entry, now):
+                with self._lock:
+                    self._store(key, entry)
+                    self.shared_hits += 1
+
+                return dict(entry['fields'])
+
+        with self._lock:
+            self.misses += 1
+
+        return None
+
+    def set(self, sub, fields):
+        """Cache subreddit fields, refreshing each field class provided
+
+        Keyword arguments:
+        sub    -- subreddit name
+        fields -- dictionary of subreddit field to value
+        """
+        key = sub.lower()
+        now = self._clock()
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                entry = {'fields': {}, 'fetched': {}}
+            else:
+                entry = {'fields': dict(entry['fields']),
+                         'fetched': dict(entry['fetched'])}
+
+            entry['fields'].update(fields)
+            for field_class, names in FIELD_CLASSES.items():
+                if all(name in fields for name in names):
+                    entry['fetched'][field_class] = now
+
+            self._store(key, entry)
+
+        if self.backend is not None:
+            self.backend.set('sub:' + key,
+                             {'fields': entry['fields'],
+                              'fetched': entry['fetched']},
+                             max(self.ttls.values()))
+
+    def _store(self, key, entry):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._size -= old['size']
+
+        entry['size'] = _sizeof(key, entry['fields'])
+        self._entries[key] = entry
+        self._size += entry['size']
+
+        # Evict least recently used entries past the memory cap
+        while self._size > self.max_bytes and len(self._entries) > 1:
+            evicted_key, evicted = self._entries.popitem(last=False)
+            self._size -= evicted['size']
+            self.evictions += 1
+
+            logger.debug('Evicted sub info for %s', evicted_key)
+
+    def expires_in(self, sub):
+        """Return seconds until a subreddit's locally cached fields go stale,
+        or None if it isn't cached
+
+        Keyword arguments:
+        sub -- subreddit name
+        """
+        now = self._clock()
+
+        with self._lock:
+            entry = self._entries.get(sub.lower())
+
+            if entry is None:
+                return None
+
+            return min(entry['fetched'].get(field_class, float('-inf')) +
+                       self.ttls[field_class] - now
+                       for field_class in FIELD_CLASSES)
+
+    def clear(self):
+        """Remove every cached entry"""
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        """Return a dictionary of cache counters"""
+        with self._lock:
+            return {'entries': len(self._entries),
+                    'bytes': self._size,
+                    'hits': self.hits,
+                    'shared_hits': self.shared_hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
+
+    def _is_stale(self, entry, now):
+        for field_class in FIELD_CLASSES:
+            fetched = entry['fetched'].get(field_class)
+
+            if fetched is None or now - fetched >= self.ttls[field_class]:
+                return True
+
+        return False
+
+
+class ResponseCache(object):
+    """LRU cache of rendered recommendation pages keyed by username
+
+    Pages are fresh for fresh seconds after rendering, then served stale for
+    up to stale more seconds while they are rendered again. A page whose
+    refresh failed isn't refreshed again for retry seconds. Entries are also
+    written through to an optional shared backend, which is consulted on
+    local misses.
+    """
+
+    def __init__(self, fresh=300, stale=3600, max_entries=1000,
+                 clock=time.time, backend=None, retry=300):
+        """Keyword arguments:
+        fresh       -- seconds a page is served without being refreshed
+        stale       -- seconds a page is served after going stale
+        retry       -- seconds before a page whose refresh failed is
+                       refreshed again
+        max_entries -- number of pages kept in memory
+        clock       -- callable returning the current time in seconds
+        backend     -- Backend shared with other processes
+        """
+        self.fresh = fresh
+        self.stale = stale
+        self.retry = retry
+        self.max_entries = max_entries
+        self.backend = backend
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+        self._clock = clock
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, user):
+        """Return a dictionary of the cached page body, etag, modified time,
+        whether it is stale and whether it should be refreshed for a user,
+        or None if missing or expired
+
+        Keyword arguments:
+        user -- username the page was rendered for
+        """
+        key = user.lower()
+        now = self._clock()
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None and self._age(entry, now) >= (self.fresh +
+                                                               self.stale):
+                del self._entries[key]
+                entry = None
+
+            if entry is not None:
+                self._entries.move_to_end(key)
+
+        # Fall back to pages rendered by other processes
+        if entry is None and self.backend is not None:
+            entry = self.backend.get('page:' + key)
+
+            if entry is not None:
+                with self._lock:
+                    self._store(key, entry)
+
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+
+            stale = self._age(entry, now) >= self.fresh
+            if stale:
+                self.stale_hits += 1
+            else:
+                self.hits += 1
+
+        failed = entry.get('refresh_failed')
+        refresh = stale and (failed is None or now - failed >= self.retry)
+
+        return dict(entry, stale=stale, refresh=refresh)
+
+    def set(self, user, body):
+        """Cache the page rendered for a user and return its entry
+
+        Keyword arguments:
+        user -- username the page was rendered for
+        body -- rendered page
+        """
+        key = user.lower()
+        entry = {'body': body,
+                 'etag': hashlib.sha1(body.encode('utf-8')).hexdigest(),
+                 'modified': self._clock()}
+
+        with self._lock:
+            self._store(key, entry)
+
+        if self.backend is not None:
+            self.backend.set('page:' + key, entry, self.fresh + self.stale)
+
+        return dict(entry, stale=False, refresh=False)
+
+    def refresh_failed(self, user):
+        """Record that refreshing a user's page failed, so it is served
+        stale without being refreshed for retry seconds
+
+        Keyword arguments:
+        user -- username the page was rendered for
+        """
+        key = user.lower()
+        now = self._clock()
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None:
+                entry = dict(entry, refresh_failed=now)
+                self._store(key, entry)
+
+        if self.backend is not None:
+            if entry is None:
+                entry = self.backend.get('page:' + key)
+
+                if entry is None:
+                    return
+
+                entry = dict(entry, refresh_failed=now)
+
+            ttl = self.fresh + self.stale - self._age(entry, now)
+            if ttl > 0:
+                self.backend.set('page:' + key, entry, ttl)
+
+    def _store(self, key, entry):
+        self._entries.pop(key, None)
+        self._entries[key] = entry
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _age(self, entry, now):
+        return now - entry['modified']
+
+    def clear(self):
+        """Remove every page cached in memory"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Return a dictionary of cache counters"""
+        with self._lock:
+            return {'entries': len(self._entries),
+                    'hits': self.hits,
+                    'stale_hits': self.stale_hits,
+                    'misses': self.misses}
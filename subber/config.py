@@ -36,6 +36,69 @@ schema = {
     "required": ["id", "secret", "password", "username"]
 }
 
+# Optional [subber] section tuning the recommendation pipeline. The type of
+# each default determines how the configured value is parsed.
+defaults = {
+    "workers": 8,
+    "similar_users_concurrency": 2,
+    "active_subs_concurrency": 8,
+    "sub_info_concurrency": 8,
+    "sub_cache_bytes": 16777216,
+    "subscribers_ttl": 3600,
+    "profile_ttl": 86400,
+    "identity_ttl": 604800,
+    "cache_path": "",
+    "activity_ttl": 3600,
+    "activity_cache_size": 10000,
+    "parent_weight": 2.0,
+    "commenter_weight": 1.0,
+    "max_recommendations": 10,
+    "job_workers": 4,
+    "job_ttl": 600,
+    "stream_results": False,
+    "rate_limit": 1.0,
+    "rate_burst": 30,
+    "rate_max_wait": 30.0,
+    "rate_max_queue": 100,
+    "timing_header": False,
+    "log_level": "INFO",
+    "log_file": "subber.log",
+    "log_max_bytes": 10485760,
+    "log_backups": 5,
+    "log_queue_size": 10000,
+    "graph_path": "",
+    "graph_ttl": 3600,
+    "graph_resync": 604800,
+    "index_path": "",
+    "listing_limit": 5,
+    "submission_comments": 1,
+    "crawl_depth": 1,
+    "crawl_decay": 0.5,
+    "max_neighbors": 0,
+    "crawl_seconds": 0.0,
+    "crawl_calls": 0,
+    "prefetch": False,
+    "prefetch_subs": 100,
+    "prefetch_users": 20,
+    "prefetch_horizon": 600,
+    "prefetch_interval": 5.0,
+    "prefetch_reserve": 10,
+    "backend": "sync",
+    "async_pool_size": 100,
+    "http_pool_size": 0,
+    "http_retries": 2,
+    "http_backoff": 0.5,
+    "http_connect_timeout": 5.0,
+    "http_read_timeout": 16.0,
+    "share_token": True,
+    "response_fresh": 300,
+    "response_stale": 3600,
+    "response_retry": 300,
+    "response_cache_size": 1000,
+    "batch_workers": 4,
+    "batch_max_users": 1000
+}
+
 
 def get_config(config_file="subber.cfg"):
     try:
@@ -63,3 +126,41 @@ def get_config(config_file="subber.cfg"):
 
 def get_api_config():
     return get_config()
+
+
+def get_options(config_file="subber.cfg"):
+    """Return the pipeline options from the optional [subber] section,
+    falling back to defaults for anything not configured"""
+    options = dict(defaults)
+
+    parser = configparser.ConfigParser()
+    try:
+        with open(config_file) as f:
+            parser.read_file(f)
+    except (FileNotFoundError, configparser.Error):
+        # get_config reports unreadable config files
+        return options
+
+    if not parser.has_section("subber"):
+        return options
+
+    for key in parser.options("subber"):
+        if key not in defaults:
+            logger.warning("Ignoring unknown option %s", key)
+            continue
+
+        kind = type(defaults[key])
+        try:
+            if kind is bool:
+                options[key] = parser.getboolean("subber", key)
+            elif kind is int:
+                options[key] = parser.getint("subber", key)
+            elif kind is float:
+                options[key] = parser.getfloat("subber", key)
+            else:
+                options[key] = parser.get("subber", key)
+        except ValueError:
+            logger.critical("Invalid value for option %s", key)
+            raise RuntimeError('Subber config file not loaded.')
+
+    return options
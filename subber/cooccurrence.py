@@ -0,0 +1,203 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Subreddit co-occurrence index
+
+Counts how many redditors are active in each pair of subs, stored as a
+sparse sub by sub matrix in CSR form. The arrays are saved as .npy files and
+memory mapped when loaded, so every worker on a host shares the same pages.
+
+Build an index from a graph store with:
+
+    python -m subber.cooccurrence graph.db index/
+"""
+
+import argparse
+import collections
+import itertools
+import json
+import logging
+import os
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from subber import graph
+
+logger = logging.getLogger(__name__)
+
+ARRAYS = ('indptr', 'indices', 'data', 'counts')
+
+
+class CooccurrenceIndex(object):
+    """Sparse matrix of the number of redditors active in both of two subs
+
+    Keyword arguments:
+    subs    -- list of sub names, the row and column labels
+    indptr  -- CSR row offsets into indices and data
+    indices -- CSR column of each stored count
+    data    -- CSR count of redditors active in both subs
+    counts  -- number of redditors active in each sub
+    """
+
+    def __init__(self, subs, indptr, indices, data, counts):
+        self.subs = subs
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.counts = counts
+
+        self._ids = {sub.lower(): i for i, sub in enumerate(subs)}
+
+    @classmethod
+    def load(cls, path):
+        """Return the index saved in a directory, memory mapping its arrays
+
+        Keyword arguments:
+        path -- directory written by save
+        """
+        if numpy is None:
+            raise RuntimeError('numpy is required for the co-occurrence '
+                               'index')
+
+        with open(os.path.join(path, 'subs.json')) as f:
+            subs = json.load(f)
+
+        arrays = [numpy.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+                  for name in ARRAYS]
+
+        logger.info('Loaded co-occurrence index of %s subs and %s pairs '
+                    'from %s', len(subs), len(arrays[1]), path)
+
+        return cls(subs, *arrays)
+
+    def save(self, path):
+        """Write the index to a directory
+
+        Keyword arguments:
+        path -- directory to write, created if missing
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        # Write to temporary names first so workers loading the index
+        # never see a partly written one
+        for name in ARRAYS:
+            with open(os.path.join(path, name + '.tmp.npy'), 'wb') as f:
+                numpy.save(f, getattr(self, name))
+
+        with open(os.path.join(path, 'subs.json.tmp'), 'w') as f:
+            json.dump(self.subs, f)
+
+        for name in ARRAYS:
+            os.replace(os.path.join(path, name + '.tmp.npy'),
+                       os.path.join(path, name + '.npy'))
+
+        os.replace(os.path.join(path, 'subs.json.tmp'),
+                   os.path.join(path, 'subs.json'))
+
+    def recommend(self, user_subs, k):
+        """Return a list of up to k (sub, score) for the subs most often
+        active together with a user's subs, best first. Scores are the
+        cosine similarity of sub memberships summed over the user's subs.
+
+        Keyword arguments:
+        user_subs -- subs the user is active in, which are skipped
+        k         -- number of subs to return
+        """
+        rows = sorted(set(self._ids[sub.lower()] for sub in user_subs
+                          if sub.lower() in self._ids))
+
+        if not rows or k <= 0:
+            return []
+
+        scores = numpy.zeros(len(self.subs))
+        for row in rows:
+            start, end = self.indptr[row], self.indptr[row + 1]
+            numpy.add.at(scores, self.indices[start:end],
+                         self.data[start:end] /
+                         numpy.sqrt(self.counts[row]))
+
+        scores /= numpy.sqrt(numpy.maximum(self.counts, 1))
+        scores[rows] = 0
+
+        # Highest scores first, ties broken by sub id so results are stable
+        candidates = numpy.flatnonzero(scores)
+        if len(candidates) > k:
+            candidates = candidates[numpy.argpartition(-scores[candidates],
+                                                       k - 1)[:k]]
+
+        ranked = sorted(candidates, key=lambda i: (-scores[i], i))
+
+        return [(self.subs[i], float(scores[i])) for i in ranked]
+
+
+def build(activity):
+    """Return a CooccurrenceIndex counting the subs redditors are active in
+    together
+
+    Keyword arguments:
+    activity -- iterable of the list of subs each redditor is active in
+    """
+    if numpy is None:
+        raise RuntimeError('numpy is required for the co-occurrence index')
+
+    names = {}
+    counts = collections.Counter()
+    pairs = collections.Counter()
+
+    for subs in activity:
+        keys = sorted(set(sub.lower() for sub in subs))
+
+        for sub in subs:
+            names.setdefault(sub.lower(), sub)
+
+        counts.update(keys)
+        pairs.update(itertools.permutations(keys, 2))
+
+    keys = sorted(names)
+    ids = {key: i for i, key in enumerate(keys)}
+
+    entries = sorted((ids[a], ids[b], n) for (a, b), n in pairs.items())
+    rows = numpy.array([e[0] for e in entries], dtype=numpy.int32)
+
+    indptr = numpy.zeros(len(keys) + 1, dtype=numpy.int64)
+    numpy.cumsum(numpy.bincount(rows, minlength=len(keys)), out=indptr[1:])
+
+    return CooccurrenceIndex(
+        [names[key] for key in keys], indptr,
+        numpy.array([e[1] for e in entries], dtype=numpy.int32),
+        numpy.array([e[2] for e in entries], dtype=numpy.float32),
+        numpy.array([counts[key] for key in keys], dtype=numpy.float32))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Build the subreddit co-occurrence index from the '
+                    'activity in a graph store')
+    parser.add_argument('graph_path', help='graph store database')
+    parser.add_argument('index_path', help='directory to write the index to')
+    args = parser.parse_args(argv)
+
+    store = graph.GraphStore(args.graph_path)
+    index = build(subs for user, subs in store.iter_activity())
+    index.save(args.index_path)
+
+    print('Indexed {} subs and {} pairs'.format(len(index.subs),
+                                                len(index.data)))
+
+
+if __name__ == '__main__':
+    main()
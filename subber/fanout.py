@@ -0,0 +1,145 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import concurrent.futures
+import logging
+import threading
+
+from subber import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class FanOut(object):
+    """Bounded-concurrency executor for recommendation pipeline stages
+
+    Calls over their stage's limit wait in a queue of the stage rather than
+    in a worker thread, so a throttled stage never holds threads the other
+    stages need.
+    """
+
+    def __init__(self, workers=1, limits=None):
+        """Keyword arguments:
+        workers -- size of the shared worker pool, 1 runs stages serially
+        limits  -- dictionary of stage name to max concurrent calls
+        """
+        self.workers = workers
+        self._limits = {}
+        self._running = collections.Counter()
+        self._pending = collections.defaultdict(collections.deque)
+        self._executor = None
+        self._lock = threading.Lock()
+
+        for stage, limit in (limits or {}).items():
+            if limit > 0:
+                self._limits[stage] = limit
+
+    def _get_executor(self):
+        # Threads do not survive a fork, so the pool is created on first use
+        # inside the worker process
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.workers)
+
+            return self._executor
+
+    def _submit(self, executor, stage, call, item):
+        limit = self._limits.get(stage)
+        if limit is None:
+            return executor.submit(call, item)
+
+        future = concurrent.futures.Future()
+
+        with self._lock:
+            if self._running[stage] >= limit:
+                self._pending[stage].append((future, call, item))
+                return future
+
+            self._running[stage] += 1
+
+        self._start(executor, stage, future, call, item)
+
+        return future
+
+    def _start(self, executor, stage, future, call, item):
+        if not future.set_running_or_notify_cancel():
+            self._release(executor, stage)
+            return
+
+        def finish(inner):
+            error = inner.exception()
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(inner.result())
+
+            self._release(executor, stage)
+
+        try:
+            inner = executor.submit(call, item)
+        except RuntimeError as e:
+            # The pool was shut down while the call waited on its stage
+            future.set_exception(e)
+            self._release(executor, stage)
+            return
+
+        inner.add_done_callback(finish)
+
+    def _release(self, executor, stage):
+        # Hand the finished call's slot to the next call of the stage
+        with self._lock:
+            if not self._pending[stage]:
+                self._running[stage] -= 1
+                return
+
+            future, call, item = self._pending[stage].popleft()
+
+        self._start(executor, stage, future, call, item)
+
+    def map(self, stage, func, items):
+        """Return a list of (item, future) pairs in input order with func
+        applied to each item
+
+        Keyword arguments:
+        stage -- name of the pipeline stage, used for concurrency limits
+        func  -- callable taking a single item
+        items -- iterable of items to process
+        """
+        if self.workers <= 1:
+            results = []
+            for item in items:
+                future = concurrent.futures.Future()
+                try:
+                    future.set_result(func(item))
+                except Exception as e:
+                    future.set_exception(e)
+
+                results.append((item, future))
+
+            return results
+
+        # Calls run under the trace of the request that started them
+        call = metrics.bind(func)
+
+        executor = self._get_executor()
+        return [(item, self._submit(executor, stage, call, item))
+                for item in items]
+
+    def shutdown(self):
+        """Stop the worker pool after pending calls complete"""
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
@@ -0,0 +1,289 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import itertools
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Listing item kept in the store. Fields are named after the praw attributes
+# the pipeline reads so stored posts can stand in for fetched ones.
+Post = collections.namedtuple('Post', ['fullname', 'subreddit_name_prefixed',
+                                       'parent_id'])
+
+# Fetch state of a user's listing: fullname of its newest post, used as the
+# before cursor for incremental refreshes, and when it was last refreshed
+# and last fetched in full
+Listing = collections.namedtuple('Listing', ['cursor', 'fetched', 'synced'])
+
+SCHEMA = ('CREATE TABLE IF NOT EXISTS listings ('
+          'user TEXT, listing TEXT, cursor TEXT, fetched REAL, synced REAL, '
+          'PRIMARY KEY (user, listing))',
+          'CREATE TABLE IF NOT EXISTS posts ('
+          'user TEXT, listing TEXT, post TEXT, sub TEXT, parent TEXT, '
+          'sort REAL, fetched REAL, PRIMARY KEY (user, listing, post))',
+          'CREATE TABLE IF NOT EXISTS edges ('
+          'user TEXT, post TEXT, other TEXT, fetched REAL, '
+          'PRIMARY KEY (user, post, other))')
+
+
+class GraphStore(object):
+    """Persistent graph of redditor activity stored in a SQLite database in
+    WAL mode
+
+    Posts from a user's listings are user to subreddit activity edges.
+    Edges map a user's post to the other users it connects them with, such
+    as the author of the post a comment replies to. Every row records when it
+    was fetched so callers can refresh stale parts of the graph only.
+    """
+
+    def __init__(self, path, clock=time.time, timeout=5.0):
+        """Keyword arguments:
+        path    -- path to the database file
+        clock   -- callable returning the current time in seconds
+        timeout -- seconds to wait for a lock held by another process
+        """
+        self.path = path
+        self.timeout = timeout
+        self.clock = clock
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._conns = []
+        self._closed = False
+
+    def _connect(self):
+        # SQLite connections can't be shared between threads or carried
+        # across a fork, so each thread of each process opens its own. They
+        # are only closed from other threads, once no longer used.
+        conn = getattr(self._local, 'conn', None)
+
+        if conn is None or self._local.pid != os.getpid():
+            if self._closed:
+                raise sqlite3.ProgrammingError('Graph store is closed')
+
+            conn = sqlite3.connect(self.path, timeout=self.timeout,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            for statement in SCHEMA:
+                conn.execute(statement)
+
+            with self._lock:
+                self._conns.append((os.getpid(), conn))
+
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+
+        return conn
+
+    def close(self):
+        """Close the connections this process opened to the database. Later
+        reads and writes fail as if the database were unavailable."""
+        with self._lock:
+            self._closed = True
+            conns, self._conns = self._conns, []
+
+        for pid, conn in conns:
+            if pid == os.getpid():
+                conn.close()
+
+    def get_listing(self, user, listing):
+        """Return the Listing state of a user's listing, or None if it has
+        never been fetched
+
+        Keyword arguments:
+        user    -- username
+        listing -- listing name, such as comments
+        """
+        try:
+            row = self._connect().execute(
+                'SELECT cursor, fetched, synced FROM listings '
+                'WHERE user = ? AND listing = ?',
+                (user.lower(), listing)).fetchone()
+        except sqlite3.Error:
+            logger.exception('Unable to read %s listing of %s from graph '
+                             '%s', listing, user, self.path)
+            return None
+
+        return None if row is None else Listing(*row)
+
+    def get_posts(self, user, listing):
+        """Return the stored posts of a user's listing in listing order
+
+        Keyword arguments:
+        user    -- username
+        listing -- listing name, such as comments
+        """
+        try:
+            rows = self._connect().execute(
+                'SELECT post, sub, parent FROM posts '
+                'WHERE user = ? AND listing = ? ORDER BY sort',
+                (user.lower(), listing)).fetchall()
+        except sqlite3.Error:
+            logger.exception('Unable to read %s posts of %s from graph '
+                             '%s', listing, user, self.path)
+            return []
+
+        return [Post(*row) for row in rows]
+
+    def add_posts(self, user, listing, posts, cursor, replace=False,
+                  keep=None):
+        """Store posts fetched from a user's listing and mark it refreshed
+
+        Keyword arguments:
+        user    -- username
+        listing -- listing name, such as comments
+        posts   -- list of (Post, sort key) with the lowest key listed first
+        cursor  -- fullname of the newest post in the listing
+        replace -- whether posts is the whole listing, dropping stored posts
+                   missing from it
+        keep    -- number of posts kept, dropping those listed last
+        """
+        now = self.clock()
+        key = user.lower()
+
+        try:
+            conn = self._connect()
+
+            with conn:
+                conn.execute('BEGIN')
+
+                if replace:
+                    conn.execute('DELETE FROM posts '
+                                 'WHERE user = ? AND listing = ?',
+                                 (key, listing))
+
+                conn.executemany(
+                    'INSERT OR REPLACE INTO posts '
+                    '(user, listing, post, sub, parent, sort, fetched) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    [(key, listing, post.fullname,
+                      post.subreddit_name_prefixed, post.parent_id, sort, now)
+                     for post, sort in posts])
+
+                if keep is not None:
+                    conn.execute(
+                        'DELETE FROM posts WHERE user = ? AND listing = ? '
+                        'AND post NOT IN (SELECT post FROM posts '
+                        'WHERE user = ? AND listing = ? '
+                        'ORDER BY sort LIMIT ?)',
+                        (key, listing, key, listing, keep))
+
+                # Edges of posts no longer stored are dropped with them
+                conn.execute('DELETE FROM edges WHERE user = ? AND post NOT '
+                             'IN (SELECT post FROM posts WHERE user = ?)',
+                             (key, key))
+
+                conn.execute(
+                    'INSERT OR REPLACE INTO listings '
+                    '(user, listing, cursor, fetched, synced) '
+                    'VALUES (?, ?, ?, ?, COALESCE(?, (SELECT synced '
+                    'FROM listings WHERE user = ? AND listing = ?)))',
+                    (key, listing, cursor, now, now if replace else None,
+                     key, listing))
+        except sqlite3.Error:
+            logger.exception('Unable to write %s posts of %s to graph '
+                             '%s', listing, user, self.path)
+
+    def get_edges(self, user, posts, max_age=None):
+        """Return a dictionary of post fullname to the list of users it
+        connects a user with, for the posts whose edges are stored
+
+        Keyword arguments:
+        user    -- username
+        posts   -- list of post fullnames
+        max_age -- seconds since edges were stored from which they are
+                   left out, None to return edges of any age
+        """
+        if not posts:
+            return {}
+
+        oldest = self.clock() - max_age if max_age is not None else None
+
+        try:
+            rows = self._connect().execute(
+                'SELECT post, other FROM edges WHERE user = ? AND post IN '
+                '({}) AND (? IS NULL OR fetched > ?)'.format(
+                    ', '.join('?' * len(posts))),
+                [user.lower()] + list(posts) + [oldest, oldest]).fetchall()
+        except sqlite3.Error:
+            logger.exception('Unable to read edges of %s from graph '
+                             '%s', user, self.path)
+            return {}
+
+        edges = {}
+        for post, other in rows:
+            edges.setdefault(post, [])
+
+            # Posts without connections are stored with an empty name
+            if other:
+                edges[post].append(other)
+
+        return edges
+
+    def add_edges(self, user, edges):
+        """Store the users a user's posts connect them with, replacing those
+        stored for the posts
+
+        Keyword arguments:
+        user  -- username
+        edges -- dictionary of post fullname to list of other usernames
+        """
+        now = self.clock()
+        key = user.lower()
+
+        try:
+            conn = self._connect()
+
+            with conn:
+                conn.execute('BEGIN')
+                conn.executemany('DELETE FROM edges '
+                                 'WHERE user = ? AND post = ?',
+                                 [(key, post) for post in edges])
+                conn.executemany(
+                    'INSERT OR REPLACE INTO edges (user, post, other, '
+                    'fetched) VALUES (?, ?, ?, ?)',
+                    [(key, post, other, now)
+                     for post, others in edges.items()
+                     for other in (others or [''])])
+        except sqlite3.Error:
+            logger.exception('Unable to write edges of %s to graph '
+                             '%s', user, self.path)
+
+    def iter_activity(self):
+        """Yield (username, list of subs) for every user with stored posts,
+        listing a sub once per post"""
+        rows = self._connect().execute('SELECT user, sub FROM posts '
+                                       'ORDER BY user')
+
+        for user, posts in itertools.groupby(rows, lambda row: row[0]):
+            yield user, [sub for _, sub in posts]
+
+    def stats(self):
+        """Return a dictionary of the number of stored users, posts and
+        edges"""
+        conn = self._connect()
+
+        return {'users': conn.execute('SELECT COUNT(DISTINCT user) '
+                                      'FROM listings').fetchone()[0],
+                'posts': conn.execute('SELECT COUNT(*) '
+                                      'FROM posts').fetchone()[0],
+                'edges': conn.execute('SELECT COUNT(*) '
+                                      'FROM edges').fetchone()[0]}
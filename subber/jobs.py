@@ -0,0 +1,202 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import concurrent.futures
+import logging
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# Seconds the shared entries of a running job last, so a job whose worker
+# died is eventually forgotten
+RUNNING_TTL = 3600
+
+
+class Job(object):
+    """Background recommendation request for a user"""
+
+    def __init__(self, user, clock=time.time):
+        self.id = uuid.uuid4().hex
+        self.user = user
+        self.status = PENDING
+        self.results = []
+        self.error = None
+        self.created = clock()
+        self.finished = None
+
+    @property
+    def in_flight(self):
+        return self.status in (PENDING, RUNNING)
+
+    def to_dict(self):
+        """Return a JSON serializable dictionary describing the job"""
+        return {'id': self.id,
+                'user': self.user,
+                'status': self.status,
+                'results': list(self.results),
+                'error': self.error}
+
+    @classmethod
+    def from_dict(cls, fields):
+        """Return a job described by a dictionary returned by to_dict"""
+        job = cls(fields['user'])
+        job.id = fields['id']
+        job.status = fields['status']
+        job.results = fields['results']
+        job.error = fields['error']
+
+        return job
+
+
+class JobManager(object):
+    """Run recommendation jobs on a background executor, attaching duplicate
+    submissions for a user to the job already in flight
+
+    Without a backend, jobs are known only to the process running them, so
+    polling requires a single worker. With a backend shared by the workers,
+    any worker serves a job's status and duplicate submissions attach to a
+    job running in another worker.
+    """
+
+    def __init__(self, workers=4, ttl=600, clock=time.time, backend=None):
+        """Keyword arguments:
+        workers -- number of jobs run concurrently
+        ttl     -- seconds finished jobs are kept for polling
+        clock   -- callable returning the current time in seconds
+        backend -- cache.Backend shared with other workers
+        """
+        self.workers = workers
+        self.ttl = ttl
+        self.backend = backend
+
+        self._clock = clock
+        self._jobs = {}
+        self._in_flight = {}
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def submit(self, user, func):
+        """Return the in-flight job for a user, or start a new job calling
+        func(user, on_result). func should pass each result to on_result as
+        soon as it is available and may raise to fail the job.
+
+        Keyword arguments:
+        user -- username to get recommendations for
+        func -- callable running the recommendation request
+        """
+        key = user.lower()
+
+        with self._lock:
+            self._expire()
+
+            job = self._in_flight.get(key)
+            if job is not None:
+                logger.info('Attaching request for user %s to job '
+                            '%s', user, job.id)
+                return job
+
+            job = Job(user, self._clock)
+
+            if self.backend is not None and not self.backend.add(
+                    'job_user:' + key, job.id, RUNNING_TTL):
+                # Another worker is running a job for the user
+                job = self._get_shared(self.backend.get('job_user:' + key))
+                if job is not None:
+                    logger.info('Attaching request for user %s to job %s '
+                                'of another worker', user, job.id)
+                    return job
+
+                job = Job(user, self._clock)
+                self.backend.set('job_user:' + key, job.id, RUNNING_TTL)
+
+            self._jobs[job.id] = job
+            self._in_flight[key] = job
+            self._publish(job)
+
+            # Threads do not survive a fork, so the pool is created on first
+            # use inside the worker process
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.workers)
+
+            self._executor.submit(self._run, job, func)
+
+        logger.info('Started job %s for user %s', job.id, user)
+
+        return job
+
+    def get(self, job_id):
+        """Return a job by id, or None if unknown or expired"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+
+        if job is None:
+            job = self._get_shared(job_id)
+
+        return job
+
+    def _get_shared(self, job_id):
+        """Return a job published by any worker, or None"""
+        if self.backend is None or job_id is None:
+            return None
+
+        fields = self.backend.get('job:' + job_id)
+
+        return None if fields is None else Job.from_dict(fields)
+
+    def _publish(self, job):
+        """Share the state of a job with other workers"""
+        if self.backend is None:
+            return
+
+        ttl = RUNNING_TTL if job.in_flight else self.ttl
+        self.backend.set('job:' + job.id, job.to_dict(), ttl)
+
+    def _run(self, job, func):
+        job.status = RUNNING
+        self._publish(job)
+
+        def on_result(result):
+            job.results.append(result)
+            self._publish(job)
+
+        try:
+            func(job.user, on_result)
+            job.status = DONE
+        except Exception as e:
+            logger.exception('Job %s for user %s failed', job.id, job.user)
+            job.error = str(e)
+            job.status = FAILED
+        finally:
+            job.finished = self._clock()
+            self._publish(job)
+
+            with self._lock:
+                self._in_flight.pop(job.user.lower(), None)
+
+            if self.backend is not None:
+                self.backend.delete('job_user:' + job.user.lower())
+
+    def _expire(self):
+        now = self._clock()
+
+        for job_id, job in list(self._jobs.items()):
+            if job.finished is not None and now - job.finished >= self.ttl:
+                del self._jobs[job_id]
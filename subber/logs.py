@@ -0,0 +1,177 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import atexit
+import contextlib
+import fcntl
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+
+from subber import metrics
+
+FORMAT = '%(asctime)-26s %(name)-17s %(levelname)-8s %(message)s'
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """Hand log records to a background writer without blocking the caller
+
+    Records are queued unformatted so messages are built on the writer
+    thread. When the queue is full the record is dropped and counted rather
+    than making the request wait on the disk.
+    """
+
+    def __init__(self, pipeline):
+        logging.handlers.QueueHandler.__init__(self, pipeline.queue)
+        self.pipeline = pipeline
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        self.pipeline.start()
+
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.registry.inc('subber_log_dropped_total')
+
+
+class SharedFileHandler(logging.handlers.RotatingFileHandler):
+    """Rotating log file shared by every process writing to it
+
+    Each record is written holding an exclusive lock on a lock file next to
+    the log, so only one process rotates it at a time. A process whose file
+    was renamed by another, or by an external tool such as logrotate,
+    reopens the log before writing.
+    """
+
+    def __init__(self, filename, max_bytes=0, backups=0):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backups,
+                         delay=True)
+
+        self.lock_path = self.baseFilename + '.lock'
+
+        self._lock_file = None
+        self._lock_pid = None
+
+    def emit(self, record):
+        try:
+            with self._locked():
+                self._reopen_if_moved()
+                super().emit(record)
+        except Exception:
+            self.handleError(record)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        # Locks are shared with a forked parent through the inherited file,
+        # so each process opens its own
+        pid = os.getpid()
+        if self._lock_pid != pid:
+            self._lock_file = open(self.lock_path, 'a')
+            self._lock_pid = pid
+
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _reopen_if_moved(self):
+        if self.stream is None:
+            return
+
+        try:
+            current = os.stat(self.baseFilename)
+        except FileNotFoundError:
+            current = None
+
+        opened = os.fstat(self.stream.fileno())
+        if (current is None or (current.st_dev, current.st_ino) !=
+                (opened.st_dev, opened.st_ino)):
+            self.stream.close()
+            self.stream = None
+
+    def close(self):
+        with self.lock:
+            if self._lock_file is not None and self._lock_pid == os.getpid():
+                self._lock_file.close()
+                self._lock_file = None
+
+        super().close()
+
+
+class Pipeline(object):
+    """Queue feeding a rotating log file from a background thread
+
+    Keyword arguments:
+    filename  -- log file path
+    max_bytes -- size the log file is rotated at, 0 never rotates
+    backups   -- rotated log files kept
+    max_queue -- records waiting to be written before new ones are dropped
+    """
+
+    def __init__(self, filename, max_bytes=0, backups=0, max_queue=10000):
+        self.max_queue = max_queue
+        self.queue = queue.Queue(max_queue)
+        self.listener = None
+
+        self.writer = SharedFileHandler(filename, max_bytes=max_bytes,
+                                        backups=backups)
+        self.writer.setFormatter(logging.Formatter(FORMAT))
+
+        self.handler = QueueHandler(self)
+
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the writer thread in this process unless it is running.
+        Records are queued from the first one logged, so this only needs
+        calling to start writing before then."""
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+
+        with self._lock:
+            if self._pid == pid:
+                return
+
+            # Threads don't survive a fork, so a forked process starts its
+            # own writer on a new queue. Records the parent had queued are
+            # still written by the parent's writer, and the copy of the
+            # queue may have been locked by it mid-fork.
+            if self._pid is not None:
+                self.queue = self.handler.queue = queue.Queue(self.max_queue)
+            else:
+                atexit.register(self.stop)
+
+            self.listener = logging.handlers.QueueListener(self.queue,
+                                                           self.writer)
+            self.listener.start()
+            self._pid = pid
+
+    def stop(self):
+        """Write out queued records and close the log file"""
+        if self.listener is not None and self.listener._thread is not None:
+            self.listener.stop()
+
+        self.writer.close()
+
+
+metrics.registry.describe('subber_log_dropped_total', 'counter',
+                          'Log records dropped because the log queue was '
+                          'full')
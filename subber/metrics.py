@@ -0,0 +1,283 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import contextlib
+import functools
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+           30.0, 60.0)
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"'))
+                          for k, v in pairs) + '}'
+
+
+class Registry(object):
+    """Process-wide counters and histograms exported in the Prometheus text
+    format"""
+
+    def __init__(self):
+        self._types = collections.OrderedDict()
+        self._help = {}
+        self._counters = collections.defaultdict(float)
+        self._histograms = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def describe(self, name, kind, text):
+        """Declare the type and help text of a metric
+
+        Keyword arguments:
+        name -- metric name
+        kind -- 'counter', 'gauge' or 'histogram'
+        text -- help text
+        """
+        self._types[name] = kind
+        self._help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        """Increment a counter"""
+        with self._lock:
+            self._counters[(name, _labels(labels))] += value
+
+    def observe(self, name, value, **labels):
+        """Add an observation to a histogram"""
+        key = (name, _labels(labels))
+
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {
+                    'buckets': [0] * len(BUCKETS), 'sum': 0.0, 'count': 0}
+
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    histogram['buckets'][i] += 1
+
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def collect(self, func):
+        """Register a callable returning (name, labels, value) samples read
+        when metrics are rendered, such as cache sizes"""
+        if func not in self._collectors:
+            self._collectors.append(func)
+
+    def get(self, name, **labels):
+        """Return the value of a counter"""
+        with self._lock:
+            return self._counters.get((name, _labels(labels)), 0)
+
+    def render(self):
+        """Return every metric in the Prometheus text format"""
+        samples = collections.defaultdict(list)
+
+        with self._lock:
+            for (name, labels), value in self._counters.items():
+                samples[name].append((labels, value))
+
+            histograms = [(key, dict(h, buckets=list(h['buckets'])))
+                          for key, h in self._histograms.items()]
+
+        for func in self._collectors:
+            try:
+                for name, labels, value in func():
+                    samples[name].append((_labels(labels), value))
+            except Exception:
+                logger.exception('Unable to collect metrics from '
+                                 '%s', func)
+
+        for (name, labels), histogram in histograms:
+            for bound, count in zip(BUCKETS, histogram['buckets']):
+                samples[name + '_bucket'].append(
+                    (labels + (('le', repr(bound)),), count))
+
+            samples[name + '_bucket'].append(
+                (labels + (('le', '+Inf'),), histogram['count']))
+            samples[name + '_sum'].append((labels, histogram['sum']))
+            samples[name + '_count'].append((labels, histogram['count']))
+
+        declared = set()
+        for name, kind in self._types.items():
+            if kind == 'histogram':
+                declared.update(name + s for s in ('_bucket', '_sum',
+                                                   '_count'))
+            else:
+                declared.add(name)
+
+        lines = []
+        names = list(self._types) + sorted(n for n in samples
+                                           if n not in declared)
+
+        for name in names:
+            kind = self._types.get(name, 'untyped')
+            series = [name] if kind != 'histogram' else [
+                name + '_bucket', name + '_sum', name + '_count']
+
+            if not any(samples.get(s) for s in series):
+                continue
+
+            if name in self._help:
+                lines.append('# HELP {} {}'.format(name, self._help[name]))
+            lines.append('# TYPE {} {}'.format(name, kind))
+
+            for s in series:
+                for labels, value in samples.get(s, ()):
+                    lines.append('{}{} {}'.format(s, _format_labels(labels),
+                                                  value))
+
+        return '\n'.join(lines) + '\n'
+
+
+class Trace(object):
+    """Timings and counters for a single request"""
+
+    def __init__(self):
+        self.durations = collections.OrderedDict()
+        self.counts = collections.Counter()
+        self.errors = collections.Counter()
+
+        self._lock = threading.Lock()
+
+    def add_span(self, stage, duration, error=False):
+        with self._lock:
+            self.durations[stage] = self.durations.get(stage, 0) + duration
+            if error:
+                self.errors[stage] += 1
+
+    def add_count(self, name, value=1):
+        with self._lock:
+            self.counts[name] += value
+
+    def server_timing(self):
+        """Return the trace as a Server-Timing header value"""
+        with self._lock:
+            entries = ['{};dur={:.1f}'.format(stage, duration * 1000)
+                       for stage, duration in self.durations.items()]
+            entries.extend('{};desc="{}"'.format(name, value)
+                           for name, value in sorted(self.counts.items()))
+
+        return ', '.join(entries)
+
+
+registry = Registry()
+registry.describe('subber_stage_duration_seconds', 'histogram',
+                  'Time spent in recommendation pipeline stages')
+registry.describe('subber_stage_errors_total', 'counter',
+                  'Pipeline stage calls that raised an error')
+registry.describe('subber_request_duration_seconds', 'histogram',
+                  'Time spent handling recommendation requests')
+registry.describe('subber_praw_calls_total', 'counter',
+                  'Requests made to the Reddit API')
+registry.describe('subber_cache_hits_total', 'counter', 'Cache hits')
+registry.describe('subber_cache_misses_total', 'counter', 'Cache misses')
+
+_local = threading.local()
+
+
+def current_trace():
+    """Return the trace of the request running on this thread, if any"""
+    return getattr(_local, 'trace', None)
+
+
+def set_trace(trace):
+    """Make a trace current on this thread and return the previous one"""
+    previous = current_trace()
+    _local.trace = trace
+    return previous
+
+
+def bind(func):
+    """Return func wrapped to run under the current thread's trace, for
+    passing work to other threads"""
+    trace = current_trace()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        previous = set_trace(trace)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            set_trace(previous)
+
+    return wrapper
+
+
+def count(name, value=1, **labels):
+    """Increment a counter in the registry and the current trace
+
+    Keyword arguments:
+    name  -- counter name without the subber_ prefix and _total suffix
+    value -- amount to increment by
+    """
+    registry.inc('subber_{}_total'.format(name), value, **labels)
+
+    trace = current_trace()
+    if trace is not None:
+        trace.add_count(name, value)
+
+
+@contextlib.contextmanager
+def span(stage):
+    """Time a pipeline stage, recording errors raised within it
+
+    Keyword arguments:
+    stage -- name of the stage
+    """
+    start = time.time()
+    error = False
+
+    try:
+        yield
+    except Exception:
+        error = True
+        raise
+    finally:
+        duration = time.time() - start
+
+        registry.observe('subber_stage_duration_seconds', duration,
+                         stage=stage)
+        if error:
+            registry.inc('subber_stage_errors_total', stage=stage)
+
+        trace = current_trace()
+        if trace is not None:
+            trace.add_span(stage, duration, error)
+
+
+def traced(stage):
+    """Decorate a function so each call is timed as a pipeline stage"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,225 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import heapq
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class AccessTracker(object):
+    """Track how often keys are accessed, with older accesses counting for
+    less as time passes"""
+
+    def __init__(self, half_life=3600, max_keys=10000, clock=time.time):
+        """Keyword arguments:
+        half_life -- seconds for an access to lose half its weight
+        max_keys  -- keys tracked, the least accessed are forgotten first
+        clock     -- callable returning the current time in seconds
+        """
+        self.half_life = half_life
+        self.max_keys = max_keys
+
+        self._clock = clock
+        self._scores = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._scores)
+
+    def __contains__(self, key):
+        return key in self._scores
+
+    def _decayed(self, score, last, now):
+        return score * 2 ** (-(now - last) / self.half_life)
+
+    def record(self, key):
+        """Count an access to a key"""
+        now = self._clock()
+
+        with self._lock:
+            score, last = self._scores.get(key, (0, now))
+            self._scores[key] = (self._decayed(score, last, now) + 1, now)
+
+            # Forget the coldest half past the cap rather than one key per
+            # access
+            if len(self._scores) > 2 * self.max_keys:
+                for key in self._hottest(len(self._scores), now)[
+                        self.max_keys:]:
+                    del self._scores[key]
+
+    def hottest(self, n):
+        """Return up to n keys, most accessed first"""
+        with self._lock:
+            return self._hottest(n, self._clock())
+
+    def _hottest(self, n, now):
+        return [key for key, (score, last) in heapq.nlargest(
+            n, self._scores.items(),
+            key=lambda item: self._decayed(item[1][0], item[1][1], now))]
+
+
+class Prefetcher(object):
+    """Refresh the most requested subreddit metadata and the activity of
+    frequent users in the background while the API budget is idle, before
+    their cached entries expire"""
+
+    def __init__(self, refresh_subs, refresh_user, expires_in, idle,
+                 user_ttl=3600, max_subs=100, max_users=20, horizon=600,
+                 interval=5.0, half_life=3600, clock=time.time):
+        """Keyword arguments:
+        refresh_subs -- callable fetching metadata for a list of subs
+        refresh_user -- callable fetching the activity of a user
+        expires_in   -- callable returning seconds until a sub's cached
+                        metadata expires, or None if it isn't cached
+        idle         -- callable returning whether there is API budget to
+                        spare
+        user_ttl     -- seconds cached user activity is kept
+        max_subs     -- hottest subs kept warm
+        max_users    -- hottest users kept warm
+        horizon      -- seconds before expiry entries are refreshed
+        interval     -- seconds between prefetch rounds
+        half_life    -- seconds for a request to lose half its weight
+        clock        -- callable returning the current time in seconds
+        """
+        self.refresh_subs = refresh_subs
+        self.refresh_user = refresh_user
+        self.expires_in = expires_in
+        self.idle = idle
+        self.user_ttl = user_ttl
+        self.max_subs = max_subs
+        self.max_users = max_users
+        self.horizon = horizon
+        self.interval = interval
+        self.subs = AccessTracker(half_life, clock=clock)
+        self.users = AccessTracker(half_life, clock=clock)
+        self.prefetched_subs = 0
+        self.prefetched_users = 0
+
+        self._clock = clock
+        self._fetched = {}
+        self._thread = None
+        self._pid = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def record_subs(self, subs):
+        """Count requests for subreddits' metadata"""
+        for sub in subs:
+            self.subs.record(sub.lower())
+
+        self._start()
+
+    def record_user(self, user):
+        """Count a recommendation request for a user, whose activity was
+        fetched or served from cache by the request"""
+        key = user.lower()
+        self.users.record(key)
+
+        with self._lock:
+            self._fetched.setdefault(key, self._clock())
+
+        self._start()
+
+    def record_fetch(self, user):
+        """Note that a request fetched and cached a user's activity again,
+        so its prefetch is due user_ttl from now"""
+        key = user.lower()
+
+        if key in self.users:
+            with self._lock:
+                self._fetched[key] = self._clock()
+
+    def _start(self):
+        # Threads do not survive a fork, so the prefetch thread is started
+        # on first use inside the worker process
+        with self._lock:
+            if self._pid == os.getpid() or self._stop.is_set():
+                return
+
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._loop,
+                                            name='subber-prefetch')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """Stop prefetching"""
+        self._stop.set()
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception('Prefetch round failed')
+
+    def run_once(self):
+        """Refresh hot entries close to expiry while budget is idle and
+        return the number of subs and users refreshed"""
+        if not self.idle():
+            return 0
+
+        count = 0
+
+        # Subs are refreshed in one batch, so check the budget once
+        subs = [sub for sub in self.subs.hottest(self.max_subs)
+                if self._expiring_sub(sub)]
+
+        if subs:
+            logger.debug('Prefetching metadata of %s hot subs', len(subs))
+            self.refresh_subs(subs)
+            self.prefetched_subs += len(subs)
+            count += len(subs)
+
+        now = self._clock()
+        with self._lock:
+            for user in [u for u in self._fetched if u not in self.users]:
+                del self._fetched[user]
+
+        for user in self.users.hottest(self.max_users):
+            with self._lock:
+                fetched = self._fetched.get(user, now)
+
+            if now - fetched < self.user_ttl - self.horizon:
+                continue
+
+            if not self.idle():
+                break
+
+            logger.debug('Prefetching activity of user %s', user)
+            self.refresh_user(user)
+            self.prefetched_users += 1
+            count += 1
+
+            with self._lock:
+                self._fetched[user] = self._clock()
+
+        return count
+
+    def _expiring_sub(self, sub):
+        remaining = self.expires_in(sub)
+
+        # Subs missing from the cache were evicted or fetched by another
+        # worker and are left to requests
+        return remaining is not None and remaining < self.horizon
+
+    def stats(self):
+        """Return a dictionary of prefetch counters"""
+        return {'tracked_subs': len(self.subs),
+                'tracked_users': len(self.users),
+                'prefetched_subs': self.prefetched_subs,
+                'prefetched_users': self.prefetched_users}
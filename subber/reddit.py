@@ -11,27 +11,419 @@
 # You should have received a copy of the GNU General Public License along with
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import heapq
+import itertools
 import logging
+import threading
+import time
 
 import praw
 import prawcore
 
-from subber import util
+from subber import (cache, fanout, graph, metrics, scheduler, transport,
+                    util)
 
 logger = logging.getLogger(__name__)
 
+# Metadata of a recommended subreddit
+SubInfo = collections.namedtuple('SubInfo', ['name', 'title', 'age',
+                                             'subscribers', 'over18',
+                                             'desc'])
+
+# Executor shared by every request, replaced by the app at startup. The
+# default runs each pipeline stage serially.
+executor = fanout.FanOut()
+
+# Subreddit metadata cache shared by every request, enabled by the app at
+# startup
+sub_cache = None
+
+# Backend caching the activity extracted from redditor comment and
+# submission listings, enabled by the app at startup
+activity_backend = None
+activity_ttl = 3600
+
+# Max subreddits or posts looked up per info request
+SUB_BATCH_SIZE = 100
+
+# Scheduler keeping Reddit requests within the API budget, enabled by the
+# app at startup
+api_scheduler = None
+
+# Connection strength of users whose posts a user commented on and of users
+# commenting on a user's submissions, and the number of subs recommended
+parent_weight = 2.0
+commenter_weight = 1.0
+max_recommendations = 10
+
+# Persistent graph of redditor activity, enabled by the app at startup.
+# Listings older than graph_ttl seconds are refreshed with only the posts
+# made since, and fetched in full again after graph_resync seconds.
+graph_store = None
+graph_ttl = 3600
+graph_resync = 604800
+
+# Crawl policy: posts read from each redditor listing, comments read from
+# each submission, hops from the user to crawl, weight kept per extra hop,
+# and the number of similar users kept (0 for no limit)
+listing_limit = 5
+submission_comments = 1
+crawl_depth = 1
+crawl_decay = 0.5
+max_neighbors = 0
+
+# Wall time in seconds and Reddit listing requests each recommendation may
+# spend crawling before ranking what it has found (0 for no limit)
+crawl_seconds = 0
+crawl_calls = 0
+
+# Precomputed subreddit co-occurrence index used by fast recommendations,
+# loaded by the app at startup
+cooccurrence_index = None
+
+# Prefetcher keeping popular subs and returning users warm, enabled by the
+# app at startup
+prefetcher = None
+
+
+class SingleFlight(object):
+    """Coalesce concurrent calls for the same key into a single call whose
+    result is shared by every caller"""
+
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args):
+        """Return func(*args), waiting on the call already in flight for key
+        if there is one
+
+        Keyword arguments:
+        key  -- hashable identifying the request
+        func -- callable making the request
+        """
+        with self._lock:
+            future = self._in_flight.get(key)
+
+            if future is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                self.calls += 1
+                future = self._in_flight[key] = concurrent.futures.Future()
+                leader = True
+
+        if leader:
+            try:
+                future.set_result(func(*args))
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                with self._lock:
+                    del self._in_flight[key]
+
+        return future.result()
+
+    def stats(self):
+        """Return a dictionary of call counters"""
+        with self._lock:
+            return {'calls': self.calls,
+                    'coalesced': self.coalesced,
+                    'in_flight': len(self._in_flight)}
+
+
+# Coalesces identical Reddit requests made concurrently by any request
+flights = SingleFlight()
+
+
+class BudgetExceeded(Exception):
+    """Raised by a crawl request made after its recommendation's crawl
+    budget ran out"""
+
+
+class CrawlBudget(object):
+    """Wall time and listing requests a recommendation may spend crawling
+
+    Keyword arguments:
+    seconds -- wall time from creation, 0 for no limit
+    calls   -- number of requests, 0 for no limit
+    clock   -- callable returning the current time in seconds
+    """
+
+    def __init__(self, seconds=0, calls=0, clock=time.monotonic):
+        self.deadline = clock() + seconds if seconds else None
+        self.max_calls = calls
+        self.calls = 0
+
+        self._clock = clock
+        self._lock = threading.Lock()
+
+    def exhausted(self):
+        """Return whether the budget has run out"""
+        return ((self.deadline is not None and
+                 self._clock() >= self.deadline) or
+                bool(self.max_calls and self.calls >= self.max_calls))
+
+    def charge(self):
+        """Count a request, raising BudgetExceeded if the budget has run
+        out"""
+        with self._lock:
+            if self.exhausted():
+                raise BudgetExceeded()
+
+            self.calls += 1
+
+
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def _crawl_budget(budget):
+    """Charge listing requests made on this thread to a budget"""
+    previous = getattr(_local, 'budget', None)
+    _local.budget = budget
+    try:
+        yield budget
+    finally:
+        _local.budget = previous
+
+
+@contextlib.contextmanager
+def _background():
+    """Make Reddit requests on this thread in the background lane"""
+    previous = getattr(_local, 'background', False)
+    _local.background = True
+    try:
+        yield
+    finally:
+        _local.background = previous
+
+
+@contextlib.contextmanager
+def _listing_memo(memo=None):
+    """Reuse the listings fetched on this thread until the block exits, so
+    every stage of a request reads a redditor's listings fetched once
+
+    Keyword arguments:
+    memo -- dictionary of listings to share, a new one if omitted
+    """
+    previous = getattr(_local, 'memo', None)
+    _local.memo = {} if memo is None else memo
+    try:
+        yield _local.memo
+    finally:
+        _local.memo = previous
+
+
+def _map(stage, func, items):
+    """Run executor.map with func charging the caller's crawl budget and
+    sharing the caller's listings on whichever thread it runs"""
+    budget = getattr(_local, 'budget', None)
+    memo = getattr(_local, 'memo', None)
+
+    @functools.wraps(func)
+    def wrapper(*args):
+        with _crawl_budget(budget), _listing_memo(memo):
+            return func(*args)
+
+    return executor.map(stage, wrapper, items)
+
+
+def _charge(lane):
+    """Charge a request to the crawl budget of this thread, raising
+    BudgetExceeded if it has run out
+
+    Keyword arguments:
+    lane -- scheduler priority lane of the request
+    """
+    budget = getattr(_local, 'budget', None)
+    if budget is not None and lane == scheduler.LISTING:
+        budget.charge()
+
+
+def _request(session, lane, func, *args, charge=True):
+    """Return the result of a Reddit request, made through the API scheduler
+    if one is configured
+
+    Keyword arguments:
+    session -- instance of the Reddit api
+    lane    -- scheduler priority lane of the request
+    func    -- callable making the request
+    charge  -- False if the caller already charged the request, as
+               requests shared through flights are charged to every caller
+    """
+    if charge:
+        _charge(lane)
+
+    if getattr(_local, 'background', False):
+        lane = scheduler.BACKGROUND
+
+    metrics.count('praw_calls')
+
+    if api_scheduler is None:
+        return func(*args)
+
+    try:
+        return api_scheduler.run(lane, func, *args)
+    finally:
+        state = _get_rate_limit(session)
+
+        if state is not None:
+            api_scheduler.update(*state)
+
+
+def _get_rate_limit(session):
+    """Return (remaining, seconds to reset) from the latest x-ratelimit
+    response headers seen by a session, or None if unknown
+
+    Keyword arguments:
+    session -- instance of the Reddit api
+    """
+    try:
+        limiter = session._core._rate_limiter
+        if limiter.remaining is None or limiter.reset_timestamp is None:
+            return None
+
+        return (limiter.remaining,
+                max(0, limiter.reset_timestamp - time.time()))
+    except AttributeError:
+        return None
+
+
+def _cached_activity(kind):
+    """Share the results of a redditor lookup through activity_backend
+
+    Keyword arguments:
+    kind -- name of the lookup, used in cache keys
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(session, user):
+            if activity_backend is None:
+                return func(session, user)
+
+            key = '{}:{}:{}'.format(kind, listing_limit, user.lower())
+            result = activity_backend.get(key)
+
+            if result is not None:
+                metrics.count('cache_hits', cache='activity')
+            else:
+                metrics.count('cache_misses', cache='activity')
+                result = func(session, user)
+
+                # Empty results are usually failed requests and results
+                # found after the crawl budget ran out may be partial, so
+                # they are left uncached
+                budget = getattr(_local, 'budget', None)
+                if result and (budget is None or not budget.exhausted()):
+                    activity_backend.set(key, result, activity_ttl)
+
+                    if prefetcher is not None:
+                        prefetcher.record_fetch(user)
+
+            return result
+
+        def refresh(session, user):
+            """Look up a user bypassing the cache and cache the result"""
+            result = func(session, user)
+
+            if result and activity_backend is not None:
+                activity_backend.set(
+                    '{}:{}:{}'.format(kind, listing_limit, user.lower()),
+                    result, activity_ttl)
+
+            return result
+
+        wrapper.refresh = refresh
+
+        return wrapper
+
+    return decorator
+
+
+def _memoized_listing(kind):
+    """Return a redditor listing from the listing memo of the request when
+    one is active, fetching it only the first time
+
+    Keyword arguments:
+    kind -- name of the listing, used in memo keys
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(session, user):
+            memo = getattr(_local, 'memo', None)
+            if memo is None:
+                return func(session, user)
+
+            key = (kind, user.lower())
+            result = memo.get(key)
+
+            if result is not None:
+                metrics.count('cache_hits', cache='listing')
+            else:
+                metrics.count('cache_misses', cache='listing')
+                result = func(session, user)
+
+                # Failed fetches are left out so a later stage retries them
+                if result is not None:
+                    memo[key] = result
+
+            return result
+
+        return wrapper
+
+    return decorator
+
 
 class Reddit(object):
     """Reddit API session"""
 
-    def __init__(self, client_id, client_secret, password, username):
+    def __init__(self, client_id, client_secret, password, username,
+                 http=None, timeout=prawcore.const.TIMEOUT,
+                 token_backend=None, scheduled=False):
+        """Keyword arguments:
+        client_id     -- Reddit app id
+        client_secret -- Reddit app secret
+        password      -- password of the Reddit account
+        username      -- name of the Reddit account
+        http          -- requests session sending API requests, such as one
+                         built by transport.build_session
+        timeout       -- seconds, or (connect, read) seconds, before a
+                         request is abandoned
+        token_backend -- cache.Backend sharing access tokens between
+                         workers, or None for each to request its own
+        scheduled     -- whether api_scheduler spaces out requests, in which
+                         case PRAW doesn't sleep between them
+        """
         self._session = praw.Reddit(client_id=client_id,
                                     client_secret=client_secret,
                                     password=password,
                                     user_agent='web app',
-                                    username=username)
+                                    username=username,
+                                    requestor_class=transport.Requestor,
+                                    requestor_kwargs={'session': http,
+                                                      'timeout': timeout})
 
-        # Verify connection
+        if scheduled:
+            self._session._core._rate_limiter = (
+                transport.ScheduledRateLimiter())
+
+        if token_backend is not None:
+            transport.share_token(self._session._core._authorizer,
+                                  token_backend,
+                                  'token:{}:{}'.format(client_id,
+                                                       username.lower()))
+
+    def verify(self):
+        """Check the credentials by fetching the authenticated user, raising
+        RuntimeError if Reddit rejects them"""
         try:
             self._session.user.me()
         except prawcore.exceptions.OAuthException:
@@ -45,199 +437,942 @@ class Reddit(object):
         return self._session
 
 
-def get_user_recommendations(session, user):
+class LazySession(object):
+    """Stand-in for a Reddit API session that creates it on first use and
+    verifies its credentials in the background
+
+    Creating the session and checking the credentials both happen in the
+    process that first uses the session, so the app can be imported and
+    forked without network access. Once the credentials are found to be
+    invalid, every use raises RuntimeError.
+    """
+
+    def __init__(self, factory):
+        """Keyword arguments:
+        factory -- callable returning a Reddit instance
+        """
+        self._factory = factory
+        self._session = None
+        self._error = None
+        self._lock = threading.Lock()
+
+    def _resolve(self):
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    client = self._factory()
+
+                    thread = threading.Thread(target=self._verify,
+                                              args=(client,),
+                                              name='subber-verify')
+                    thread.daemon = True
+                    thread.start()
+
+                    self._session = client.get_session()
+
+        if self._error is not None:
+            raise RuntimeError(self._error)
+
+        return self._session
+
+    def _verify(self, client):
+        try:
+            client.verify()
+        except RuntimeError as e:
+            self._error = str(e)
+        except Exception:
+            # Reddit may be briefly unreachable, which requests will report
+            logger.warning('Unable to verify Reddit API credentials',
+                           exc_info=True)
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+
+def get_user_recommendations(session, user, on_result=None):
     """Return a list of recommended subs for a user
 
+    Keyword arguments:
+    session   -- instance of the Reddit api
+    user      -- username to retrieve recommendations for
+    on_result -- optional callable passed each recommendation as it is found
+    """
+    subs = []
+    for sub_info in iter_user_recommendations(session, user):
+        subs.append(sub_info)
+
+        if on_result is not None:
+            on_result(sub_info)
+
+    if not subs:
+        logger.warning('No recommendations found for user %s', user)
+    else:
+        logger.debug('Recommending subs %s to user %s.',
+                     util.sample(s.name for s in subs), user)
+
+    return subs
+
+
+def iter_user_recommendations(session, user):
+    """Yield recommended subs for a user in rank order, each as soon as its
+    metadata is available
+
     Keyword arguments:
     session  -- instance of the Reddit api
     user     -- username to retrieve recommendations for
     """
-    # Get similar users
+    if prefetcher is not None:
+        prefetcher.record_user(user)
+
+    budget = CrawlBudget(crawl_seconds, crawl_calls)
+
+    with _crawl_budget(budget), _listing_memo():
+        # Get similar users
+        try:
+            similar_users = _get_similar_users(session, user)
+        except Exception as e:
+            logger.error('Unable to get recommendations for user %s. Error '
+                         'retrieving similar users.', user)
+            logger.exception(e)
+
+            return
+
+        # Fetch active subs for the user and every similar user, strongest
+        # connections first so they are found if the budget runs out
+        neighbors = sorted(similar_users, key=lambda u: -similar_users[u])
+        activity = _map('active_subs',
+                        functools.partial(_get_active_subs, session),
+                        [user] + neighbors)
+
+        user_subs = None
+        found = {}
+        for i, (sim_user, future) in enumerate(activity):
+            try:
+                if i == 0:
+                    user_subs = future.result()
+                else:
+                    found[sim_user] = future.result()
+
+            except BudgetExceeded:
+                logger.debug('Skipping active subs of %s for user %s, crawl '
+                             'budget exhausted', sim_user, user)
+
+            except Exception as e:
+                logger.exception('Unable to get recommendations for user '
+                                 '%s. Error retrieving active subs for user '
+                                 '%s', user, sim_user)
+                logger.exception(e)
+
+    if budget.exhausted():
+        logger.info('Crawl budget exhausted for user %s after %s requests, '
+                    'ranking subs of %s similar users', user, budget.calls,
+                    len(found))
+        metrics.count('crawl_budget_exhausted')
+
+    # Without the user's own subs, subs they are already active in can't be
+    # left out, so nothing is recommended
+    if user_subs is None:
+        logger.error('Unable to get recommendations for user %s. Error '
+                     'retrieving active subs of the user.', user)
+        return
+
+    weighted_subs = [(weight, found[sim_user])
+                     for sim_user, weight in similar_users.items()
+                     if sim_user in found]
+
+    # Rank subs and fetch metadata for the best ones only
+    top_subs = _top_subs(_score_subs(user_subs, weighted_subs),
+                         max_recommendations)
+
+    # Yield sub recommendations in rank order, each as soon as its batch
+    # of metadata arrives
+    seen = set()
     try:
-        similar_users = _get_similar_users(session, user)
+        for sub, sub_info in iter_sub_infos(session,
+                                            [sub[2:] for sub in top_subs]):
+            if sub_info is not None and sub_info.name not in seen:
+                seen.add(sub_info.name)
+
+                yield sub_info
     except Exception as e:
-        logger.error('Unable to get recommendations for user {}. Error '
-                     'retrieving similar users.'.format(user))
+        logger.error('Unable to get recommendations for user %s. Error '
+                     'retrieving sub info.', user)
         logger.exception(e)
 
-        return
 
-    # Create a list of sub recommendations
-    subs = []
-    for sim_user in similar_users:
-        # Get active subs for similar user
-        try:
-            active_subs = _get_active_subs(session, sim_user)
+def get_fast_recommendations(session, user):
+    """Return a list of recommended subs for a user scored by the
+    co-occurrence index from the user's own active subs, without crawling
+    similar users. Falls back to get_user_recommendations when the index is
+    not loaded or knows none of the user's subs.
 
-            # Add active subs to recommendations
-            for sub in active_subs:
+    Keyword arguments:
+    session -- instance of the Reddit api
+    user    -- username to retrieve recommendations for
+    """
+    if cooccurrence_index is None:
+        return get_user_recommendations(session, user)
 
-                # Get sub metadata and append if not in subs
-                sub_info = get_sub_info(session, sub[2:])
+    user_subs = _get_active_subs(session, user)
 
-                if sub_info not in subs:
-                    subs.append(sub_info)
+    with metrics.span('index_lookup'):
+        ranked = cooccurrence_index.recommend(user_subs, max_recommendations)
 
-        except Exception as e:
-            logger.exception('Unable to get recommendations for user {}. '
-                             'Error retrieving active subs for user '
-                             '{}'.format(user, sim_user))
-            logger.exception(e)
+    if not ranked:
+        logger.info('No indexed subs for user %s, falling back to similar '
+                    'users', user)
+        return get_user_recommendations(session, user)
 
-    if not subs:
-        logger.warning('No recommendations found for user {}'.format(user))
-    else:
-        logger.debug('Recommending subs {} to user {}.'.format(subs, user))
+    infos = get_sub_infos(session, [sub[2:] for sub, score in ranked])
+
+    subs = []
+    seen = set()
+    for sub_info in infos.values():
+        if sub_info is not None and sub_info.name not in seen:
+            seen.add(sub_info.name)
+            subs.append(sub_info)
+
+    logger.debug('Recommending indexed subs %s to user %s.',
+                 util.sample(s.name for s in subs), user)
 
     return subs
 
 
+def _score_subs(user_subs, weighted_subs):
+    """Return an ordered dictionary of sub to score, in the order subs were
+    first found. Each similar user active in a sub adds their connection
+    weight to its score.
+
+    Keyword arguments:
+    user_subs     -- subs the user is already active in, which are skipped
+    weighted_subs -- list of (weight, active subs) for each similar user
+    """
+    skip = set(sub.lower() for sub in user_subs)
+
+    names = {}
+    scores = collections.OrderedDict()
+    for weight, active_subs in weighted_subs:
+        for key in collections.OrderedDict.fromkeys(
+                sub.lower() for sub in active_subs):
+            if key not in skip:
+                scores[key] = scores.get(key, 0) + weight
+
+        for sub in active_subs:
+            names.setdefault(sub.lower(), sub)
+
+    return collections.OrderedDict((names[key], score)
+                                   for key, score in scores.items())
+
+
+def _top_subs(scores, k):
+    """Return the k highest scoring subs, breaking ties by the order subs
+    were found
+
+    Keyword arguments:
+    scores -- ordered dictionary of sub to score
+    k      -- number of subs to return
+    """
+    ranked = heapq.nlargest(k, enumerate(scores.items()),
+                            key=lambda e: (e[1][1], -e[0]))
+
+    return [sub for i, (sub, score) in ranked]
+
+
+@metrics.traced('similar_users')
 def _get_similar_users(session, user):
-    """Return a list containing users that have commented on a user's post
-    and users whose posts have been commented on by a user.
+    """Return an ordered dictionary of users that have commented on a user's
+    post and users whose posts have been commented on by a user, mapped to
+    the strength of their connection to the user.
+
+    Users are crawled breadth first up to crawl_depth hops from the user,
+    connections found at each extra hop weighing crawl_decay times as much.
+    Crawling stops early when the crawl budget runs out.
 
     Keyword arguments:
     session -- instance of the Reddit api
     user    -- username to retrieve similar users for
     """
-    similar_users = []
+    similar_users = collections.OrderedDict()
+    budget = getattr(_local, 'budget', None)
+
+    lookups = ((_get_parent_authors, parent_weight),
+               (_get_submission_commenters, commenter_weight))
+
+    frontier = [user]
+    for depth in range(crawl_depth):
+        if depth and budget is not None and budget.exhausted():
+            break
+
+        # Retrieve parent commenters and submission commenters concurrently
+        results = _map('similar_users',
+                       lambda job: job[1][0](session, job[0]),
+                       [(u, lookup) for u in frontier for lookup in lookups])
+
+        connections = []
+        for (crawled, (lookup, weight)), future in results:
+            try:
+                connections.append((weight, future.result()))
+            except Exception:
+                # Only a failure to crawl the user themself is fatal
+                if depth == 0:
+                    raise
+
+                logger.debug('Skipping similar users of %s', crawled)
+
+        frontier = _add_connections(similar_users, user, connections, depth)
+
+        if not frontier:
+            break
+
+    similar_users = _strongest(similar_users)
+
+    logger.debug('Considering %s similar users %s for user %s',
+                 len(similar_users), util.sample(similar_users), user)
+
+    return similar_users
+
+
+def _add_connections(similar_users, user, connections, depth):
+    """Add the users found on one hop of the crawl to similar_users and
+    return the users to crawl on the next hop
+
+    Keyword arguments:
+    similar_users -- ordered dictionary of similar user to weight
+    user          -- username recommendations are for
+    connections   -- list of (weight, list of connected users) found
+    depth         -- hops from the user the connections were found at
+    """
+    found = collections.OrderedDict()
+    for weight, authors in connections:
+        for author in authors:
+            if author != user and author.lower() != user.lower():
+                found[author] = (found.get(author, 0) +
+                                 weight * crawl_decay ** depth)
+
+    # Crawl users first found at this hop on the next one, the strongest
+    # first as _strongest keeps them
+    frontier = sorted((u for u in found if u not in similar_users),
+                      key=lambda u: -found[u])
+
+    for author, weight in found.items():
+        similar_users[author] = similar_users.get(author, 0) + weight
+
+    if max_neighbors:
+        frontier = frontier[:max_neighbors]
+
+    return frontier
+
+
+def _strongest(similar_users):
+    """Return similar_users keeping only the max_neighbors strongest
+    connections, in the order they were found
+
+    Keyword arguments:
+    similar_users -- ordered dictionary of similar user to weight
+    """
+    if not max_neighbors or len(similar_users) <= max_neighbors:
+        return similar_users
 
-    # Retrieve commenters from parent comments
+    keep = set(sorted(similar_users, key=lambda u: -similar_users[u])
+               [:max_neighbors])
+
+    return collections.OrderedDict(
+        (u, w) for u, w in similar_users.items() if u in keep)
+
+
+@_cached_activity('parent_authors')
+def _get_parent_authors(session, user):
+    """Return a list of the authors of posts a user has commented on
+
+    Keyword arguments:
+    session -- instance of the Reddit api
+    user    -- username to retrieve parent authors for
+    """
     comments = _get_user_comments(session, user)
 
-    try:
-        for comment in comments:
-            parent = comment.parent().author.name
-            if parent not in similar_users and parent != user:
-                similar_users.append(parent)
-    except Exception:
-        # Comment is deleted
-        pass
+    if not comments:
+        return []
+
+    if graph_store is not None:
+        return _get_interactions(session, user, comments,
+                                 _fetch_parent_authors)
+
+    return _connections(comments, _fetch_parent_authors(session, comments))
+
 
-    # Retrieve commenters from user's top posts
+@_cached_activity('submission_commenters')
+def _get_submission_commenters(session, user):
+    """Return a list of the first submission_comments commenters on each of
+    a user's top submissions
+
+    Keyword arguments:
+    session -- instance of the Reddit api
+    user    -- username to retrieve submission commenters for
+    """
     submissions = _get_user_submissions(session, user)
 
-    try:
-        for s in submissions:
-            for c in s.comments:
-                if (c.author and c.author.name not in similar_users and
-                        c.author.name != user):
-                    similar_users.append(c.author.name)
+    if not submissions:
+        return []
 
-                break  # limit to one submission comment
-    except Exception:
-        # Comments missing
-        logger.debug('Skipping submission comments for user '
-                     '{}'.format(user))
-        pass
+    if graph_store is not None:
+        return _get_interactions(session, user, submissions,
+                                 _fetch_commenters)
 
-    logger.debug('Considering similar users {} for user '
-                 '{}'.format(similar_users, user))
+    return _connections(submissions, _fetch_commenters(session, submissions))
 
-    return similar_users
 
+def _post(thing, parent_id=None):
+    """Return a graph.Post of the fields the pipeline reads from a PRAW
+    comment or submission, so the PRAW object can be dropped. Only fields
+    present in listings are read, as any other would load the whole post.
+
+    Keyword arguments:
+    thing     -- PRAW comment or submission
+    parent_id -- fullname of the post a comment replies to
+    """
+    return graph.Post(thing.fullname, thing.subreddit_name_prefixed,
+                      parent_id)
 
+
+@_memoized_listing('comments')
 def _get_user_comments(session, user):
-    """Return a list of a user's five newest comments
+    """Return a list of graph.Post for a user's listing_limit newest
+    comments
 
     Keyword arguments:
     session  -- instance of the Reddit api
     user     -- username to retrieve comments for
     """
-    try:
-        comments = session.redditor(user).comments.new(limit=5)
-        logger.debug('PRAW comment request made for user {}'.format(user))
+    if graph_store is not None:
+        return _get_stored_listing(session, user, 'comments')
+
+    def fetch():
+        logger.debug('PRAW comment request made for user %s', user)
+        return _request(session, scheduler.LISTING, lambda: [
+            _post(c, c.parent_id)
+            for c in session.redditor(user).comments.new(
+                limit=listing_limit)], charge=False)
 
-        return comments
+    # Charged here so callers sharing the request are each charged, and
+    # only for their own budget
+    _charge(scheduler.LISTING)
+
+    try:
+        return flights.do(('comments', user.lower(), listing_limit), fetch)
     except Exception:
-        logger.error('Error retrieving comments for user {}'.format(user))
+        logger.error('Error retrieving comments for user %s', user)
 
 
+@_memoized_listing('submissions')
 def _get_user_submissions(session, user):
-    """Return a list of a user's top five submissions
+    """Return a list of graph.Post for a user's listing_limit top
+    submissions
 
     Keyword arguments:
     session  -- instance of the Reddit api
     user     -- username to retrieve submissions for
     """
-    try:
-        submissions = session.redditor(user).submissions.top(limit=5)
-        logger.debug('PRAW submission request made for user {}'.format(user))
+    if graph_store is not None:
+        return _get_stored_listing(session, user, 'submissions')
 
-        return submissions
+    def fetch():
+        logger.debug('PRAW submission request made for user %s', user)
+        return _request(session, scheduler.LISTING, lambda: [
+            _post(s)
+            for s in session.redditor(user).submissions.top(
+                limit=listing_limit)], charge=False)
+
+    _charge(scheduler.LISTING)
+
+    try:
+        return flights.do(('submissions', user.lower(), listing_limit),
+                          fetch)
     except Exception:
-        logger.error('Error retrieving submissions for user {}'.format(user))
+        logger.error('Error retrieving submissions for user %s', user)
 
 
-def _get_active_subs(session, user):
-    """Return a list of subs a user is active in
+def _get_stored_listing(session, user, listing):
+    """Return a list of graph.Post for a user's comments or submissions from
+    the graph store, refreshing the listing first if it is stale. Returns
+    None if the listing was never fetched and can't be.
 
     Keyword arguments:
     session -- instance of the Reddit api
-    user    -- username to retrieve active subs for
+    user    -- username to retrieve the listing for
+    listing -- comments or submissions
+    """
+    state = graph_store.get_listing(user, listing)
+
+    if state is not None and graph_store.clock() - state.fetched < graph_ttl:
+        metrics.count('cache_hits', cache='graph')
+    else:
+        metrics.count('cache_misses', cache='graph')
+        _charge(scheduler.LISTING)
+
+        try:
+            flights.do((listing, user.lower(), listing_limit),
+                       _refresh_listing, session, user, listing, state)
+        except Exception:
+            logger.error('Error refreshing %s for user %s', listing, user)
+
+            # Serve the stale listing rather than nothing
+            if state is None:
+                return None
+
+    return graph_store.get_posts(user, listing)
+
+
+def _refresh_listing(session, user, listing, state):
+    """Fetch a user's comments or submissions into the graph store. Comments
+    already stored are refreshed with only the comments made since the
+    newest one stored, or fetched again in full if a whole page of newer
+    comments came back.
+
+    Keyword arguments:
+    session -- instance of the Reddit api
+    user    -- username to refresh the listing for
+    listing -- comments or submissions
+    state   -- graph.Listing of the stored listing, or None
+    """
+    redditor = session.redditor(user)
+
+    if listing == 'submissions':
+        # Top submissions aren't ordered by time, so there is no cursor to
+        # resume from
+        logger.debug('PRAW submission request made for user %s', user)
+        submissions = _request(session, scheduler.LISTING, lambda: list(
+            redditor.submissions.top(limit=listing_limit)), charge=False)
+
+        graph_store.add_posts(
+            user, listing,
+            [(_post(s), i) for i, s in enumerate(submissions)],
+            None, replace=True)
+
+        return
+
+    incremental = (state is not None and state.cursor is not None and
+                   graph_store.clock() - state.synced < graph_resync)
+    params = {'before': state.cursor} if incremental else {}
+
+    logger.debug('PRAW comment request made for user %s after %s', user,
+                 params.get('before'))
+    comments = _request(session, scheduler.LISTING, lambda: list(
+        redditor.comments.new(limit=listing_limit, params=params)),
+        charge=False)
+
+    # A full page after the cursor holds the comments closest to it, not
+    # the newest, so the listing is fetched again from the top. The second
+    # request is charged on its own, and the stored listing is kept as it is
+    # if the budget can't cover it.
+    if incremental and len(comments) >= listing_limit:
+        try:
+            _charge(scheduler.LISTING)
+        except BudgetExceeded:
+            logger.debug('Keeping stale comments of user %s', user)
+            return
+
+        logger.debug('PRAW comment request made for user %s', user)
+        incremental = False
+        params = {}
+        comments = _request(session, scheduler.LISTING, lambda: list(
+            redditor.comments.new(limit=listing_limit)), charge=False)
+
+    cursor = comments[0].fullname if comments else params.get('before')
+
+    graph_store.add_posts(
+        user, listing,
+        [(_post(c, c.parent_id), -c.created_utc) for c in comments],
+        cursor, replace=not incremental, keep=listing_limit)
+
+
+def _get_interactions(session, user, posts, fetch):
+    """Return a list of the users connected to a user by their stored posts,
+    fetching only connections missing from the graph store or stored more
+    than graph_ttl seconds ago. Stale connections are kept for posts whose
+    fetch fails.
+
+    Keyword arguments:
+    session -- instance of the Reddit api
+    user    -- username the posts belong to
+    posts   -- list of graph.Post
+    fetch   -- callable returning a dictionary of the list of usernames
+               connected by each of a list of posts, by post fullname
+    """
+    edges = graph_store.get_edges(user, [p.fullname for p in posts],
+                                  max_age=graph_ttl)
+
+    missing = [p for p in posts if p.fullname not in edges]
+    found = fetch(session, missing) if missing else {}
+
+    graph_store.add_edges(user, found)
+    edges.update(found)
+
+    # Fall back to stale connections of posts that couldn't be fetched
+    failed = [p.fullname for p in missing if p.fullname not in found]
+    if failed:
+        edges.update(graph_store.get_edges(user, failed))
+
+    return _connections(posts, edges)
+
+
+def _connections(posts, edges):
+    """Return a list of the usernames connected by a list of posts in order,
+    skipping posts without edges
+
+    Keyword arguments:
+    posts -- list of graph.Post
+    edges -- dictionary of lists of usernames by post fullname
+    """
+    return [other for p in posts for other in edges.get(p.fullname, [])]
+
+
+def _fetch_parent_authors(session, comments):
+    """Return a dictionary of the author of the post each comment replies
+    to, by comment fullname
+
+    Parents are looked up SUB_BATCH_SIZE at a time with info requests. A
+    deleted or missing parent gives an empty list, and comments whose
+    lookup failed are left out so the graph store fetches them again.
+
+    Keyword arguments:
+    session  -- instance of the Reddit api
+    comments -- list of graph.Post of the comments
+    """
+    replies = collections.OrderedDict()
+    for comment in comments:
+        replies.setdefault(comment.parent_id, []).append(comment.fullname)
+
+    parent_ids = list(replies)
+    found = {}
+
+    for i in range(0, len(parent_ids), SUB_BATCH_SIZE):
+        chunk = parent_ids[i:i + SUB_BATCH_SIZE]
+
+        try:
+            parents = _request(session, scheduler.LISTING,
+                               lambda: list(session.info(chunk)))
+        except BudgetExceeded:
+            raise
+        except Exception:
+            logger.debug('Skipping parent authors of %s comments',
+                         len(chunk))
+            continue
+
+        authors = {p.fullname: p.author.name for p in parents if p.author}
+
+        for parent_id in chunk:
+            author = authors.get(parent_id)
+
+            for fullname in replies[parent_id]:
+                found[fullname] = [author] if author else []
+
+    return found
+
+
+def _fetch_commenters(session, submissions):
+    """Return a dictionary of the authors of the first submission_comments
+    comments on each submission, by submission fullname
+
+    Keyword arguments:
+    session     -- instance of the Reddit api
+    submissions -- list of graph.Post of the submissions
     """
-    def process_posts(posts):
-        subs = []
+    found = {}
+
+    for submission in submissions:
         try:
-            for p in posts:
-                sub = p.subreddit_name_prefixed
+            comments = _request(session, scheduler.LISTING, lambda: list(
+                itertools.islice(
+                    session.submission(id=submission.fullname[3:]).comments,
+                    submission_comments)))
 
-                if sub not in subs:
-                    subs.append(sub)
+            # Skip MoreComments placeholders and deleted authors
+            found[submission.fullname] = [
+                c.author.name for c in comments
+                if isinstance(c, praw.models.Comment) and c.author]
+        except BudgetExceeded:
+            # Left out of the graph store rather than stored empty
+            raise
         except Exception:
-            # Skip post if missing metadata
-            logger.error('Error processing content request results for user '
-                         '{}'.format(user))
-            pass
+            # Submission is deleted
+            logger.debug('Skipping comments of submission %s',
+                         submission.fullname)
+            found[submission.fullname] = []
+
+    return found
 
-        return subs
 
+@metrics.traced('active_subs')
+@_cached_activity('active_subs')
+def _get_active_subs(session, user):
+    """Return a list of subs a user is active in
+
+    Keyword arguments:
+    session -- instance of the Reddit api
+    user    -- username to retrieve active subs for
+    """
     # Retrieve user comments and submissions
     comments = _get_user_comments(session, user)
     submissions = _get_user_submissions(session, user)
 
-    # Process active subs
-    subs = []
-
-    if comments is not None:
-        logger.debug('Processing PRAW comment request results for user '
-                     '{}'.format(user))
+    # Process active subs of both listings in one pass, in the order they
+    # are first found
+    subs = collections.OrderedDict()
 
-        subs = process_posts(comments)
-
-    if submissions is not None:
-        logger.debug('Processing PRAW submission requst results for user '
-                     '{}'.format(user))
+    try:
+        for posts in (comments, submissions):
+            if posts is not None:
+                for p in posts:
+                    subs.setdefault(p.subreddit_name_prefixed)
+    except Exception:
+        # Skip posts if missing metadata
+        logger.error('Error processing content request results for user '
+                     '%s', user)
 
-        subs = subs + process_posts(submissions)
+    subs = list(subs)
 
-    logger.debug('{} active subs found for user {}'.format(len(subs), user))
+    logger.debug('%s active subs found for user %s', len(subs), user)
 
     if subs:
-        logger.debug('Active subs found for user {} as {}'.format(user, subs))
+        logger.debug('Active subs found for user %s as %s', user,
+                     util.sample(subs))
 
     return subs
 
 
+def _sub_info(fields):
+    """Return a SubInfo built from subreddit fields
+
+    Keyword arguments:
+    fields -- dictionary of subreddit field to value
+    """
+    # Convert seconds after UTC epoch to years since sub creation
+    sub_age = util.utc_epoch_sec_to_years(fields['created'])
+
+    return SubInfo(name=fields['display_name_prefixed'],
+                   title=fields['title'],
+                   age=sub_age,
+                   subscribers=fields['subscribers'],
+                   over18=fields['over18'],
+                   desc=fields['public_description'])
+
+
+def _fetch_sub_fields(session, sub):
+    """Return a dictionary of subreddit fields fetched from Reddit, caching
+    them if the sub cache is enabled
+
+    Keyword arguments:
+    session -- instance of the Reddit api
+    sub     -- subreddit to get fields for
+    """
+    def fetch():
+        subreddit = session.subreddit(sub)
+        return {f: getattr(subreddit, f) for f in cache.SUB_FIELDS}
+
+    # Get subreddit metadata
+    fields = _request(session, scheduler.METADATA, fetch)
+
+    if sub_cache is not None:
+        sub_cache.set(sub, fields)
+
+    return fields
+
+
+def _get_cached_fields(sub):
+    """Return cached subreddit fields, or None if the sub cache is disabled
+    or has no fresh entry
+
+    Keyword arguments:
+    sub -- subreddit to get fields for
+    """
+    if sub_cache is None:
+        return None
+
+    fields = sub_cache.get(sub)
+
+    if fields is not None:
+        metrics.count('cache_hits', cache='sub')
+    else:
+        metrics.count('cache_misses', cache='sub')
+
+    return fields
+
+
+@metrics.traced('sub_info')
 def get_sub_info(session, sub):
-    """Return a dictionary containing metadata for a subreddit
+    """Return a SubInfo of metadata for a subreddit, or None if it can't be
+    retrieved
 
     Keyword arguments:
     session -- instance of the Reddit api
     sub     -- subreddit to get metadata for
     """
     try:
-        # Get subreddit metadata
-        subreddit = session.subreddit(sub)
+        fields = _get_cached_fields(sub)
 
-        # Convert seconds after UTC epoch to years since sub creation
-        sub_age = util.utc_epoch_sec_to_years(subreddit.created)
+        if fields is None:
+            fields = flights.do(('sub', sub.lower()), _fetch_sub_fields,
+                                session, sub)
 
-        return {'name': subreddit.display_name_prefixed,
-                'title': subreddit.title,
-                'age': sub_age,
-                'subscribers': subreddit.subscribers,
-                'over18': subreddit.over18,
-                'desc': subreddit.public_description}
+        return _sub_info(fields)
     except Exception:
-        logger.debug('Unable to retrieve sub info for {}'.format(sub))
+        logger.debug('Unable to retrieve sub info for %s', sub)
+
+
+def get_sub_infos(session, subs):
+    """Return an ordered dictionary of subreddit to SubInfo, looking up subs
+    missing from the cache in batches. Subs that can't be
+    found in a batch are looked up one at a time, and map to None if they
+    still can't be retrieved.
+
+    Keyword arguments:
+    session -- instance of the Reddit api
+    subs    -- list of subreddits to get metadata for
+    """
+    return collections.OrderedDict(iter_sub_infos(session, subs))
+
+
+def iter_sub_infos(session, subs):
+    """Yield (subreddit, SubInfo) pairs in the order of subs, each as soon
+    as it and every sub before it are available. Subs missing from the
+    cache are looked up in concurrent batches, and subs a batch can't find
+    are looked up one at a time, giving None if they still can't be
+    retrieved.
+
+    Keyword arguments:
+    session -- instance of the Reddit api
+    subs    -- list of subreddits to get metadata for
+    """
+    if prefetcher is not None:
+        prefetcher.record_subs(subs)
+
+    fields = collections.OrderedDict((sub, None) for sub in subs)
+
+    for sub in subs:
+        fields[sub] = _get_cached_fields(sub)
+
+    missing = [sub for sub, f in fields.items() if f is None]
+    chunks = [missing[i:i + SUB_BATCH_SIZE]
+              for i in range(0, len(missing), SUB_BATCH_SIZE)]
+
+    # Look up missing subs in batches, reading each as its subs come up
+    batches = executor.map('sub_info',
+                           functools.partial(_fetch_sub_batch, session),
+                           chunks)
+    batch_of = {sub: i for i, chunk in enumerate(chunks) for sub in chunk}
+
+    infos = {}
+    for sub, f in fields.items():
+        if sub not in infos:
+            if f is not None:
+                infos[sub] = _build_sub_info(sub, f)
+            else:
+                infos.update(_read_sub_batch(session,
+                                             *batches[batch_of[sub]]))
+
+        yield sub, infos[sub]
+
+
+def _read_sub_batch(session, chunk, future):
+    """Return a dictionary of subreddit to SubInfo for a batch lookup,
+    looking up subs the batch didn't find one at a time
+
+    Keyword arguments:
+    session -- instance of the Reddit api
+    chunk   -- list of subreddits of the batch
+    future  -- future of the batch lookup
+    """
+    try:
+        found = future.result()
+    except Exception as e:
+        logger.error('Unable to retrieve sub info for %s',
+                     util.sample(chunk))
+        logger.exception(e)
+        found = {}
+
+    infos = {}
+
+    # Fall back to single lookups for subs missing from the batch
+    missing = [sub for sub in chunk if sub.lower() not in found]
+    for sub, single in executor.map('sub_info',
+                                    functools.partial(get_sub_info, session),
+                                    missing):
+        infos[sub] = single.result()
+
+    for sub in chunk:
+        if sub.lower() in found:
+            infos[sub] = _build_sub_info(sub, found[sub.lower()])
+
+    return infos
+
+
+def _build_sub_info(sub, fields):
+    """Return the SubInfo of a sub's fields, or None if they are invalid"""
+    try:
+        return _sub_info(fields)
+    except Exception:
+        logger.debug('Unable to build sub info for %s', sub)
+        return None
+
+
+@metrics.traced('sub_info_batch')
+def _fetch_sub_batch(session, subs):
+    """Return a dictionary of lower case subreddit name to subreddit fields
+    for up to SUB_BATCH_SIZE subs fetched in a single request, caching them
+    if the sub cache is enabled
+
+    Keyword arguments:
+    session -- instance of the Reddit api
+    subs    -- list of subreddits to get fields for
+    """
+    def fetch():
+        listing = session.get('/api/info', params={'sr_name': ','.join(subs)})
+        return [{f: getattr(subreddit, f) for f in cache.SUB_FIELDS}
+                for subreddit in listing]
+
+    logger.debug('PRAW batch sub info request made for %s subs %s',
+                 len(subs), util.sample(subs))
+
+    found = {}
+    for fields in _request(session, scheduler.METADATA, fetch):
+        name = fields['display_name_prefixed'][2:]
+        found[name.lower()] = fields
+
+        if sub_cache is not None:
+            sub_cache.set(name, fields)
+
+    return found
+
+
+def prefetch_subs(session, subs):
+    """Refresh the cached metadata of subreddits in the background lane
+
+    Keyword arguments:
+    session -- instance of the Reddit api
+    subs    -- list of subreddits to refresh
+    """
+    with _background():
+        for i in range(0, len(subs), SUB_BATCH_SIZE):
+            try:
+                _fetch_sub_batch(session, subs[i:i + SUB_BATCH_SIZE])
+            except Exception:
+                logger.exception('Unable to prefetch sub info for %s',
+                                 util.sample(subs[i:i + SUB_BATCH_SIZE]))
+
+
+def prefetch_user(session, user):
+    """Refresh the cached activity a recommendation for a user starts from
+    in the background lane
+
+    Keyword arguments:
+    session -- instance of the Reddit api
+    user    -- username to refresh
+    """
+    with _background(), _listing_memo():
+        for lookup in (_get_parent_authors, _get_submission_commenters,
+                       _get_active_subs):
+            try:
+                lookup.refresh(session, user)
+            except Exception:
+                logger.exception('Unable to prefetch activity of user %s',
+                                 user)
@@ -0,0 +1,343 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import concurrent.futures
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Priority lanes, lower lanes are dispatched first
+LISTING = 0
+METADATA = 1
+BACKGROUND = 2
+
+LANES = (LISTING, METADATA, BACKGROUND)
+
+
+class RateLimited(Exception):
+    """Request shed because it would exceed the API budget"""
+
+
+class TokenBucket(object):
+    """Token bucket tracking the Reddit API request budget"""
+
+    def __init__(self, rate=1.0, capacity=60, clock=time.time):
+        """Keyword arguments:
+        rate     -- tokens added per second
+        capacity -- max tokens held, the largest burst allowed
+        clock    -- callable returning the current time in seconds
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+
+        self._default_rate = rate
+        self._clock = clock
+        self._updated = clock()
+
+        # When the window reported by Reddit resets
+        self._reset = None
+
+    def _refill(self):
+        now = self._clock()
+
+        if self._reset is not None and now >= self._reset:
+            # The reported budget only holds until the window resets, which
+            # gives back the full budget
+            self.tokens = self.capacity
+            self.rate = self._default_rate
+            self._updated = self._reset
+            self._reset = None
+
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def take(self):
+        """Return whether a token was available and take it"""
+        self._refill()
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+
+        return False
+
+    def give(self):
+        """Return a token taken for a call that didn't run"""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+    def wait_time(self, tokens=1):
+        """Return seconds until a number of tokens are available"""
+        self._refill()
+
+        missing = tokens - self.tokens
+        if missing <= 0:
+            return 0.0
+
+        return missing / self.rate if self.rate > 0 else float('inf')
+
+    def update(self, remaining, seconds_to_reset):
+        """Resize the bucket from Reddit's x-ratelimit response headers so
+        the remaining budget is spread over the rest of the window
+
+        Keyword arguments:
+        remaining        -- requests left in the current window
+        seconds_to_reset -- seconds until the window resets
+        """
+        self._refill()
+
+        self.tokens = min(self.tokens, remaining)
+        if seconds_to_reset > 0:
+            # With no requests left, the next token arrives as the window
+            # resets
+            self.rate = max(remaining, 1) / seconds_to_reset
+            self._reset = self._clock() + seconds_to_reset
+
+
+class Scheduler(object):
+    """Grant Reddit API calls tokens from a token bucket budget, highest
+    priority lane first. A dispatcher thread hands out tokens as the bucket
+    refills, and each call then runs on the thread that made it. Calls that
+    would wait longer than max_wait, or that arrive while their lane's queue
+    is full, are shed with RateLimited."""
+
+    def __init__(self, bucket, max_wait=30.0, max_queue=100,
+                 clock=time.time, dispatcher=True):
+        """Keyword arguments:
+        bucket     -- TokenBucket holding the API budget
+        max_wait   -- max seconds a call may wait for budget
+        max_queue  -- max calls waiting in each lane
+        clock      -- callable returning the current time in seconds
+        dispatcher -- whether a dispatcher thread grants queued calls,
+                      otherwise dispatch must be called
+        """
+        self.bucket = bucket
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self.dispatched = dict.fromkeys(LANES, 0)
+        self.shed = dict.fromkeys(LANES, 0)
+
+        self._clock = clock
+        self._queue = []
+        self._queued = dict.fromkeys(LANES, 0)
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._dispatcher = dispatcher
+        self._thread = None
+        self._stopped = False
+
+    def acquire(self, lane):
+        """Queue a call for a token and return a future resolved once it is
+        granted, raising RateLimited right away if the call would wait
+        longer than max_wait
+
+        Keyword arguments:
+        lane -- priority lane of the call
+        """
+        future = concurrent.futures.Future()
+
+        with self._lock:
+            ahead = sum(n for queued_lane, n in self._queued.items()
+                        if queued_lane <= lane)
+
+            if (self._queued[lane] >= self.max_queue or
+                    self.bucket.wait_time(ahead + 1) > self.max_wait):
+                self.shed[lane] += 1
+                raise RateLimited('API budget exhausted for lane '
+                                  '{}'.format(lane))
+
+            if not ahead and self.bucket.take():
+                future.set_running_or_notify_cancel()
+                future.set_result(None)
+                self.dispatched[lane] += 1
+
+                return future
+
+            heapq.heappush(self._queue, (lane, next(self._seq), future))
+            self._queued[lane] += 1
+
+            self._start()
+            self._wakeup.notify()
+
+        return future
+
+    def dispatch(self):
+        """Grant tokens to queued calls in priority order while budget is
+        available and return the number of calls granted"""
+        count = 0
+
+        with self._lock:
+            while self._queue:
+                lane, seq, future = self._queue[0]
+
+                # Calls that gave up waiting don't use a token
+                if not future.done() and not self.bucket.take():
+                    break
+
+                heapq.heappop(self._queue)
+                self._queued[lane] -= 1
+
+                if future.done():
+                    continue
+
+                if not future.set_running_or_notify_cancel():
+                    self.bucket.give()
+                    continue
+
+                future.set_result(None)
+                self.dispatched[lane] += 1
+                count += 1
+
+        return count
+
+    def run(self, lane, func, *args):
+        """Return the result of a call, made on this thread once the budget
+        allows it to run
+
+        Keyword arguments:
+        lane -- priority lane of the call
+        func -- callable making the API request
+        """
+        granted = self.acquire(lane)
+
+        try:
+            granted.result(timeout=self.max_wait)
+        except concurrent.futures.TimeoutError:
+            if granted.cancel():
+                with self._lock:
+                    self.shed[lane] += 1
+                raise RateLimited('Timed out waiting for API budget in lane '
+                                  '{}'.format(lane))
+
+            # Granted as the wait ran out
+            granted.result()
+
+        return func(*args)
+
+    def _start(self):
+        if self._dispatcher and self._thread is None and not self._stopped:
+            self._thread = threading.Thread(target=self._dispatch_loop,
+                                            name='api-scheduler')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _dispatch_loop(self):
+        while True:
+            self.dispatch()
+
+            with self._lock:
+                if self._stopped:
+                    return
+
+                # Sleep until the next token, or a call or update arrives
+                timeout = None
+                if self._queue:
+                    timeout = min(max(self.bucket.wait_time(), 0.001), 1.0)
+
+                self._wakeup.wait(timeout)
+
+    def stop(self):
+        """Stop the dispatcher thread, shedding queued calls"""
+        with self._lock:
+            self._stopped = True
+            thread = self._thread
+
+            for lane, seq, future in self._queue:
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(RateLimited('Scheduler stopped'))
+
+            self._queue = []
+            self._queued = dict.fromkeys(LANES, 0)
+            self._wakeup.notify()
+
+        if thread is not None:
+            thread.join()
+
+    def try_acquire(self, lane):
+        """Take a token for a call made outside the queue, such as from an
+        event loop that can't block, and return 0. If no token can be taken
+        return the seconds to wait before trying again.
+
+        Keyword arguments:
+        lane -- priority lane of the call
+        """
+        with self._lock:
+            # Leave tokens to calls already queued in higher priority lanes
+            ahead = sum(n for queued_lane, n in self._queued.items()
+                        if queued_lane <= lane)
+            wait = self.bucket.wait_time(ahead + 1)
+
+            if wait > self.max_wait:
+                self.shed[lane] += 1
+                raise RateLimited('API budget exhausted for lane '
+                                  '{}'.format(lane))
+
+            if wait == 0 and self.bucket.take():
+                self.dispatched[lane] += 1
+                return 0
+
+            return max(wait, 0.01)
+
+    def update(self, remaining, seconds_to_reset):
+        """Update the budget from Reddit's x-ratelimit response headers,
+        shedding queued calls that would now wait longer than max_wait"""
+        with self._lock:
+            self.bucket.update(remaining, seconds_to_reset)
+
+            queue = sorted(self._queue)
+            for position, (lane, seq, future) in enumerate(queue):
+                if self.bucket.wait_time(position + 1) <= self.max_wait:
+                    continue
+
+                self._queue.remove((lane, seq, future))
+                self._queued[lane] -= 1
+
+                if future.set_running_or_notify_cancel():
+                    self.shed[lane] += 1
+                    future.set_exception(RateLimited(
+                        'API budget exhausted for lane {}'.format(lane)))
+
+            heapq.heapify(self._queue)
+            self._wakeup.notify()
+
+    def wait_time(self):
+        """Return seconds until the budget allows another call"""
+        with self._lock:
+            return self.bucket.wait_time()
+
+    def idle(self, reserve=1):
+        """Return whether no calls are waiting and at least reserve tokens
+        are available, leaving room for background calls
+
+        Keyword arguments:
+        reserve -- tokens that must be left for incoming requests
+        """
+        with self._lock:
+            return (not self._queue and
+                    self.bucket.wait_time(reserve + 1) == 0)
+
+    def stats(self):
+        """Return a dictionary of per-lane counters"""
+        with self._lock:
+            return {'tokens': self.bucket.tokens,
+                    'rate': self.bucket.rate,
+                    'queued': dict(self._queued),
+                    'dispatched': dict(self.dispatched),
+                    'shed': dict(self.shed)}
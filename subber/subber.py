@@ -13,60 +13,136 @@
 
 import json
 import logging
+import time
 
 import flask
 
-from subber import config, reddit
+from subber import (aioreddit, batch, cache, config, cooccurrence, fanout,
+                    graph, jobs, logs, metrics, prefetch, reddit, scheduler,
+                    transport)
 
 app = flask.Flask(__name__)
 logger = logging.getLogger(__name__)
 
 
+@app.before_request
+def start_trace():
+    """Trace the pipeline stages run while handling a request"""
+    flask.g.trace = metrics.Trace()
+    flask.g.start = time.time()
+    metrics.set_trace(flask.g.trace)
+
+
+@app.after_request
+def finish_trace(response):
+    """Record request timing, adding a Server-Timing header if enabled"""
+    metrics.set_trace(None)
+
+    trace = flask.g.get('trace')
+    if trace is None:
+        return response
+
+    metrics.registry.observe('subber_request_duration_seconds',
+                             time.time() - flask.g.start,
+                             endpoint=flask.request.endpoint)
+
+    if timing_header and trace.durations:
+        response.headers['Server-Timing'] = trace.server_timing()
+
+    return response
+
+
+@app.route('/metrics')
+def get_metrics():
+    """Get process metrics in the Prometheus text format"""
+    return app.response_class(metrics.registry.render(),
+                              mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/')
 def get_form():
     return flask.render_template('form.html')
 
 
-@app.route('/user', methods=['POST'])
+@app.route('/user', methods=['GET', 'POST'])
 def get_sub_recommendations():
     """Get user recommendations
 
+    Results pages are served from the response cache when enabled, and
+    refreshed in the background once stale. GET requests for a cached page
+    are answered with 304 Not Modified when the client has it already.
+
     Keyword arguments:
     user -- string containing reddit username
+    mode -- 'async' to start a background job and return its id, also used
+            when the client prefers a JSON response. 'stream' to send each
+            recommendation as soon as it is found, the default when the
+            stream_results option is set. 'fast' to score subs from the
+            precomputed co-occurrence index, not available with the async
+            backend.
     """
-    user = flask.request.form['username']
+    user = flask.request.values['username']
 
     logger.info('Received recommendation request '
-                'for user {0}'.format(user))
+                'for user %s', user)
+
+    if (flask.request.values.get('mode') == 'async' or
+            flask.request.accept_mimetypes.best == 'application/json'):
+        return start_job(user)
+
+    mode = flask.request.values.get('mode', default_mode)
+    cached = response_cache is not None and mode != 'fast'
+
+    # The co-occurrence index is only read through the sync client
+    if mode == 'fast' and backend == 'async':
+        return app.response_class(json.dumps({'status': 'failure',
+                                              'mode': mode}),
+                                  status=400,
+                                  mimetype='application/json')
+
+    if cached:
+        entry = response_cache.get(user)
+
+        if entry is not None:
+            logger.info('Returning cached response for user %s', user)
+
+            if entry['refresh']:
+                refresh_page(user)
+
+            return cached_response(entry)
 
     # Make sure user exists
-    try:
-        logger.info('User {} tested for existence'.format(user))
-        redditor = session.redditor(user)
-        hasattr(redditor, 'created')
-    except reddit.prawcore.exceptions.NotFound:
-        logger.error('Unable to fetch recommendations for {} - '
-                     'user does not exist'.format(user))
+    if not user_exists(user):
         response = flask.render_template('invalid-user.html', user=user)
         return response
 
+    if mode == 'stream':
+        return stream_recommendations(user)
+
     # Get recommendations
     try:
-        recommendations = reddit.get_user_recommendations(session, user)
+        if mode == 'fast':
+            recommendations = reddit.get_fast_recommendations(session, user)
+        else:
+            recommendations = get_recommendations(user)
 
     except Exception as e:
         logger.exception(e)
 
     try:
-        response = flask.render_template('results.html', user=user,
-                                         recommendations=recommendations)
+        with metrics.span('render'):
+            response = flask.render_template('results.html', user=user,
+                                             recommendations=recommendations)
+
+        logger.info('Returning success response for user %s with %s '
+                    'recommendations', user, len(recommendations))
 
-        logger.info('Returning success response for user {} with '
-                    'recommendations {}'.format(user, recommendations))
+        if cached and recommendations:
+            response = cached_response(response_cache.set(user, response))
 
     except Exception:
         logger.exception('Exception while getting user recommendations '
-                         'for user {}'.format(user))
+                         'for user %s', user)
 
         response = app.response_class(json.dumps({'status': 'failure',
                                                   'user': user}),
@@ -76,11 +152,246 @@ def get_sub_recommendations():
     return response
 
 
-def init_logging():
+@app.route('/batch', methods=['POST'])
+def get_batch_recommendations():
+    """Get recommendations for many users, streamed as JSON Lines in the
+    order the users were given
+
+    The request body is either a JSON list of usernames, a JSON object
+    listing them under "users", or plain text with a username per line.
+    """
+    if flask.request.mimetype == 'application/json':
+        users = flask.request.get_json(silent=True)
+        if isinstance(users, dict):
+            users = users.get('users')
+    else:
+        users = batch.read_users(
+            flask.request.get_data(as_text=True).splitlines())
+
+    if (not isinstance(users, list) or
+            not all(isinstance(user, str) for user in users) or
+            len(users) > batch_max_users):
+        return app.response_class(json.dumps({'status': 'failure',
+                                              'max_users': batch_max_users}),
+                                  status=400,
+                                  mimetype='application/json')
+
+    logger.info('Received batch recommendation request for %s users',
+                len(users))
+
+    results = batch.iter_results(users, get_recommendations,
+                                 exists=user_exists, workers=batch_workers)
+
+    return app.response_class(
+        flask.stream_with_context(json.dumps(result) + '\n'
+                                  for result in results),
+        mimetype='application/x-ndjson')
+
+
+def stream_recommendations(user):
+    """Return a response rendering the results page incrementally, flushing
+    the page header at once and each sub card as it is found
+
+    Keyword arguments:
+    user -- string containing reddit username
+    """
+    logger.info('Streaming recommendations for user %s', user)
+
+    def recommendations():
+        # The async backend finds every recommendation before sending any
+        if backend == 'async':
+            subs = get_recommendations(user)
+        else:
+            subs = reddit.iter_user_recommendations(session, user)
+
+        found = []
+        for sub_info in subs:
+            found.append(sub_info)
+            yield sub_info
+
+        # Cache the whole page for the next request
+        if response_cache is not None and found:
+            response_cache.set(user, flask.render_template(
+                'results.html', user=user, recommendations=found))
+
+    return app.response_class(flask.stream_with_context(
+        stream_template('results.html', user=user,
+                        recommendations=recommendations())))
+
+
+def get_recommendations(user, on_result=None):
+    """Return a list of recommended subs for a user from the configured
+    backend
+
+    Keyword arguments:
+    user      -- string containing reddit username
+    on_result -- optional callable passed each recommendation as it is
+                 found, or all at once by the async backend
+    """
+    if backend == 'async':
+        recommendations = aioreddit.loop_thread.run(
+            aioreddit.get_user_recommendations(async_client, user))
+
+        if on_result is not None:
+            for sub_info in recommendations:
+                on_result(sub_info)
+
+        return recommendations
+
+    if on_result is None:
+        return reddit.get_user_recommendations(session, user)
+
+    return reddit.get_user_recommendations(session, user,
+                                           on_result=on_result)
+
+
+def cached_response(entry):
+    """Return a response serving a cached results page, or 304 Not Modified
+    if the client's copy is current
+
+    Keyword arguments:
+    entry -- dictionary returned by the response cache
+    """
+    response = app.response_class(entry['body'], mimetype='text/html')
+    response.set_etag(entry['etag'])
+    response.last_modified = entry['modified']
+
+    return response.make_conditional(flask.request)
+
+
+def refresh_page(user):
+    """Render a user's cached results page again in the background, unless
+    a job for the user is already in flight
+
+    Keyword arguments:
+    user -- string containing reddit username
+    """
+    # The page is written back to the cache it was read from, even if
+    # create_app replaced it meanwhile
+    cache = response_cache
+
+    def run(user, on_result):
+        try:
+            recommendations = get_recommendations(user)
+        except Exception:
+            cache.refresh_failed(user)
+            raise
+
+        for sub_info in recommendations:
+            on_result(sub_info._asdict())
+
+        # Failed crawls leave the stale page in place until it expires,
+        # refreshing it again only after response_retry seconds
+        if not recommendations:
+            cache.refresh_failed(user)
+            return
+
+        with app.test_request_context():
+            cache.set(user, flask.render_template(
+                'results.html', user=user,
+                recommendations=recommendations))
+
+    logger.info('Refreshing cached response for user %s', user)
+
+    job_manager.submit(user, run)
+
+
+def stream_template(template_name, **context):
+    """Return a generator rendering a template in chunks as its context
+    iterables are consumed
+
+    Keyword arguments:
+    template_name -- name of the template to render
+    context       -- variables available in the template
+    """
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+
+    return template.stream(context)
+
+
+def start_job(user):
+    """Start or attach to a background recommendation job for a user and
+    return its status
+
+    Keyword arguments:
+    user -- string containing reddit username
+    """
+    def run(user, on_result):
+        if not user_exists(user):
+            raise LookupError('User {} does not exist'.format(user))
+
+        # Job results are served as JSON
+        get_recommendations(
+            user, on_result=lambda sub_info: on_result(sub_info._asdict()))
+
+    job = job_manager.submit(user, run)
+
+    response = app.response_class(json.dumps(job.to_dict()),
+                                  status=202,
+                                  mimetype='application/json')
+    response.headers['Location'] = flask.url_for('get_job', job_id=job.id)
+
+    return response
+
+
+@app.route('/jobs/<job_id>')
+def get_job(job_id):
+    """Get the status and results found so far for a recommendation job
+
+    Keyword arguments:
+    job_id -- id returned when the job was started
+    """
+    job = job_manager.get(job_id)
+
+    if job is None:
+        return app.response_class(json.dumps({'status': 'failure',
+                                              'job': job_id}),
+                                  status=404,
+                                  mimetype='application/json')
+
+    return app.response_class(json.dumps(job.to_dict()),
+                              mimetype='application/json')
+
+
+def user_exists(user):
+    """Return whether a reddit user exists
+
+    Keyword arguments:
+    user -- string containing reddit username
+    """
+    try:
+        logger.info('User %s tested for existence', user)
+        redditor = session.redditor(user)
+        hasattr(redditor, 'created')
+    except reddit.prawcore.exceptions.NotFound:
+        logger.error('Unable to fetch recommendations for %s - '
+                     'user does not exist', user)
+        return False
+
+    return True
+
+
+def init_logging(options):
+    """Send log records through a background writer at the configured level
+
+    Keyword arguments:
+    options -- dictionary of Subber options
+    """
     try:
-        logging.basicConfig(filename='subber.log', level=logging.DEBUG,
-                            format='%(asctime)-26s %(name)-17s '
-                                   '%(levelname)-8s %(message)s', filemode='a')
+        level = logging.getLevelName(options['log_level'].upper())
+        if not isinstance(level, int):
+            raise ValueError('Unknown log level {}'.format(
+                options['log_level']))
+
+        pipeline = logs.Pipeline(options['log_file'],
+                                 max_bytes=options['log_max_bytes'],
+                                 backups=options['log_backups'],
+                                 max_queue=options['log_queue_size'])
+
+        root = logging.getLogger()
+        root.setLevel(level)
+        root.addHandler(pipeline.handler)
 
         # Suppress outside loggers
         logging.getLogger('prawcore').setLevel(logging.WARNING)
@@ -90,15 +401,306 @@ def init_logging():
     except Exception as e:
         exit('Unable to initiate logging because of: \n{}'.format(e))
 
+    return pipeline
+
+
+def init_session(cfg, http, options):
+    """Return a Reddit API session created on first use
+
+    Keyword arguments:
+    cfg     -- dictionary of Reddit API credentials
+    http    -- requests session sending API requests
+    options -- dictionary of Subber options
+    """
+    def create():
+        # Workers on the host share one access token through the cache
+        token_backend = None
+        if options['cache_path'] and options['share_token']:
+            token_backend = reddit.activity_backend
+
+        return reddit.Reddit(cfg['id'], cfg['secret'], cfg['password'],
+                             cfg['username'], http=http,
+                             timeout=(options['http_connect_timeout'],
+                                      options['http_read_timeout']),
+                             token_backend=token_backend,
+                             scheduled=options['rate_limit'] > 0)
+
+    return reddit.LazySession(create)
+
+
+def init_http(options):
+    """Return the requests session shared by Reddit API calls, pooling a
+    kept-alive connection for each thread that may call Reddit at once
+
+    Keyword arguments:
+    options -- dictionary of Subber options
+    """
+    pool_size = options['http_pool_size'] or (options['workers'] +
+                                              options['job_workers'])
+
+    return transport.build_session(pool_size=pool_size,
+                                   retries=options['http_retries'],
+                                   backoff=options['http_backoff'])
+
+
+def init_async_client(cfg, options):
+    """Return the client of the async backend, or None unless the async
+    backend is configured
+
+    Keyword arguments:
+    cfg     -- dictionary of Reddit API credentials
+    options -- dictionary of Subber options
+    """
+    if options['backend'] not in ('sync', 'async'):
+        logger.critical('Unknown backend %s', options['backend'])
+        raise RuntimeError('Subber config file not loaded.')
+
+    if options['backend'] != 'async':
+        return None
+
+    return aioreddit.Client(cfg['id'], cfg['secret'], cfg['password'],
+                            cfg['username'],
+                            pool_size=options['async_pool_size'])
+
+
+def close_pipeline():
+    """Stop the background threads and close the stores of the
+    recommendation pipeline configured by an earlier init_pipeline"""
+    reddit.executor.shutdown()
+
+    if reddit.api_scheduler is not None:
+        reddit.api_scheduler.stop()
+
+    if reddit.prefetcher is not None:
+        reddit.prefetcher.stop()
+
+    if reddit.graph_store is not None:
+        reddit.graph_store.close()
+
+    reddit.api_scheduler = None
+    reddit.prefetcher = None
+    reddit.graph_store = None
+    reddit.cooccurrence_index = None
+
+
+def init_pipeline(options):
+    """Configure the recommendation pipeline from the Subber options
+
+    Keyword arguments:
+    options -- dictionary of Subber options
+    """
+
+    reddit.executor = fanout.FanOut(
+        workers=options['workers'],
+        limits={'similar_users': options['similar_users_concurrency'],
+                'active_subs': options['active_subs_concurrency'],
+                'sub_info': options['sub_info_concurrency']})
+
+    # Share fetched Reddit data with other workers on the host when a cache
+    # path is configured
+    if options['cache_path']:
+        backend = cache.SQLiteBackend(options['cache_path'])
+    else:
+        backend = cache.MemoryBackend(
+            max_entries=options['activity_cache_size'])
+
+    reddit.sub_cache = cache.SubInfoCache(
+        ttls={'subscribers': options['subscribers_ttl'],
+              'profile': options['profile_ttl'],
+              'identity': options['identity_ttl']},
+        max_bytes=options['sub_cache_bytes'],
+        backend=backend if options['cache_path'] else None)
+
+    reddit.activity_backend = backend
+    reddit.activity_ttl = options['activity_ttl']
+
+    if options['rate_limit'] > 0:
+        reddit.api_scheduler = scheduler.Scheduler(
+            scheduler.TokenBucket(rate=options['rate_limit'],
+                                  capacity=options['rate_burst']),
+            max_wait=options['rate_max_wait'],
+            max_queue=options['rate_max_queue'])
+
+    reddit.parent_weight = options['parent_weight']
+    reddit.commenter_weight = options['commenter_weight']
+    reddit.max_recommendations = options['max_recommendations']
+
+    reddit.listing_limit = options['listing_limit']
+    reddit.submission_comments = options['submission_comments']
+    reddit.crawl_depth = options['crawl_depth']
+    reddit.crawl_decay = options['crawl_decay']
+    reddit.max_neighbors = options['max_neighbors']
+    reddit.crawl_seconds = options['crawl_seconds']
+    reddit.crawl_calls = options['crawl_calls']
+
+    if options['prefetch']:
+        reddit.prefetcher = init_prefetcher(options)
+
+    # Keep the activity graph between requests when a graph path is
+    # configured
+    if options['graph_path']:
+        reddit.graph_store = graph.GraphStore(options['graph_path'])
+        reddit.graph_ttl = options['graph_ttl']
+        reddit.graph_resync = options['graph_resync']
+
+    # Memory map the co-occurrence index built by the batch job, serving
+    # fast recommendations from live crawls if it can't be loaded
+    if options['index_path']:
+        try:
+            reddit.cooccurrence_index = cooccurrence.CooccurrenceIndex.load(
+                options['index_path'])
+        except Exception:
+            logger.exception('Unable to load co-occurrence index %s',
+                             options['index_path'])
+
+
+def init_prefetcher(options):
+    """Create the prefetcher keeping popular subs and returning users warm
+
+    Keyword arguments:
+    options -- dictionary of Subber options
+    """
+    def idle():
+        return (reddit.api_scheduler is None or
+                reddit.api_scheduler.idle(options['prefetch_reserve']))
+
+    return prefetch.Prefetcher(
+        refresh_subs=lambda subs: reddit.prefetch_subs(session, subs),
+        refresh_user=lambda user: reddit.prefetch_user(session, user),
+        expires_in=reddit.sub_cache.expires_in,
+        idle=idle,
+        user_ttl=options['activity_ttl'],
+        max_subs=options['prefetch_subs'],
+        max_users=options['prefetch_users'],
+        horizon=options['prefetch_horizon'],
+        interval=options['prefetch_interval'])
+
+
+def collect_metrics():
+    """Yield metric samples from the pipeline's shared components"""
+    if reddit.sub_cache is not None:
+        for name, value in reddit.sub_cache.stats().items():
+            yield 'subber_sub_cache_' + name, {}, value
+
+    for name, value in reddit.flights.stats().items():
+        yield 'subber_single_flight_' + name, {}, value
+
+    if reddit.prefetcher is not None:
+        for name, value in reddit.prefetcher.stats().items():
+            yield 'subber_prefetch_' + name, {}, value
+
+    if response_cache is not None:
+        for name, value in response_cache.stats().items():
+            yield 'subber_response_cache_' + name, {}, value
+
+    if http_session is not None:
+        for name, value in transport.stats(http_session).items():
+            yield 'subber_http_' + name, {}, value
+
+    if reddit.api_scheduler is not None:
+        stats = reddit.api_scheduler.stats()
+        yield 'subber_scheduler_tokens', {}, stats['tokens']
+        yield 'subber_scheduler_rate', {}, stats['rate']
+
+        for name in ('queued', 'dispatched', 'shed'):
+            for lane, value in stats[name].items():
+                yield 'subber_scheduler_' + name, {'lane': lane}, value
+
+
+def init_jobs(options):
+    """Create the background job manager
+
+    Keyword arguments:
+    options -- dictionary of Subber options
+    """
+
+    # Jobs are polled from any worker when they share a cache path
+    if not options['cache_path']:
+        logger.info('No cache_path configured, recommendation jobs can only '
+                    'be polled from the worker running them')
+
+    return jobs.JobManager(workers=options['job_workers'],
+                           ttl=options['job_ttl'],
+                           backend=(reddit.activity_backend
+                                    if options['cache_path'] else None))
+
+
+def init_response_cache(options):
+    """Create the cache of rendered results pages, or return None if it is
+    disabled
+
+    Keyword arguments:
+    options -- dictionary of Subber options
+    """
+    if options['response_fresh'] <= 0:
+        return None
+
+    # Share pages with other workers on the host when a cache path is
+    # configured
+    return cache.ResponseCache(
+        fresh=options['response_fresh'],
+        stale=options['response_stale'],
+        retry=options['response_retry'],
+        max_entries=options['response_cache_size'],
+        backend=reddit.activity_backend if options['cache_path'] else None)
+
+
+# Set up by create_app
+log_pipeline = None
+http_session = None
+session = None
+async_client = None
+backend = 'sync'
+job_manager = None
+response_cache = None
+default_mode = None
+timing_header = False
+batch_workers = 4
+batch_max_users = 1000
+
+
+def create_app(config_file='subber.cfg'):
+    """Configure Subber from a config file and return the Flask app
+
+    Nothing here contacts Reddit or starts a thread: the Reddit session is
+    created by the first request needing it and background workers start on
+    first use. Running gunicorn with --preload therefore reads the config
+    once in the master, and workers fork ready to serve.
+
+    Keyword arguments:
+    config_file -- path to the Subber config file
+    """
+    global log_pipeline, http_session, session, async_client, backend
+    global job_manager, response_cache, default_mode, timing_header
+    global batch_workers, batch_max_users
+
+    options = config.get_options(config_file)
+
+    # Replace the log pipeline of an earlier call
+    if log_pipeline is not None:
+        logging.getLogger().removeHandler(log_pipeline.handler)
+        log_pipeline.stop()
+
+    if http_session is not None:
+        http_session.close()
 
-def init_session():
-    """Init Reddit API session"""
-    cfg = config.get_config()
-    return reddit.Reddit(cfg['id'],
-                         cfg['secret'],
-                         cfg['password'],
-                         cfg['username']).get_session()
+    # Options left out of the new config must not keep the features of an
+    # earlier call enabled
+    close_pipeline()
 
+    log_pipeline = init_logging(options)
+    cfg = config.get_config(config_file)
+    http_session = init_http(options)
+    session = init_session(cfg, http_session, options)
+    backend = options['backend']
+    async_client = init_async_client(cfg, options)
+    init_pipeline(options)
+    job_manager = init_jobs(options)
+    response_cache = init_response_cache(options)
+    default_mode = 'stream' if options['stream_results'] else None
+    timing_header = options['timing_header']
+    batch_workers = options['batch_workers']
+    batch_max_users = options['batch_max_users']
+    metrics.registry.collect(collect_metrics)
 
-init_logging()
-session = init_session()
+    return app
@@ -0,0 +1,201 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""HTTP transport of the PRAW session
+
+Reddit requests from every worker thread share one requests session whose
+connection pool is sized to the worker concurrency, so sockets are kept
+alive between calls instead of being reopened with a new TLS handshake.
+"""
+
+import logging
+import random
+import time
+
+import prawcore
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from subber import metrics
+
+logger = logging.getLogger(__name__)
+
+# Reddit API and token hosts
+HOSTS = 2
+
+
+class JitterRetry(Retry):
+    """Retry policy sleeping a random fraction of the exponential backoff,
+    so workers retrying the same outage don't reconnect in lockstep"""
+
+    def get_backoff_time(self):
+        return random.uniform(0, super().get_backoff_time())
+
+    def increment(self, *args, **kwargs):
+        metrics.registry.inc('subber_http_retries_total')
+
+        return super().increment(*args, **kwargs)
+
+
+class PooledAdapter(HTTPAdapter):
+    """HTTP adapter reporting how often pooled connections are reused"""
+
+    def stats(self):
+        """Return a dictionary of requests sent and connections opened by
+        the adapter's live pools"""
+        connections = requests_sent = 0
+
+        for key in list(self.poolmanager.pools.keys()):
+            pool = self.poolmanager.pools.get(key)
+            if pool is not None:
+                connections += pool.num_connections
+                requests_sent += pool.num_requests
+
+        return {'connections': connections,
+                'requests': requests_sent}
+
+
+def build_session(pool_size=10, retries=2, backoff=0.5):
+    """Return a requests session keeping up to pool_size connections alive
+    per host and retrying failed connections with jittered exponential
+    backoff
+
+    Server errors and read timeouts are left to PRAW, which retries them
+    itself, so a request is only ever retried by one layer and each retry
+    that reaches Reddit goes through the API scheduler.
+
+    Keyword arguments:
+    pool_size -- connections kept open per host, at least the number of
+                 threads making requests at once
+    retries   -- retries of a failed connection
+    backoff   -- seconds before the second retry, doubling after each one
+    """
+    adapter = PooledAdapter(
+        pool_connections=HOSTS,
+        pool_maxsize=pool_size,
+        max_retries=JitterRetry(total=retries,
+                                connect=retries,
+                                read=0,
+                                status=0,
+                                backoff_factor=backoff,
+                                raise_on_status=False))
+
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    return session
+
+
+def stats(session):
+    """Return a dictionary of requests sent and connections opened by a
+    session built by build_session
+
+    Keyword arguments:
+    session -- requests session
+    """
+    return session.get_adapter('https://').stats()
+
+
+class Requestor(prawcore.Requestor):
+    """PRAW requestor applying a configured timeout to every request"""
+
+    def __init__(self, user_agent, oauth_url='https://oauth.reddit.com',
+                 reddit_url='https://www.reddit.com', session=None,
+                 timeout=prawcore.const.TIMEOUT):
+        """Keyword arguments:
+        user_agent -- user agent sent with requests
+        oauth_url  -- URL of the Reddit API
+        reddit_url -- URL access tokens are requested from
+        session    -- requests session sending the requests
+        timeout    -- seconds, or (connect, read) seconds, before a request
+                      is abandoned
+        """
+        super().__init__(user_agent, oauth_url=oauth_url,
+                         reddit_url=reddit_url, session=session)
+
+        self.timeout = timeout
+
+    def request(self, *args, **kwargs):
+        try:
+            return self._http.request(*args, timeout=self.timeout, **kwargs)
+        except Exception as exc:
+            raise prawcore.exceptions.RequestException(exc, args, kwargs)
+
+
+class ScheduledRateLimiter(prawcore.rate_limit.RateLimiter):
+    """PRAW rate limiter that tracks Reddit's x-ratelimit headers without
+    sleeping, for sessions whose requests a scheduler.Scheduler spaces out.
+    The scheduler sheds calls it can't fit in the budget rather than
+    stalling the thread that happens to dispatch them."""
+
+    def delay(self):
+        pass
+
+
+def share_token(authorizer, backend, key, clock=time.time):
+    """Make a prawcore authorizer reuse an access token another worker has
+    stored in a cache backend, storing the tokens it requests itself
+
+    A token Reddit has rejected is never reused: the authorizer requests a
+    new one and replaces the stored token.
+
+    Keyword arguments:
+    authorizer -- prawcore authorizer of the PRAW session
+    backend    -- cache.Backend shared by the workers
+    key        -- key of the token in the backend
+    clock      -- callable returning the current time in seconds
+    """
+    refresh = authorizer.refresh
+    used = []
+
+    def shared_refresh():
+        stored = backend.get(key)
+
+        # Leave a minute so the token doesn't expire during a request
+        if (stored is not None and stored['token'] not in used and
+                stored['expires'] > clock() + 60):
+            metrics.registry.inc('subber_oauth_tokens_total', source='shared')
+        else:
+            metrics.registry.inc('subber_oauth_tokens_total',
+                                 source='requested')
+            refresh()
+
+            stored = {'token': authorizer.access_token,
+                      'expires': authorizer._expiration_timestamp,
+                      'scopes': sorted(authorizer.scopes)}
+            backend.set(key, stored, max(stored['expires'] - clock(), 1))
+
+        authorizer.access_token = stored['token']
+        authorizer._expiration_timestamp = stored['expires']
+        authorizer.scopes = set(stored['scopes'])
+
+        # A refresh while this token is current means Reddit rejected it
+        del used[:]
+        used.append(stored['token'])
+
+    authorizer.refresh = shared_refresh
+
+
+metrics.registry.describe('subber_http_retries_total', 'counter',
+                          'Connections to Reddit retried after a '
+                          'connection error')
+metrics.registry.describe('subber_oauth_tokens_total', 'counter',
+                          'Access tokens requested from Reddit or reused '
+                          'from another worker')
+metrics.registry.describe('subber_http_connections', 'gauge',
+                          'Connections opened, each with a TLS handshake, '
+                          'by live connection pools')
+metrics.registry.describe('subber_http_requests', 'gauge',
+                          'Requests sent through live connection pools')
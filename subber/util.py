@@ -20,12 +20,12 @@ logger = logging.getLogger(__name__)
 def utc_epoch_sec_to_years(sec):
     """Converts seconds from UTC epoch to elapsed time from current time"""
 
-    logging.debug('Converting {} seconds from UTC epoch to years to '
-                  'date'.format(sec))
+    logger.debug('Converting %s seconds from UTC epoch to years to date',
+                 sec)
 
     try:
         # Elapsed seconds
-        elapsed_sec = datetime.now() - sec
+        elapsed_sec = datetime.datetime.now().timestamp() - sec
 
         # Elapsed days from time
         days = datetime.timedelta(seconds=elapsed_sec).days
@@ -35,5 +35,33 @@ def utc_epoch_sec_to_years(sec):
         return int(days/365)
 
     except Exception:
-        logging.error('Unable to calculate years to date from UTC epoch '
-                      'timestamp')
+        logger.error('Unable to calculate years to date from UTC epoch '
+                     'timestamp')
+
+
+class sample(object):
+    """Log argument showing at most limit items of a collection, formatted
+    only if the message is emitted
+
+    Keyword arguments:
+    items -- collection to log
+    limit -- number of items shown
+    """
+
+    def __init__(self, items, limit=10):
+        self.items = items
+        self.limit = limit
+        self.text = None
+
+    def __str__(self):
+        # Items may be a generator, so keep the text for later handlers
+        if self.text is None:
+            items = list(self.items)
+            shown = ', '.join(str(item) for item in items[:self.limit])
+
+            if len(items) > self.limit:
+                shown += ', ... ({} more)'.format(len(items) - self.limit)
+
+            self.text = '[{}]'.format(shown)
+
+        return self.text
@@ -0,0 +1,226 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import unittest
+from collections import OrderedDict
+from unittest.mock import patch
+
+from benchmarks import fakereddit
+from subber import aioreddit, fanout, reddit
+
+# Comments and top submissions of each user, as (subreddit, parent id)
+COMMENTS = {'user': [('r/a', 't1_p1'), ('r/b', 't3_p2')],
+            'alice': [('r/c', 't1_p3'), ('r/d', 't1_p3')],
+            'bob': [('r/c', 't1_p3')],
+            'carol': [('r/e', 't1_p3')]}
+SUBMISSIONS = {'user': [('r/a', 's1')]}
+
+# Authors of parent posts and commenters on submissions
+AUTHORS = {'t1_p1': 'alice', 't3_p2': 'bob', 't1_p3': '[deleted]'}
+COMMENTERS = {'s1': 'carol'}
+
+
+def _listing(children):
+    return {'data': {'children': children}}
+
+
+def _sub(name):
+    return {'display_name_prefixed': 'r/' + name,
+            'title': name,
+            'created': 0,
+            'subscribers': 1,
+            'over18': False,
+            'public_description': name}
+
+
+class FakeClient(object):
+    """Serves the canned Reddit above in API response format"""
+
+    def __init__(self):
+        self.requests = []
+
+    async def get(self, lane, path, **params):
+        self.requests.append((path, params))
+        parts = path.split('/')
+
+        if path.endswith('/comments') and parts[1] == 'user':
+            return _listing([{'data': {'subreddit_name_prefixed': sub,
+                                       'parent_id': parent}}
+                             for sub, parent in COMMENTS.get(parts[2], [])])
+
+        if path.endswith('/submitted'):
+            return _listing([{'data': {'subreddit_name_prefixed': sub,
+                                       'id': id}}
+                             for sub, id in SUBMISSIONS.get(parts[2], [])])
+
+        if parts[1] == 'comments':
+            author = COMMENTERS[parts[2]]
+
+            # Collapsed comments are served for missing authors
+            return [_listing([]),
+                    _listing([{'kind': 't1' if author else 'more',
+                               'data': {'author': author}}])]
+
+        if path == '/api/info' and 'id' in params:
+            return _listing([{'data': {'name': id, 'author': AUTHORS[id]}}
+                             for id in params['id'].split(',')])
+
+        if path == '/api/info':
+            return _listing([{'data': _sub(name)}
+                             for name in params['sr_name'].split(',')
+                             if name != 'missing'])
+
+        if path.endswith('/about') and parts[2] == 'missing':
+            raise aioreddit.NotFound(path)
+
+        return {'data': {}}
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+class TestCrawler(unittest.TestCase):
+    def setUp(self):
+        self.client = FakeClient()
+        self.crawler = aioreddit.Crawler(self.client)
+
+        # Crawl without the caches of the configured pipeline
+        for name in ('activity_backend', 'sub_cache', 'prefetcher'):
+            patcher = patch.object(reddit, name, None)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_parent_authors(self):
+        self.assertEqual(['alice', 'bob'],
+                         run(self.crawler.parent_authors('user')))
+
+        # Parents are resolved in one request
+        self.assertEqual(1, sum(1 for path, params in self.client.requests
+                                if path == '/api/info'))
+
+        # Deleted authors are skipped
+        self.assertEqual([], run(self.crawler.parent_authors('alice')))
+
+    def test_submission_commenters(self):
+        # The first submission fails and the second is collapsed
+        with patch.dict(SUBMISSIONS, {'dave': [('r/a', 'gone'),
+                                               ('r/b', 's2'),
+                                               ('r/c', 's1')]}), \
+                patch.dict(COMMENTERS, {'s2': None}):
+            self.assertEqual(['carol'],
+                             run(self.crawler.submission_commenters('dave')))
+
+    def test_similar_users(self):
+        self.assertEqual(OrderedDict([('alice', 2.0), ('bob', 2.0),
+                                      ('carol', 1.0)]),
+                         run(self.crawler.similar_users('user')))
+
+    def test_active_subs(self):
+        self.assertEqual(['r/a', 'r/b'],
+                         run(self.crawler.active_subs('user')))
+        self.assertEqual(['r/c', 'r/d'],
+                         run(self.crawler.active_subs('alice')))
+
+    def test_listings_reused(self):
+        run(self.crawler.parent_authors('user'))
+        run(self.crawler.active_subs('User'))
+
+        # The comments listing is fetched once for both stages
+        self.assertEqual(1, sum(1 for path, params in self.client.requests
+                                if path == '/user/user/comments'))
+
+    def test_same_as_sync(self):
+        # Both backends read the same Reddit, through PRAW objects and
+        # through API JSON
+        graph = fakereddit.synthetic_graph(users=40, subs=30, seed=3)
+
+        # Some parents and commenters are deleted
+        for i, name in enumerate(sorted(graph['users'])):
+            if i % 3 == 0:
+                graph['users'][name]['comments'][0]['parent_author'] = None
+                graph['users'][name]['submissions'][0]['commenters'][0] = None
+
+        session = fakereddit.FakeReddit(graph)
+        client = fakereddit.FakeClient(session)
+
+        with patch.object(reddit, 'executor', fanout.FanOut()), \
+                patch.object(reddit, 'flights', reddit.SingleFlight()):
+            for user in ('user0', 'user7', 'user19'):
+                expected = reddit.get_user_recommendations(session, user)
+
+                self.assertTrue(expected)
+                self.assertEqual(expected, run(
+                    aioreddit.get_user_recommendations(client, user)))
+
+    def test_own_subs_failed(self):
+        active_subs = self.crawler.active_subs
+
+        async def own_subs_failing(user):
+            if user == 'user':
+                raise reddit.BudgetExceeded()
+
+            return await active_subs(user)
+
+        # Subs the user is active in can't be left out, so none are
+        # recommended
+        with patch.object(self.crawler, 'active_subs', own_subs_failing):
+            self.assertEqual([], run(self.crawler.recommendations('user')))
+
+        self.assertFalse(any('sr_name' in params
+                             for path, params in self.client.requests))
+
+    def test_sub_infos_fallback(self):
+        with patch.object(reddit, 'SUB_BATCH_SIZE', 1):
+            infos = run(self.crawler.sub_infos(['a', 'missing']))
+
+        self.assertEqual('r/a', infos['a'].name)
+        self.assertIsNone(infos['missing'])
+
+    def test_user_exists(self):
+        self.assertTrue(run(aioreddit.user_exists(self.client, 'user')))
+        self.assertFalse(run(aioreddit.user_exists(self.client, 'missing')))
+
+
+class TestSingleFlight(unittest.TestCase):
+    def test_do(self):
+        flights = aioreddit.SingleFlight()
+        calls = []
+
+        async def fetch(key):
+            calls.append(key)
+            await asyncio.sleep(0)
+            return key
+
+        async def crawl():
+            return await asyncio.gather(flights.do('a', fetch, 'a'),
+                                        flights.do('a', fetch, 'a'),
+                                        flights.do('b', fetch, 'b'))
+
+        self.assertEqual(['a', 'a', 'b'], run(crawl()))
+        self.assertEqual(['a', 'b'], calls)
+        self.assertEqual(1, flights.coalesced)
+
+        # Finished calls are not shared
+        run(flights.do('a', fetch, 'a'))
+        self.assertEqual(['a', 'b', 'a'], calls)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from subber import batch, reddit
+
+
+def recommend(user):
+    if user == 'broken':
+        raise RuntimeError('crawl failed')
+
+    return [reddit.SubInfo('r/' + user, 'Title', 3, 8962, False,
+                           'Description')]
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+        self.path = os.path.join(self.dir, 'results.jsonl')
+
+    def test_read_users(self):
+        self.assertEqual(['a', 'b'],
+                         batch.read_users(['a\n', '\n', '# comment\n',
+                                           '  b  \n']))
+
+    def test_iter_results(self):
+        users = ['a', 'missing', 'broken', 'b', 'A', 'done']
+        results = list(batch.iter_results(
+            users, recommend, exists=lambda u: u != 'missing',
+            done={'done'}, workers=1))
+
+        # Results keep input order, skipping repeated and finished users
+        self.assertEqual(['a', 'missing', 'broken', 'b'],
+                         [r['user'] for r in results])
+        self.assertEqual(['done', 'not_found', 'failed', 'done'],
+                         [r['status'] for r in results])
+        self.assertEqual(['r/a'], [sub['name'] for sub in
+                                   results[0]['recommendations']])
+        self.assertEqual('crawl failed', results[2]['error'])
+
+    def test_checkpoint_resume(self):
+        checkpoint = batch.Checkpoint(self.path)
+        for result in batch.iter_results(['a', 'broken'], recommend):
+            checkpoint.write(result)
+        checkpoint.close()
+
+        # Simulate a crash while writing the next result
+        with open(self.path, 'ab') as f:
+            f.write(b'{"user": "b", "sta')
+
+        checkpoint = batch.Checkpoint(self.path)
+        self.assertEqual({'a'}, checkpoint.done)
+
+        for result in batch.iter_results(['a', 'broken', 'b'], recommend,
+                                         done=checkpoint.done):
+            checkpoint.write(result)
+        checkpoint.close()
+
+        with open(self.path) as f:
+            results = [json.loads(line) for line in f]
+
+        self.assertEqual(['a', 'broken', 'broken', 'b'],
+                         [r['user'] for r in results])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from benchmarks import fakereddit, run
+from subber import reddit
+
+
+class TestBenchmarks(unittest.TestCase):
+    def setUp(self):
+        self.graph = fakereddit.synthetic_graph(users=50, subs=30, seed=1)
+        self.session = fakereddit.FakeReddit(self.graph)
+
+        # Run against fresh pipeline components, restoring the originals
+        for name in ('executor', 'sub_cache', 'activity_backend',
+                     'api_scheduler', 'flights'):
+            patcher = patch.object(reddit, name, getattr(reddit, name))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        run.configure(workers=1)
+
+    def test_recommendations(self):
+        result = reddit.get_user_recommendations(self.session, 'user0')
+
+        self.assertTrue(result)
+        self.assertLessEqual(len(result), reddit.max_recommendations)
+
+    def test_call_volume(self):
+        reddit.get_user_recommendations(self.session, 'user0')
+
+        # Catch regressions in the number of API requests per recommendation
+        self.assertLessEqual(self.session.total_calls, 25)
+        self.assertLessEqual(self.session.calls['info'], 1)
+
+        # Parents of the user's comments are looked up together
+        self.assertLessEqual(self.session.calls['parent'], 1)
+
+    def test_failures(self):
+        session = fakereddit.FakeReddit(self.graph, failure_rate=0.3)
+
+        for i in range(5):
+            reddit.get_user_recommendations(session, 'user{}'.format(i))
+
+        self.assertGreater(session.total_calls, 0)
+
+    def test_fixture_replay(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+
+        path = os.path.join(tmpdir, 'graph.json')
+        fakereddit.save_fixture(self.graph, path)
+
+        replayed = fakereddit.FakeReddit(fakereddit.load_fixture(path))
+
+        self.assertEqual(
+            reddit.get_user_recommendations(self.session, 'user3'),
+            reddit.get_user_recommendations(replayed, 'user3'))
+
+    def test_percentile(self):
+        samples = list(range(1, 101))
+
+        self.assertEqual(51, run.percentile(samples, 50))
+        self.assertEqual(99, run.percentile(samples, 99))
+        self.assertEqual(100, run.percentile(samples, 100))
+
+
+if __name__ == '__main__':
+    unittest.main()
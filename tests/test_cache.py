@@ -0,0 +1,268 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from subber import cache
+
+
+def sub_fields(name):
+    return {'display_name_prefixed': 'r/' + name,
+            'title': 'Title',
+            'created': 892349754,
+            'subscribers': 8962,
+            'over18': False,
+            'public_description': 'Description'}
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestSubInfoCache(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = cache.SubInfoCache(ttls={'subscribers': 10,
+                                              'profile': 100,
+                                              'identity': 1000},
+                                        clock=self.clock)
+
+    def test_hit_and_miss(self):
+        self.assertIsNone(self.cache.get('sub'))
+
+        self.cache.set('sub', sub_fields('sub'))
+
+        self.assertEqual(sub_fields('sub'), self.cache.get('SUB'))
+        self.assertEqual(1, self.cache.hits)
+        self.assertEqual(1, self.cache.misses)
+
+    def test_subscribers_expire_first(self):
+        self.cache.set('sub', sub_fields('sub'))
+
+        self.clock.now += 9
+        self.assertIsNotNone(self.cache.get('sub'))
+
+        self.clock.now += 1
+        self.assertIsNone(self.cache.get('sub'))
+
+        # Refreshing only the subscriber count revives the entry
+        self.cache.set('sub', {'subscribers': 9000})
+        self.assertEqual(9000, self.cache.get('sub')['subscribers'])
+
+        # Profile fields still expire on their own schedule
+        self.clock.now += 90
+        self.cache.set('sub', {'subscribers': 9001})
+        self.assertIsNone(self.cache.get('sub'))
+
+    def test_expires_in(self):
+        self.assertIsNone(self.cache.expires_in('sub'))
+
+        self.cache.set('sub', sub_fields('sub'))
+        self.clock.now += 4
+        self.assertEqual(6, self.cache.expires_in('SUB'))
+
+        self.cache.set('other', {'subscribers': 1})
+        self.assertEqual(float('-inf'), self.cache.expires_in('other'))
+
+    def test_lru_eviction(self):
+        self.cache.set('sub1', sub_fields('sub1'))
+        entry_size = self.cache.stats()['bytes']
+        self.cache.max_bytes = entry_size * 2
+
+        self.cache.set('sub2', sub_fields('sub2'))
+
+        # Use sub1 so sub2 is least recently used
+        self.cache.get('sub1')
+        self.cache.set('sub3', sub_fields('sub3'))
+
+        self.assertIsNotNone(self.cache.get('sub1'))
+        self.assertIsNone(self.cache.get('sub2'))
+        self.assertIsNotNone(self.cache.get('sub3'))
+        self.assertEqual(1, self.cache.evictions)
+        self.assertEqual(2, len(self.cache))
+
+    def test_shared_backend(self):
+        backend = cache.MemoryBackend(clock=self.clock)
+        worker1 = cache.SubInfoCache(clock=self.clock, backend=backend)
+        worker2 = cache.SubInfoCache(clock=self.clock, backend=backend)
+
+        worker1.set('sub', sub_fields('sub'))
+
+        self.assertEqual(sub_fields('sub'), worker2.get('sub'))
+        self.assertEqual(1, worker2.shared_hits)
+
+        # Entry is now held locally
+        self.assertEqual(sub_fields('sub'), worker2.get('sub'))
+        self.assertEqual(1, worker2.hits)
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = cache.ResponseCache(fresh=10, stale=100, max_entries=2,
+                                         clock=self.clock)
+
+    def test_fresh_stale_expired(self):
+        self.assertIsNone(self.cache.get('user'))
+
+        entry = self.cache.set('User', '<html>')
+        self.assertFalse(entry['stale'])
+        self.assertEqual(entry, self.cache.get('user'))
+
+        # Stale pages are still served
+        self.clock.now += 10
+        self.assertTrue(self.cache.get('USER')['stale'])
+
+        self.clock.now += 100
+        self.assertIsNone(self.cache.get('user'))
+
+        self.assertEqual({'entries': 0, 'hits': 1, 'stale_hits': 1,
+                          'misses': 2}, self.cache.stats())
+
+    def test_refresh_failed(self):
+        backend = cache.MemoryBackend(clock=self.clock)
+        worker1 = cache.ResponseCache(fresh=10, stale=100, retry=30,
+                                      clock=self.clock, backend=backend)
+        worker2 = cache.ResponseCache(fresh=10, stale=100, retry=30,
+                                      clock=self.clock, backend=backend)
+
+        worker1.set('user', '<html>')
+        self.assertFalse(worker1.get('user')['refresh'])
+
+        self.clock.now += 10
+        self.assertTrue(worker1.get('user')['refresh'])
+
+        # Failed refreshes are retried after the retry delay, by any worker
+        worker1.refresh_failed('User')
+        self.assertTrue(worker1.get('user')['stale'])
+        self.assertFalse(worker1.get('user')['refresh'])
+        self.assertFalse(worker2.get('user')['refresh'])
+
+        self.clock.now += 30
+        self.assertTrue(worker1.get('user')['refresh'])
+        self.assertTrue(worker2.get('user')['refresh'])
+
+    def test_etag(self):
+        etag = self.cache.set('user', '<html>')['etag']
+
+        self.assertEqual(etag, self.cache.set('user', '<html>')['etag'])
+        self.assertNotEqual(etag, self.cache.set('user', '<body>')['etag'])
+
+    def test_lru_eviction(self):
+        self.cache.set('a', 'a')
+        self.cache.set('b', 'b')
+        self.cache.get('a')
+        self.cache.set('c', 'c')
+
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual('a', self.cache.get('a')['body'])
+
+    def test_shared_backend(self):
+        backend = cache.MemoryBackend(clock=self.clock)
+        worker1 = cache.ResponseCache(fresh=10, stale=100, clock=self.clock,
+                                      backend=backend)
+        worker2 = cache.ResponseCache(fresh=10, stale=100, clock=self.clock,
+                                      backend=backend)
+
+        worker1.set('user', '<html>')
+        self.assertEqual('<html>', worker2.get('user')['body'])
+
+
+class TestBackends(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'cache.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def check_backend(self, backend):
+        self.assertIsNone(backend.get('key'))
+
+        backend.set('key', {'subs': ['r/sub']})
+        self.assertEqual({'subs': ['r/sub']}, backend.get('key'))
+
+        backend.set('expiring', [1, 2], ttl=10)
+        self.clock.now += 10
+        self.assertIsNone(backend.get('expiring'))
+
+        backend.delete('key')
+        self.assertIsNone(backend.get('key'))
+
+        # Keys are only added while missing or expired
+        self.assertTrue(backend.add('lock', 'a', ttl=10))
+        self.assertFalse(backend.add('lock', 'b', ttl=10))
+        self.clock.now += 10
+        self.assertTrue(backend.add('lock', 'b'))
+        self.assertEqual('b', backend.get('lock'))
+
+    def test_memory_backend(self):
+        self.check_backend(cache.MemoryBackend(clock=self.clock))
+
+    def test_memory_backend_lru(self):
+        backend = cache.MemoryBackend(clock=self.clock, max_entries=2)
+
+        backend.set('a', 1)
+        backend.set('b', 2, ttl=10)
+        backend.get('a')
+        backend.set('c', 3)
+
+        # The least recently used entry is evicted
+        self.assertEqual(2, len(backend))
+        self.assertIsNone(backend.get('b'))
+        self.assertEqual(1, backend.get('a'))
+
+        backend.set('d', 4, ttl=10)
+        self.clock.now += 10
+        backend.purge()
+        self.assertEqual(1, len(backend))
+
+    def test_sqlite_backend(self):
+        self.check_backend(cache.SQLiteBackend(self.path, clock=self.clock))
+
+    def test_sqlite_backend_shared(self):
+        worker1 = cache.SQLiteBackend(self.path, clock=self.clock)
+        worker2 = cache.SQLiteBackend(self.path, clock=self.clock)
+
+        worker1.set('active_subs:user', ['r/sub'], ttl=10)
+        self.assertEqual(['r/sub'], worker2.get('active_subs:user'))
+
+        self.clock.now += 10
+        worker2.purge()
+        self.assertIsNone(worker1.get('active_subs:user'))
+
+    def test_sqlite_backend_purge_on_write(self):
+        backend = cache.SQLiteBackend(self.path, clock=self.clock,
+                                      purge_every=2)
+
+        backend.set('expiring', 1, ttl=10)
+        self.clock.now += 10
+
+        # The second write purges the expired entry
+        backend.set('key', 2)
+
+        rows = backend._connect().execute(
+            'SELECT key FROM cache').fetchall()
+        self.assertEqual([('key',)], rows)
+
+
+if __name__ == '__main__':
+    unittest.main()
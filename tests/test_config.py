@@ -52,3 +52,23 @@ class TestConfig(unittest.TestCase):
         rec = capture.records[0]
         self.assertEqual("CRITICAL", rec.levelname)
         self.assertTrue(rec.msg.startswith("Validation error:"))
+
+    def test_default_options(self):
+        cfg = os.path.join(TESTCONF, 'good.cfg')
+        self.assertEqual(config.defaults, config.get_options(cfg))
+
+    def test_options(self):
+        cfg = os.path.join(TESTCONF, 'options.cfg')
+        res = config.get_options(cfg)
+        self.assertEqual(4, res["workers"])
+        self.assertEqual(2, res["sub_info_concurrency"])
+        self.assertEqual(config.defaults["active_subs_concurrency"],
+                         res["active_subs_concurrency"])
+
+    @log_capture()
+    def test_invalid_option(self, capture):
+        cfg = os.path.join(TESTCONF, 'bad_option.cfg')
+        self.assertRaises(RuntimeError, config.get_options, cfg)
+        rec = capture.records[0]
+        self.assertEqual("CRITICAL", rec.levelname)
+        self.assertTrue(rec.msg.startswith("Invalid value for option"))
@@ -0,0 +1,83 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from subber import cooccurrence, graph
+
+ACTIVITY = [['r/python', 'r/linux', 'r/vim'],
+            ['r/Python', 'r/linux'],
+            ['r/python', 'r/django'],
+            ['r/cooking', 'r/baking']]
+
+
+@unittest.skipIf(cooccurrence.numpy is None, 'numpy is not installed')
+class TestCooccurrence(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_build(self):
+        index = cooccurrence.build(ACTIVITY)
+
+        self.assertEqual(['r/baking', 'r/cooking', 'r/django', 'r/linux',
+                          'r/python', 'r/vim'], index.subs)
+        self.assertEqual([1, 1, 1, 2, 3, 1], list(index.counts))
+
+        # r/python appears with r/django once, r/linux twice, r/vim once
+        start, end = index.indptr[4], index.indptr[5]
+        self.assertEqual([2, 3, 5], list(index.indices[start:end]))
+        self.assertEqual([1, 2, 1], list(index.data[start:end]))
+
+    def test_recommend(self):
+        index = cooccurrence.build(ACTIVITY)
+
+        ranked = index.recommend(['r/Python'], 2)
+        self.assertEqual(['r/linux', 'r/django'], [s for s, _ in ranked])
+
+        # Known subs are skipped and unknown subs ignored
+        ranked = index.recommend(['r/python', 'r/linux', 'r/unknown'], 10)
+        self.assertEqual(['r/vim', 'r/django'], [s for s, _ in ranked])
+
+        self.assertEqual([], index.recommend(['r/unknown'], 10))
+
+    def test_save_load(self):
+        path = os.path.join(self.dir, 'index')
+        cooccurrence.build(ACTIVITY).save(path)
+
+        index = cooccurrence.CooccurrenceIndex.load(path)
+        self.assertEqual(['r/linux', 'r/django'],
+                         [s for s, _ in index.recommend(['r/python'], 2)])
+
+    def test_main(self):
+        store = graph.GraphStore(os.path.join(self.dir, 'graph.db'))
+        for i, subs in enumerate(ACTIVITY):
+            store.add_posts('user{}'.format(i), 'comments',
+                            [(graph.Post('t1_{}{}'.format(i, j), sub, None),
+                              j) for j, sub in enumerate(subs)], None)
+
+        path = os.path.join(self.dir, 'index')
+        cooccurrence.main([store.path, path])
+
+        index = cooccurrence.CooccurrenceIndex.load(path)
+        self.assertEqual(6, len(index.subs))
+
+
+if __name__ == '__main__':
+    unittest.main()
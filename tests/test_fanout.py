@@ -0,0 +1,94 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+import unittest
+
+from subber import fanout
+
+
+class TestFanOut(unittest.TestCase):
+    def test_map_serial(self):
+        executor = fanout.FanOut()
+        results = executor.map('stage', lambda x: x * 2, [1, 2, 3])
+
+        self.assertEqual([1, 2, 3], [item for item, future in results])
+        self.assertEqual([2, 4, 6], [future.result() for item, future
+                                     in results])
+
+    def test_map_serial_exception(self):
+        def fail(x):
+            if x == 2:
+                raise ValueError(x)
+            return x
+
+        results = fanout.FanOut().map('stage', fail, [1, 2, 3])
+
+        self.assertEqual(1, results[0][1].result())
+        self.assertRaises(ValueError, results[1][1].result)
+        self.assertEqual(3, results[2][1].result())
+
+    def test_map_keeps_order(self):
+        executor = fanout.FanOut(workers=4)
+
+        def slow_first(x):
+            time.sleep(0.05 if x == 0 else 0)
+            return x
+
+        results = executor.map('stage', slow_first, range(8))
+
+        self.assertEqual(list(range(8)), [future.result() for item, future
+                                          in results])
+        executor.shutdown()
+
+    def test_stage_limit(self):
+        executor = fanout.FanOut(workers=8, limits={'limited': 2})
+        lock = threading.Lock()
+        running = [0]
+        peak = [0]
+
+        def track(x):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+
+        for item, future in executor.map('limited', track, range(8)):
+            future.result()
+
+        self.assertEqual(2, peak[0])
+        executor.shutdown()
+
+    def test_stage_limit_leaves_workers(self):
+        executor = fanout.FanOut(workers=2, limits={'limited': 1})
+        release = threading.Event()
+
+        limited = executor.map('limited', lambda x: release.wait(5),
+                               range(4))
+
+        # Calls waiting on the limit don't take the other worker
+        other = executor.map('other', lambda x: x, [1])
+        self.assertEqual(1, other[0][1].result(timeout=1))
+        self.assertFalse(release.is_set())
+
+        release.set()
+        self.assertEqual([True] * 4, [future.result(timeout=5)
+                                      for item, future in limited])
+        executor.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from subber import graph
+
+
+class TestGraphStore(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.now = 1000.0
+        self.store = graph.GraphStore(os.path.join(self.dir, 'graph.db'),
+                                      clock=lambda: self.now)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def post(self, name, sub='r/sub', parent=None):
+        return graph.Post(name, sub, parent)
+
+    def test_listing(self):
+        self.assertIsNone(self.store.get_listing('user', 'comments'))
+
+        posts = [(self.post('t1_b'), -2), (self.post('t1_a'), -1)]
+        self.store.add_posts('User', 'comments', posts, 't1_b', replace=True)
+
+        self.assertEqual(graph.Listing('t1_b', 1000.0, 1000.0),
+                         self.store.get_listing('user', 'comments'))
+        self.assertEqual([self.post('t1_b'), self.post('t1_a')],
+                         self.store.get_posts('USER', 'comments'))
+        self.assertEqual([], self.store.get_posts('user', 'submissions'))
+
+    def test_incremental(self):
+        posts = [(self.post('t1_b'), -2), (self.post('t1_a'), -1)]
+        self.store.add_posts('user', 'comments', posts, 't1_b', replace=True)
+
+        self.now = 2000.0
+        self.store.add_posts('user', 'comments', [(self.post('t1_c'), -3)],
+                             't1_c', keep=2)
+
+        # Full fetch time is kept and the oldest post is dropped
+        self.assertEqual(graph.Listing('t1_c', 2000.0, 1000.0),
+                         self.store.get_listing('user', 'comments'))
+        self.assertEqual(['t1_c', 't1_b'],
+                         [p.fullname
+                          for p in self.store.get_posts('user', 'comments')])
+
+    def test_edges(self):
+        self.store.add_posts('user', 'comments',
+                             [(self.post('t1_a', parent='t3_x'), -1),
+                              (self.post('t1_b', parent='t3_y'), -2)],
+                             't1_b', replace=True)
+
+        self.assertEqual({}, self.store.get_edges('user', ['t1_a']))
+
+        self.store.add_edges('user', {'t1_a': ['other', 'more'], 't1_b': []})
+        self.assertEqual({'t1_a': ['more', 'other'], 't1_b': []},
+                         self.store.get_edges('user', ['t1_a', 't1_b']))
+
+        self.store.add_edges('user', {'t1_a': ['other']})
+
+        # Edges stored too long ago are left out when a max age is given
+        self.now = 1500.0
+        self.assertEqual({}, self.store.get_edges('user', ['t1_a'],
+                                                  max_age=300))
+        self.assertEqual({'t1_a': ['other']},
+                         self.store.get_edges('user', ['t1_a'], max_age=600))
+
+        # Edges go away with their posts
+        self.store.add_posts('user', 'comments', [(self.post('t1_a'), -1)],
+                             't1_a', replace=True)
+        self.assertEqual({'t1_a': ['other']},
+                         self.store.get_edges('user', ['t1_a', 't1_b']))
+        self.assertEqual({'users': 1, 'posts': 1, 'edges': 1},
+                         self.store.stats())
+
+    def test_close(self):
+        self.store.add_edges('user', {'t1_a': ['other']})
+        self.store.close()
+
+        # A closed store reads nothing and writes are dropped
+        self.assertEqual({}, self.store.get_edges('user', ['t1_a']))
+        self.store.add_edges('user', {'t1_b': ['other']})
+
+        store = graph.GraphStore(self.store.path)
+        self.assertEqual({'t1_a': ['other']},
+                         store.get_edges('user', ['t1_a', 't1_b']))
+
+
+if __name__ == '__main__':
+    unittest.main()
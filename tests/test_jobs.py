@@ -0,0 +1,129 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+import unittest
+
+from subber import cache, jobs
+
+
+def wait_for(job, timeout=5):
+    deadline = time.time() + timeout
+    while job.in_flight and time.time() < deadline:
+        time.sleep(0.01)
+
+
+class TestJobManager(unittest.TestCase):
+    def setUp(self):
+        self.manager = jobs.JobManager(workers=2)
+
+    def test_partial_results(self):
+        release = threading.Event()
+
+        def run(user, on_result):
+            on_result({'name': 'r/first'})
+            release.wait(5)
+            on_result({'name': 'r/second'})
+
+        job = self.manager.submit('user', run)
+
+        deadline = time.time() + 5
+        while not job.results and time.time() < deadline:
+            time.sleep(0.01)
+
+        self.assertEqual(jobs.RUNNING, job.status)
+        self.assertEqual([{'name': 'r/first'}], job.to_dict()['results'])
+
+        release.set()
+        wait_for(job)
+
+        self.assertEqual(jobs.DONE, job.status)
+        self.assertEqual(2, len(job.results))
+
+    def test_duplicate_submission(self):
+        release = threading.Event()
+        calls = []
+
+        def run(user, on_result):
+            calls.append(user)
+            release.wait(5)
+
+        job = self.manager.submit('User', run)
+        duplicate = self.manager.submit('user', run)
+
+        self.assertIs(job, duplicate)
+        self.assertIs(job, self.manager.get(job.id))
+
+        release.set()
+        wait_for(job)
+
+        # Finished jobs are not reused
+        self.assertIsNot(job, self.manager.submit('user', run))
+        self.assertEqual(['User'], calls[:1])
+
+    def test_failed_job(self):
+        def run(user, on_result):
+            raise LookupError('User user does not exist')
+
+        job = self.manager.submit('user', run)
+        wait_for(job)
+
+        self.assertEqual(jobs.FAILED, job.status)
+        self.assertEqual('User user does not exist', job.error)
+
+    def test_expired_job(self):
+        now = [1000.0]
+        manager = jobs.JobManager(ttl=60, clock=lambda: now[0])
+
+        job = manager.submit('user', lambda user, on_result: None)
+        wait_for(job)
+
+        now[0] += 60
+        manager.submit('other', lambda user, on_result: None)
+
+        self.assertIsNone(manager.get(job.id))
+
+    def test_shared_jobs(self):
+        backend = cache.MemoryBackend()
+        worker1 = jobs.JobManager(backend=backend)
+        worker2 = jobs.JobManager(backend=backend)
+
+        release = threading.Event()
+        calls = []
+
+        def run(user, on_result):
+            calls.append(user)
+            on_result({'name': 'r/first'})
+            release.wait(5)
+
+        job = worker1.submit('user', run)
+
+        # Another worker attaches to the job and serves its status
+        duplicate = worker2.submit('User', run)
+        self.assertEqual(job.id, duplicate.id)
+
+        release.set()
+        wait_for(job)
+
+        polled = worker2.get(job.id)
+        self.assertEqual(jobs.DONE, polled.status)
+        self.assertEqual([{'name': 'r/first'}], polled.results)
+        self.assertEqual(['user'], calls)
+
+        # Finished jobs are not reused
+        self.assertNotEqual(job.id, worker2.submit('user', run).id)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,179 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from subber import logs, metrics
+
+
+class Payload(object):
+    def __init__(self):
+        self.formatted = 0
+
+    def __str__(self):
+        self.formatted += 1
+        return 'payload'
+
+
+class TestLogs(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'test.log')
+        self.logger = logging.getLogger('subber.test_logs')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+
+    def tearDown(self):
+        for handler in list(self.logger.handlers):
+            self.logger.removeHandler(handler)
+        shutil.rmtree(self.dir)
+
+    def test_writes_in_background(self):
+        pipeline = logs.Pipeline(self.path)
+        self.logger.addHandler(pipeline.handler)
+        pipeline.start()
+
+        self.logger.info('Hello %s', 'there')
+        pipeline.stop()
+
+        with open(self.path) as f:
+            self.assertIn('Hello there', f.read())
+
+    def test_formats_on_writer_thread(self):
+        pipeline = logs.Pipeline(self.path)
+        self.logger.addHandler(pipeline.handler)
+        payload = Payload()
+
+        # Other handlers, such as a test runner's, may format the record
+        # too, so only formatting by the pipeline is counted
+        writer_threads = []
+        format_record = pipeline.writer.format
+
+        def format(record):
+            writer_threads.append(threading.current_thread())
+            return format_record(record)
+
+        pipeline.writer.format = format
+
+        # Records are queued unformatted
+        record = self.logger.makeRecord(self.logger.name, logging.INFO,
+                                        __file__, 0, 'Payload %s',
+                                        (payload,), None)
+        self.assertIs(record, pipeline.handler.prepare(record))
+        self.assertEqual(0, payload.formatted)
+
+        # The writer starts with the first record
+        self.logger.info('Payload %s', payload)
+        pipeline.stop()
+
+        self.assertEqual(1, len(writer_threads))
+        self.assertIsNot(threading.current_thread(), writer_threads[0])
+        self.assertIs(pipeline.listener._thread, None)
+
+        with open(self.path) as f:
+            self.assertIn('Payload payload', f.read())
+
+    def test_restart_after_fork(self):
+        pipeline = logs.Pipeline(self.path)
+        pipeline.start()
+        parent_queue = pipeline.queue
+        parent_listener = pipeline.listener
+
+        # Pretend the pipeline was started by a parent process
+        pipeline._pid = -1
+        pipeline.start()
+
+        self.assertIsNot(parent_queue, pipeline.queue)
+        self.assertIs(pipeline.queue, pipeline.handler.queue)
+        pipeline.stop()
+        parent_listener.stop()
+
+    def test_skips_disabled_levels(self):
+        pipeline = logs.Pipeline(self.path)
+        self.logger.addHandler(pipeline.handler)
+        payload = Payload()
+
+        self.logger.debug('Payload %s', payload)
+        self.assertEqual(0, pipeline.queue.qsize())
+        self.assertEqual(0, payload.formatted)
+
+    def test_drops_when_full(self):
+        pipeline = logs.Pipeline(self.path, max_queue=1)
+        self.logger.addHandler(pipeline.handler)
+
+        # Keep the writer from draining the queue
+        pipeline.start = lambda: None
+        dropped = metrics.registry.get('subber_log_dropped_total')
+
+        self.logger.info('first')
+        self.logger.info('second')
+
+        self.assertEqual(1, pipeline.queue.qsize())
+        self.assertEqual(dropped + 1,
+                         metrics.registry.get('subber_log_dropped_total'))
+
+    def test_rotates(self):
+        pipeline = logs.Pipeline(self.path, max_bytes=200, backups=2)
+        self.logger.addHandler(pipeline.handler)
+        pipeline.start()
+
+        for i in range(20):
+            self.logger.info('Message number %s', i)
+        pipeline.stop()
+
+        self.assertTrue(os.path.exists(self.path + '.1'))
+        self.assertFalse(os.path.exists(self.path + '.3'))
+
+    def test_rotates_across_processes(self):
+        pipeline = logs.Pipeline(self.path, max_bytes=1000, backups=100)
+        self.logger.addHandler(pipeline.handler)
+
+        # The parent starts writing before forking, as under --preload
+        self.logger.info('parent started')
+
+        pid = os.fork()
+        if pid == 0:
+            try:
+                for i in range(200):
+                    self.logger.info('child %s', i)
+                pipeline.stop()
+            finally:
+                os._exit(0)
+
+        for i in range(200):
+            self.logger.info('parent %s', i)
+        os.waitpid(pid, 0)
+        pipeline.stop()
+
+        lines = []
+        for name in os.listdir(self.dir):
+            if not name.endswith('.lock'):
+                with open(os.path.join(self.dir, name)) as f:
+                    lines.extend(line.split()[-2:] for line in f)
+
+        # Every record of both processes is kept once
+        expected = ([['parent', 'started']] +
+                    [[who, str(i)] for who in ('child', 'parent')
+                     for i in range(200)])
+        self.assertEqual(sorted(expected), sorted(lines))
+        self.assertTrue(os.path.exists(self.path + '.10'))
+
+
+if __name__ == '__main__':
+    unittest.main()
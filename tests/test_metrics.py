@@ -0,0 +1,89 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+from unittest.mock import patch
+
+from subber import fanout, metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+        self.registry.describe('test_duration_seconds', 'histogram',
+                               'Test durations')
+        self.registry.describe('test_calls_total', 'counter', 'Test calls')
+
+        patcher = patch('subber.metrics.registry', self.registry)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(metrics.set_trace, None)
+
+    def test_render(self):
+        self.registry.inc('test_calls_total', stage='a')
+        self.registry.inc('test_calls_total', 2, stage='a')
+        self.registry.observe('test_duration_seconds', 0.02, stage='a')
+        self.registry.collect(lambda: [('test_entries', {}, 7)])
+
+        lines = self.registry.render().splitlines()
+
+        self.assertIn('# TYPE test_calls_total counter', lines)
+        self.assertIn('test_calls_total{stage="a"} 3.0', lines)
+        self.assertIn('# TYPE test_duration_seconds histogram', lines)
+        self.assertIn('test_duration_seconds_bucket{stage="a",le="0.01"} 0',
+                      lines)
+        self.assertIn('test_duration_seconds_bucket{stage="a",le="0.025"} 1',
+                      lines)
+        self.assertIn('test_duration_seconds_bucket{stage="a",le="+Inf"} 1',
+                      lines)
+        self.assertIn('test_duration_seconds_count{stage="a"} 1', lines)
+        self.assertIn('test_entries 7', lines)
+
+    def test_span(self):
+        trace = metrics.Trace()
+        metrics.set_trace(trace)
+
+        with metrics.span('stage'):
+            metrics.count('praw_calls')
+
+        with self.assertRaises(ValueError):
+            with metrics.span('failing'):
+                raise ValueError()
+
+        self.assertEqual(['stage', 'failing'], list(trace.durations))
+        self.assertEqual(1, trace.counts['praw_calls'])
+        self.assertEqual(1, trace.errors['failing'])
+        self.assertEqual(1, self.registry.get('subber_stage_errors_total',
+                                              stage='failing'))
+        self.assertEqual(1, self.registry.get('subber_praw_calls_total'))
+        self.assertIn('praw_calls;desc="1"', trace.server_timing())
+
+    def test_trace_follows_fanout(self):
+        trace = metrics.Trace()
+        metrics.set_trace(trace)
+
+        def work(item):
+            with metrics.span('work'):
+                metrics.count('praw_calls')
+
+        executor = fanout.FanOut(workers=4)
+        for item, future in executor.map('stage', work, range(4)):
+            future.result()
+        executor.shutdown()
+
+        self.assertEqual(4, trace.counts['praw_calls'])
+        self.assertIn('work', trace.durations)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+from unittest.mock import Mock
+
+from subber import prefetch
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestAccessTracker(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.tracker = prefetch.AccessTracker(half_life=10, max_keys=2,
+                                              clock=self.clock)
+
+    def test_hottest(self):
+        for key in ('a', 'b', 'b', 'c'):
+            self.tracker.record(key)
+
+        self.assertEqual(['b', 'a'], self.tracker.hottest(2))
+
+        # Old accesses fade
+        self.clock.now += 20
+        self.tracker.record('c')
+        self.tracker.record('c')
+        self.assertEqual(['c', 'b', 'a'], self.tracker.hottest(3))
+
+    def test_max_keys(self):
+        for key in ('a', 'a', 'b', 'c', 'd', 'e'):
+            self.tracker.record(key)
+
+        self.assertEqual(2, len(self.tracker))
+        self.assertIn('a', self.tracker)
+
+
+class TestPrefetcher(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.expiry = {}
+        self.idle = True
+
+        self.prefetcher = prefetch.Prefetcher(
+            refresh_subs=Mock(), refresh_user=Mock(),
+            expires_in=self.expiry.get, idle=lambda: self.idle,
+            user_ttl=100, max_subs=2, max_users=1, horizon=10,
+            clock=self.clock)
+
+        # Keep the prefetch thread from starting
+        self.prefetcher.stop()
+
+    def test_refresh_expiring_subs(self):
+        self.prefetcher.record_subs(['Hot', 'hot', 'missing', 'missing'])
+        self.prefetcher.record_subs(['warm', 'warm', 'cold'])
+        self.expiry.update({'hot': 5, 'warm': 50, 'cold': 5})
+
+        self.assertEqual(1, self.prefetcher.run_once())
+        self.prefetcher.refresh_subs.assert_called_once_with(['hot'])
+
+    def test_refresh_returning_users(self):
+        self.prefetcher.record_user('Frequent')
+        self.prefetcher.record_user('frequent')
+        self.prefetcher.record_user('once')
+
+        self.assertEqual(0, self.prefetcher.run_once())
+
+        # Only the most frequent user is refreshed before expiring
+        self.clock.now += 90
+        self.assertEqual(1, self.prefetcher.run_once())
+        self.prefetcher.refresh_user.assert_called_once_with('frequent')
+
+        self.assertEqual(0, self.prefetcher.run_once())
+
+    def test_refetched_users(self):
+        self.prefetcher.record_user('user')
+
+        # A later request fetched the activity again
+        self.clock.now += 50
+        self.prefetcher.record_user('user')
+        self.prefetcher.record_fetch('User')
+        self.prefetcher.record_fetch('untracked')
+
+        self.clock.now += 40
+        self.assertEqual(0, self.prefetcher.run_once())
+
+        self.clock.now += 50
+        self.assertEqual(1, self.prefetcher.run_once())
+        self.prefetcher.refresh_user.assert_called_once_with('user')
+
+    def test_busy(self):
+        self.prefetcher.record_subs(['hot'])
+        self.expiry['hot'] = 0
+        self.idle = False
+
+        self.assertEqual(0, self.prefetcher.run_once())
+        self.assertFalse(self.prefetcher.refresh_subs.called)
+
+
+if __name__ == '__main__':
+    unittest.main()
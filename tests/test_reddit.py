@@ -11,10 +11,41 @@
 # You should have received a copy of the GNU General Public License along with
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
-from unittest.mock import Mock, patch
+from collections import OrderedDict
+from unittest.mock import Mock, call, patch
 
-from subber import reddit
+import praw
+
+from subber import cache, fanout, graph, reddit, scheduler
+
+
+def sub_info(name):
+    return reddit.SubInfo(name, 'Title', 3, 8962, False, 'Description')
+
+
+def info_session():
+    """Return a mock session answering /api/info batches with a subreddit for
+    every name requested"""
+    def api_info(path, params):
+        return [Mock(display_name_prefixed='r/' + name, title='Title',
+                     created=892349754, subscribers=8962, over18=False,
+                     public_description='Description')
+                for name in params['sr_name'].split(',')]
+
+    session = Mock()
+    session.get.side_effect = api_info
+
+    return session
+
+
+def names(subs):
+    return [sub.name for sub in subs]
 
 
 class TestReddit(unittest.TestCase):
@@ -25,34 +56,183 @@ class TestReddit(unittest.TestCase):
                                       mock_similar_users):
         # Mock similar users
         similar_users = ['similar_user1', 'similar_user2', 'similar_user3']
-        mock_similar_users.return_value = similar_users
+        mock_similar_users.return_value = OrderedDict.fromkeys(similar_users,
+                                                               1.0)
 
-        # Mock active subs
+        # Mock active subs, the user is not active in any of them
         active_subs = ['r/active_sub1', 'r/active_sub2', 'r/active_sub3',
                        'r/active_sub4']
-        mock_active_subs.return_value = active_subs
-
-        # Mock sub info
-        sub = {'name': 'sub',
-               'title': 'title',
-               'age': 3,
-               'subscribers': 8692,
-               'over18': False,
-               'desc': 'desc'}
-
-        mock_sub_info.return_value = sub
+        mock_active_subs.side_effect = lambda session, u: (
+            [] if u == 'user' else active_subs)
 
         # Test results
+        session = info_session()
         user_param = 'user'
-        expected_result = [sub]
 
-        self.assertEqual(reddit.get_user_recommendations(None,
-                                                         user_param),
-                         expected_result)
+        self.assertEqual(names(reddit.get_user_recommendations(session,
+                                                               user_param)),
+                         active_subs)
+
+        mock_similar_users.assert_called_with(session, user_param)
+        mock_active_subs.assert_called_with(session, similar_users[-1])
+
+        # Sub info is fetched in a single batch
+        session.get.assert_called_once_with(
+            '/api/info', params={'sr_name': ','.join(s[2:]
+                                                     for s in active_subs)})
+        mock_sub_info.assert_not_called()
+
+    @patch('subber.reddit._get_similar_users')
+    @patch('subber.reddit._get_active_subs')
+    @patch('subber.reddit.get_sub_info')
+    def test_get_user_recommendations_concurrent(self, mock_sub_info,
+                                                 mock_active_subs,
+                                                 mock_similar_users):
+        mock_similar_users.return_value = OrderedDict.fromkeys(
+            ['user1', 'user2', 'user3'], 1.0)
+
+        # Mock active subs overlapping between users
+        active_subs = {'user': [],
+                       'user1': ['r/a', 'r/b'],
+                       'user2': ['r/b', 'r/c'],
+                       'user3': ['r/d', 'r/a']}
+        mock_active_subs.side_effect = lambda session, u: active_subs[u]
+
+        session = info_session()
+        serial = reddit.get_user_recommendations(session, 'user')
+
+        with patch('subber.reddit.executor', fanout.FanOut(workers=4)), \
+                patch('subber.reddit.SUB_BATCH_SIZE', 2):
+            concurrent = reddit.get_user_recommendations(session, 'user')
+
+        self.assertEqual(serial, concurrent)
+        self.assertEqual(['r/a', 'r/b', 'r/c', 'r/d'], names(concurrent))
+
+        # Sub info is fetched in one batch, then in two batches of two
+        self.assertEqual(3, session.get.call_count)
+        mock_sub_info.assert_not_called()
+
+    @patch('subber.reddit._get_similar_users')
+    @patch('subber.reddit._get_active_subs')
+    @patch('subber.reddit.get_sub_info')
+    def test_get_user_recommendations_ranked(self, mock_sub_info,
+                                             mock_active_subs,
+                                             mock_similar_users):
+        mock_similar_users.return_value = OrderedDict([('parent', 2.0),
+                                                       ('commenter1', 1.0),
+                                                       ('commenter2', 1.0)])
+
+        active_subs = {'user': ['r/mine'],
+                       'parent': ['r/a', 'r/mine'],
+                       'commenter1': ['r/b', 'r/c', 'r/c'],
+                       'commenter2': ['r/c', 'r/d']}
+        mock_active_subs.side_effect = lambda session, u: active_subs[u]
+        session = info_session()
+
+        with patch('subber.reddit.max_recommendations', 2):
+            result = reddit.get_user_recommendations(session, 'user')
+
+        # Metadata is only fetched for the top subs
+        self.assertEqual(['r/a', 'r/c'], names(result))
+        session.get.assert_called_once_with('/api/info',
+                                            params={'sr_name': 'a,c'})
+        mock_sub_info.assert_not_called()
+
+    @patch('subber.reddit._get_similar_users')
+    @patch('subber.reddit._get_active_subs')
+    @patch('subber.reddit.get_sub_info')
+    def test_get_user_recommendations_batch_fallback(self, mock_sub_info,
+                                                     mock_active_subs,
+                                                     mock_similar_users):
+        mock_similar_users.return_value = OrderedDict([('user1', 1.0)])
+        mock_active_subs.side_effect = lambda session, u: (
+            [] if u == 'user' else ['r/a', 'r/b'])
+        mock_sub_info.side_effect = lambda session, sub: sub_info(sub)
+
+        # The batch request fails
+        session = Mock()
+        session.get.side_effect = ValueError()
+
+        result = reddit.get_user_recommendations(session, 'user')
+
+        # Each sub of the failed batch is looked up on its own
+        self.assertEqual([sub_info('a'), sub_info('b')], result)
+        mock_sub_info.assert_has_calls([call(session, 'a'),
+                                        call(session, 'b')], any_order=True)
+
+    @patch('subber.reddit.sub_cache', None)
+    @patch('subber.reddit.SUB_BATCH_SIZE', 1)
+    @patch('subber.reddit._get_similar_users')
+    @patch('subber.reddit._get_active_subs')
+    def test_iter_user_recommendations_streams(self, mock_active_subs,
+                                               mock_similar_users):
+        mock_similar_users.return_value = OrderedDict([('user1', 1.0)])
+        mock_active_subs.side_effect = lambda session, u: (
+            [] if u == 'user' else ['r/first', 'r/last'])
+
+        release = threading.Event()
+        fetched = []
+
+        def api_info(path, params):
+            # The last batch is only answered once released
+            if params['sr_name'] == 'last':
+                release.wait(5)
 
-        mock_similar_users.assert_called_with(None, user_param)
-        mock_active_subs.assert_called_with(None, similar_users[-1])
-        mock_sub_info.assert_called_with(None, active_subs[-1][2:])
+            fetched.append(params['sr_name'])
+            return [Mock(display_name_prefixed='r/' + params['sr_name'],
+                         title='Title', created=892349754, subscribers=1,
+                         over18=False, public_description='Description')]
+
+        session = Mock()
+        session.get.side_effect = lambda path, params: api_info(path, params)
+
+        with patch('subber.reddit.executor', fanout.FanOut(workers=2)):
+            recommendations = reddit.iter_user_recommendations(session,
+                                                               'user')
+
+            # The first card is ready while the last batch is in flight
+            self.assertEqual('r/first', next(recommendations).name)
+            self.assertEqual(['first'], fetched)
+
+            release.set()
+            self.assertEqual(['r/last'],
+                             [s.name for s in recommendations])
+
+    @patch('subber.reddit._get_active_subs')
+    @patch('subber.reddit.get_sub_infos')
+    def test_get_fast_recommendations(self, mock_sub_infos, mock_active_subs):
+        mock_active_subs.return_value = ['r/python']
+        mock_sub_infos.return_value = OrderedDict(
+            [('linux', sub_info('r/linux')), ('vim', None)])
+
+        index = Mock()
+        index.recommend.return_value = [('r/linux', 1.0), ('r/vim', 0.5)]
+
+        with patch('subber.reddit.cooccurrence_index', index):
+            result = reddit.get_fast_recommendations(None, 'user')
+
+        self.assertEqual([sub_info('r/linux')], result)
+        index.recommend.assert_called_once_with(['r/python'],
+                                                reddit.max_recommendations)
+        mock_sub_infos.assert_called_once_with(None, ['linux', 'vim'])
+
+    @patch('subber.reddit.get_user_recommendations')
+    def test_get_fast_recommendations_fallback(self, mock_recommendations):
+        mock_recommendations.return_value = [sub_info('r/sub')]
+
+        self.assertEqual([sub_info('r/sub')],
+                         reddit.get_fast_recommendations(None, 'user'))
+
+    def test_top_subs(self):
+        scores = reddit._score_subs(['r/Mine'],
+                                    [(1.0, ['r/a', 'r/b']),
+                                     (2.0, ['r/b', 'r/mine']),
+                                     (1.0, ['r/c', 'r/a'])])
+
+        self.assertEqual(OrderedDict([('r/a', 2.0), ('r/b', 3.0),
+                                      ('r/c', 1.0)]), scores)
+        self.assertEqual(['r/b', 'r/a'], reddit._top_subs(scores, 2))
+        self.assertEqual(['r/b', 'r/a', 'r/c'], reddit._top_subs(scores, 5))
 
     @patch('subber.reddit._get_user_comments')
     @patch('subber.reddit._get_user_submissions')
@@ -62,17 +242,19 @@ class TestReddit(unittest.TestCase):
                                   'comment_author3', 'comment_author4',
                                   'comment_author5', 'comment_author6']
 
-        comments = []
-        for author in parent_comment_authors:
-            comment_author_obj = Mock()
-            comment_author_obj.author.name = author
+        def parent(fullname):
+            comment = Mock(fullname=fullname)
+            comment.author.name = parent_comment_authors[int(fullname[3:])]
 
-            comment = Mock()
-            comment.parent.return_value = comment_author_obj
+            return comment
 
-            comments.append(comment)
+        session = Mock()
+        session.info.side_effect = lambda fullnames: [parent(f)
+                                                      for f in fullnames]
 
-        mock_comments.return_value = comments
+        mock_comments.return_value = [
+            graph.Post('t1_c{}'.format(i), 'r/sub', 't1_{}'.format(i))
+            for i in range(len(parent_comment_authors))]
 
         # Mock submissions
         submission_comment_authors = ['user',
@@ -84,31 +266,165 @@ class TestReddit(unittest.TestCase):
                                       'submission_comment_author7',
                                       'submission_comment_author8']
 
-        submission_comments = []
-        for author in submission_comment_authors:
-            comment_author_obj = Mock()
-            comment_author_obj.author.name = author
-
-            submission_comments.append(comment_author_obj)
+        submission_comments = [
+            praw.models.Comment(None, _data={'id': author, 'author': author})
+            for author in submission_comment_authors]
 
-        submission_1 = Mock()
-        submission_1.comments = submission_comments[:5]
+        submissions = {'s1': Mock(comments=submission_comments[:5]),
+                       's2': Mock(comments=submission_comments[6:])}
+        session.submission.side_effect = lambda id: submissions[id]
 
-        submission_2 = Mock()
-        submission_2.comments = submission_comments[6:]
-
-        mock_submissions.return_value = [submission_1, submission_2]
+        mock_submissions.return_value = [graph.Post('t3_s1', 'r/sub', None),
+                                         graph.Post('t3_s2', 'r/sub', None)]
 
         # Test results
         expected_result = (parent_comment_authors[1:]) + \
                           (submission_comment_authors[6:7])
 
         user_param = 'user'
-        self.assertEqual(reddit._get_similar_users(None, user_param),
-                         expected_result)
+        similar_users = reddit._get_similar_users(session, user_param)
+        self.assertEqual(list(similar_users), expected_result)
 
-        mock_comments.assert_called_with(None, user_param)
-        mock_submissions.assert_called_with(None, user_param)
+        self.assertEqual(reddit.parent_weight,
+                         similar_users['comment_author2'])
+        self.assertEqual(reddit.commenter_weight,
+                         similar_users['submission_comment_author7'])
+
+        mock_comments.assert_called_with(session, user_param)
+        mock_submissions.assert_called_with(session, user_param)
+
+    @patch('subber.reddit._get_user_submissions')
+    def test_get_submission_commenters(self, mock_submissions):
+        mock_submissions.return_value = [graph.Post('t3_a', 'r/sub', None),
+                                         graph.Post('t3_b', 'r/sub', None),
+                                         graph.Post('t3_c', 'r/sub', None)]
+
+        def comment(author):
+            return praw.models.Comment(None, _data={'id': author,
+                                                    'author': author})
+
+        more = praw.models.MoreComments(None, {'count': 2, 'children': [],
+                                               'parent_id': 't3_a',
+                                               'id': 'more'})
+
+        def submission(id):
+            if id == 'b':
+                raise RuntimeError('Submission is deleted')
+
+            return Mock(comments={'a': [comment('x'), more,
+                                        comment('[deleted]')],
+                                  'c': [comment('y')]}[id])
+
+        session = Mock()
+        session.submission.side_effect = submission
+
+        # Placeholders, deleted authors and deleted submissions are skipped
+        # without losing the other submissions
+        self.assertEqual(['x', 'y'],
+                         reddit._get_submission_commenters.__wrapped__(
+                             session, 'user'))
+
+    @patch('subber.reddit._get_parent_authors')
+    @patch('subber.reddit._get_submission_commenters')
+    def test_get_similar_users_deep(self, mock_commenters, mock_parents):
+        parents = {'user': ['a', 'b'], 'a': ['c', 'User'], 'b': ['c'],
+                   'c': ['d']}
+        mock_parents.side_effect = lambda session, u: parents.get(u, [])
+        mock_commenters.return_value = []
+
+        with patch('subber.reddit.crawl_depth', 2):
+            similar_users = reddit._get_similar_users(None, 'user')
+
+        # Second hop connections are decayed and the user is never similar
+        self.assertEqual(OrderedDict([('a', 2.0), ('b', 2.0), ('c', 2.0)]),
+                         similar_users)
+
+        with patch('subber.reddit.crawl_depth', 3), \
+                patch('subber.reddit.max_neighbors', 2):
+            similar_users = reddit._get_similar_users(None, 'user')
+
+        self.assertEqual(['a', 'b'], list(similar_users))
+        mock_parents.assert_any_call(None, 'c')
+
+    def test_add_connections_strongest_frontier(self):
+        similar_users = OrderedDict()
+
+        # The weakest connection is found first
+        connections = [(1, ['weak']), (1, ['strong', 'strong']),
+                       (1, ['middle']), (1, ['middle'])]
+
+        with patch('subber.reddit.max_neighbors', 2):
+            frontier = reddit._add_connections(similar_users, 'user',
+                                               connections, 0)
+            kept = reddit._strongest(similar_users)
+
+        self.assertEqual(['strong', 'middle'], frontier)
+        self.assertEqual(set(frontier), set(kept))
+
+    def test_crawl_budget(self):
+        now = [0]
+        budget = reddit.CrawlBudget(seconds=10, calls=2,
+                                    clock=lambda: now[0])
+
+        with reddit._crawl_budget(budget):
+            reddit._request(None, scheduler.LISTING, lambda: None)
+            reddit._request(None, scheduler.LISTING, lambda: None)
+
+            # Metadata requests are outside the crawl budget
+            reddit._request(None, scheduler.METADATA, lambda: None)
+
+            self.assertRaises(reddit.BudgetExceeded, reddit._request, None,
+                              scheduler.LISTING, lambda: None)
+
+        self.assertEqual(2, budget.calls)
+
+        budget = reddit.CrawlBudget(seconds=10, clock=lambda: now[0])
+        self.assertFalse(budget.exhausted())
+        now[0] = 10
+        self.assertTrue(budget.exhausted())
+
+    @patch('subber.reddit._get_similar_users')
+    @patch('subber.reddit._get_active_subs')
+    @patch('subber.reddit.get_sub_info')
+    def test_get_user_recommendations_budget(self, mock_sub_info,
+                                             mock_active_subs,
+                                             mock_similar_users):
+        mock_similar_users.return_value = OrderedDict([('weak', 1.0),
+                                                       ('strong', 2.0)])
+
+        def active_subs(session, u):
+            # Each lookup spends one request
+            reddit._request(session, scheduler.LISTING, lambda: None)
+            return {'user': [], 'weak': ['r/weak'], 'strong': ['r/strong']}[u]
+
+        mock_active_subs.side_effect = active_subs
+
+        with patch('subber.reddit.crawl_calls', 2):
+            result = reddit.get_user_recommendations(info_session(), 'user')
+
+        # The strongest connection is crawled before the budget runs out
+        self.assertEqual(['r/strong'], names(result))
+        mock_sub_info.assert_not_called()
+
+    @patch('subber.reddit._get_similar_users')
+    @patch('subber.reddit._get_active_subs')
+    def test_get_user_recommendations_own_subs_budget(self, mock_active_subs,
+                                                      mock_similar_users):
+        mock_similar_users.return_value = OrderedDict([('similar', 1.0)])
+
+        def active_subs(session, u):
+            if u == 'user':
+                raise reddit.BudgetExceeded()
+
+            return ['r/mine', 'r/other']
+
+        mock_active_subs.side_effect = active_subs
+        session = info_session()
+
+        # Subs the user is active in can't be left out, so none are
+        # recommended
+        self.assertEqual([], reddit.get_user_recommendations(session, 'user'))
+        session.get.assert_not_called()
 
     @patch('subber.reddit._get_user_comments')
     @patch('subber.reddit._get_user_submissions')
@@ -130,7 +446,8 @@ class TestReddit(unittest.TestCase):
         submission_subs = ['r/sub', 'r/AskReddit']
         mock_submissions.return_value = mock_post_sub_names(submission_subs)
 
-        expected_result = comment_subs + submission_subs
+        # Subs of both listings are merged without repeats
+        expected_result = ['r/sub', 'r/subreddit', 'r/AskReddit']
 
         # Test results
         user_param = 'user'
@@ -140,6 +457,49 @@ class TestReddit(unittest.TestCase):
         mock_comments.assert_called_with(None, user_param)
         mock_submissions.assert_called_with(None, user_param)
 
+    @patch('subber.reddit._get_user_comments')
+    @patch('subber.reddit._get_user_submissions')
+    def test_get_active_subs_cached(self, mock_submissions, mock_comments):
+        mock_comments.return_value = [Mock(subreddit_name_prefixed='r/sub')]
+        mock_submissions.return_value = []
+
+        prefetcher = Mock()
+
+        with patch('subber.reddit.activity_backend', cache.MemoryBackend()), \
+                patch('subber.reddit.prefetcher', prefetcher):
+            first = reddit._get_active_subs(None, 'user')
+            second = reddit._get_active_subs(None, 'User')
+
+        self.assertEqual(['r/sub'], first)
+        self.assertEqual(first, second)
+        mock_comments.assert_called_once_with(None, 'user')
+
+        # Only the fetch postpones prefetching the user
+        prefetcher.record_fetch.assert_called_once_with('user')
+
+    @patch('subber.reddit.activity_backend', None)
+    def test_listing_memo(self):
+        session = Mock()
+        comments = session.redditor.return_value.comments
+        comments.new.side_effect = lambda limit: iter(
+            [Mock(fullname='t1_a', subreddit_name_prefixed='r/sub',
+                  parent_id='t3_b')])
+        session.redditor.return_value.submissions.top.return_value = iter(
+            [])
+        session.info.return_value = []
+
+        with reddit._listing_memo():
+            reddit._get_parent_authors(session, 'user')
+            subs = reddit._get_active_subs(session, 'User')
+
+        # Both stages read the comments fetched once
+        self.assertEqual(['r/sub'], subs)
+        self.assertEqual(1, comments.new.call_count)
+
+        # Outside a request listings are fetched again
+        reddit._get_user_comments(session, 'user')
+        self.assertEqual(2, comments.new.call_count)
+
     @patch('praw.Reddit')
     @patch('subber.util.utc_epoch_sec_to_years')
     def test_get_sub_info(self, mock_years, mock_session):
@@ -157,12 +517,13 @@ class TestReddit(unittest.TestCase):
         mock_session.subreddit.return_value = subreddit
 
         # Test results
-        expected_result = {'name': subreddit.display_name_prefixed,
-                           'title': subreddit.title,
-                           'age': 3,
-                           'subscribers': subreddit.subscribers,
-                           'over18': subreddit.over18,
-                           'desc': subreddit.public_description}
+        expected_result = reddit.SubInfo(
+            name=subreddit.display_name_prefixed,
+            title=subreddit.title,
+            age=3,
+            subscribers=subreddit.subscribers,
+            over18=subreddit.over18,
+            desc=subreddit.public_description)
 
         sub_param = 'subreddit'
         self.assertEqual(reddit.get_sub_info(mock_session, sub_param),
@@ -171,6 +532,416 @@ class TestReddit(unittest.TestCase):
         mock_years.assert_called_with(subreddit.created)
         mock_session.subreddit.assert_called_with(sub_param)
 
+    @patch('praw.Reddit')
+    @patch('subber.util.utc_epoch_sec_to_years')
+    def test_get_sub_info_cached(self, mock_years, mock_session):
+        mock_years.return_value = 3
+
+        subreddit = Mock(display_name_prefixed='r/subreddit',
+                         title='Title',
+                         created=892349754,
+                         subscribers=8962,
+                         over18=False,
+                         public_description='Description')
+
+        mock_session.subreddit.return_value = subreddit
+
+        with patch('subber.reddit.sub_cache', cache.SubInfoCache()):
+            first = reddit.get_sub_info(mock_session, 'subreddit')
+            second = reddit.get_sub_info(mock_session, 'subreddit')
+
+            self.assertEqual(1, reddit.sub_cache.hits)
+
+        self.assertEqual(first, second)
+        mock_session.subreddit.assert_called_once_with('subreddit')
+
+    @patch('subber.reddit.get_sub_info')
+    @patch('subber.util.utc_epoch_sec_to_years')
+    def test_get_sub_infos(self, mock_years, mock_sub_info):
+        mock_years.return_value = 3
+        mock_sub_info.return_value = None
+
+        def subreddit(name):
+            return Mock(display_name_prefixed='r/' + name,
+                        title='Title',
+                        created=892349754,
+                        subscribers=8962,
+                        over18=False,
+                        public_description='Description')
+
+        # Batch lookup finds every sub but missing
+        session = Mock()
+        session.get.return_value = [subreddit('Sub1'), subreddit('sub3')]
+
+        sub_cache = cache.SubInfoCache()
+        sub_cache.set('sub2', {f: getattr(subreddit('sub2'), f)
+                               for f in cache.SUB_FIELDS})
+
+        with patch('subber.reddit.sub_cache', sub_cache):
+            result = reddit.get_sub_infos(session, ['sub1', 'sub2',
+                                                    'sub3', 'missing'])
+
+        self.assertEqual(['sub1', 'sub2', 'sub3', 'missing'], list(result))
+        self.assertEqual('r/Sub1', result['sub1'].name)
+        self.assertEqual('r/sub2', result['sub2'].name)
+        self.assertEqual(3, result['sub3'].age)
+        self.assertIsNone(result['missing'])
+
+        # Cached subs are not requested, missing subs are retried alone
+        session.get.assert_called_once_with(
+            '/api/info', params={'sr_name': 'sub1,sub3,missing'})
+        mock_sub_info.assert_called_once_with(session, 'missing')
+
+        # Batch results are cached
+        self.assertIsNotNone(sub_cache.get('sub3'))
+
+    def test_single_flight(self):
+        flights = reddit.SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return ['r/sub']
+
+        results = []
+        leader = threading.Thread(
+            target=lambda: results.append(flights.do('key', fetch)))
+        leader.start()
+        started.wait(5)
+
+        followers = [threading.Thread(
+            target=lambda: results.append(flights.do('key', fetch)))
+            for i in range(3)]
+        for follower in followers:
+            follower.start()
+
+        # Wait for followers to attach to the call in flight
+        deadline = time.time() + 5
+        while flights.coalesced < 3 and time.time() < deadline:
+            time.sleep(0.01)
+
+        release.set()
+        for thread in [leader] + followers:
+            thread.join(5)
+
+        self.assertEqual([['r/sub']] * 4, results)
+        self.assertEqual(1, len(calls))
+        self.assertEqual({'calls': 1, 'coalesced': 3, 'in_flight': 0},
+                         flights.stats())
+
+        # Later calls are made again
+        release.set()
+        flights.do('key', fetch)
+        self.assertEqual(2, len(calls))
+
+    @patch('subber.reddit.flights', reddit.SingleFlight())
+    def test_coalesced_listing_budget(self):
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def comments(limit):
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return [Mock(fullname='t1_a', parent_id='t3_a')]
+
+        session = Mock()
+        session.redditor.return_value.comments.new.side_effect = comments
+
+        budgets = [reddit.CrawlBudget(calls=5) for i in range(2)]
+        results = []
+
+        def crawl(budget):
+            with reddit._crawl_budget(budget):
+                results.append(reddit._get_user_comments(session, 'user'))
+
+        leader = threading.Thread(target=crawl, args=(budgets[0],))
+        leader.start()
+        started.wait(5)
+
+        follower = threading.Thread(target=crawl, args=(budgets[1],))
+        follower.start()
+
+        deadline = time.time() + 5
+        while reddit.flights.coalesced < 1 and time.time() < deadline:
+            time.sleep(0.01)
+
+        release.set()
+        for thread in (leader, follower):
+            thread.join(5)
+
+        # Each caller is charged for the shared request
+        self.assertEqual(1, len(calls))
+        self.assertEqual(2, len(results))
+        self.assertEqual([1, 1], [b.calls for b in budgets])
+
+        # An exhausted budget is raised to the caller, not logged
+        with reddit._crawl_budget(reddit.CrawlBudget(calls=1)) as budget:
+            budget.charge()
+            self.assertRaises(reddit.BudgetExceeded,
+                              reddit._get_user_comments, session, 'user')
+            self.assertRaises(reddit.BudgetExceeded,
+                              reddit._get_user_submissions, session, 'user')
+
+        self.assertEqual(1, len(calls))
+
+    def test_single_flight_exception(self):
+        def fail():
+            raise ValueError()
+
+        flights = reddit.SingleFlight()
+        self.assertRaises(ValueError, flights.do, 'key', fail)
+        self.assertEqual(0, flights.stats()['in_flight'])
+
+    def test_request_scheduled(self):
+        session = Mock()
+        session._core._rate_limiter.remaining = 10
+        session._core._rate_limiter.reset_timestamp = time.time() + 100
+
+        api_scheduler = scheduler.Scheduler(scheduler.TokenBucket())
+
+        with patch('subber.reddit.api_scheduler', api_scheduler):
+            result = reddit._request(session, scheduler.METADATA,
+                                     lambda: 'result')
+
+        self.assertEqual('result', result)
+        self.assertEqual(1, api_scheduler.dispatched[scheduler.METADATA])
+
+        # Budget follows the rate limit headers
+        self.assertAlmostEqual(0.1, api_scheduler.bucket.rate, places=2)
+
+    @patch('subber.reddit.Reddit')
+    def test_lazy_session(self, mock_reddit):
+        verified = threading.Event()
+        mock_reddit.return_value.verify.side_effect = verified.set
+
+        session = reddit.LazySession(
+            lambda: reddit.Reddit('id', 'secret', 'password', 'user'))
+        self.assertFalse(mock_reddit.called)
+
+        session.redditor('user')
+        session.redditor('other')
+
+        self.assertTrue(verified.wait(1))
+        mock_reddit.assert_called_once_with('id', 'secret', 'password',
+                                            'user')
+        self.assertEqual(2, mock_reddit.return_value.get_session.return_value
+                         .redditor.call_count)
+
+    def test_lazy_session_rejected(self):
+        client = Mock()
+        client.verify.side_effect = RuntimeError('Bad credentials')
+
+        session = reddit.LazySession(lambda: client)
+        session._verify(client)
+
+        with self.assertRaises(RuntimeError):
+            session.redditor('user')
+
+    def test_prefetch_user(self):
+        session = Mock()
+        session._core._rate_limiter.remaining = None
+        session.redditor.return_value.comments.new.return_value = iter(
+            [Mock(subreddit_name_prefixed='r/sub')])
+        session.redditor.return_value.submissions.top.return_value = iter(
+            [])
+
+        backend = cache.MemoryBackend()
+        api_scheduler = scheduler.Scheduler(scheduler.TokenBucket())
+
+        with patch('subber.reddit.activity_backend', backend), \
+                patch('subber.reddit.api_scheduler', api_scheduler), \
+                patch('subber.reddit._get_parent_authors'), \
+                patch('subber.reddit._get_submission_commenters'):
+            reddit.prefetch_user(session, 'User')
+
+        self.assertEqual(['r/sub'], backend.get(
+            'active_subs:{}:user'.format(reddit.listing_limit)))
+        self.assertEqual(2, api_scheduler.dispatched[scheduler.BACKGROUND])
+        self.assertEqual(0, api_scheduler.dispatched[scheduler.LISTING])
+
+    def test_get_user_comments(self):
+        session = Mock()
+        session.redditor.return_value.comments.new.return_value = iter(
+            [Mock(fullname='t1_a', subreddit_name_prefixed='r/sub',
+                  parent_id='t3_b')])
+
+        # Only the fields the pipeline reads are kept
+        self.assertEqual([graph.Post('t1_a', 'r/sub', 't3_b')],
+                         reddit._get_user_comments(session, 'user'))
+        session.redditor.assert_called_with('user')
+
+    def test_get_user_comments_stored(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        now = [1000.0]
+        store = graph.GraphStore(os.path.join(tmp, 'graph.db'),
+                                 clock=lambda: now[0])
+
+        def comment(name, created):
+            return Mock(fullname=name, subreddit_name_prefixed='r/sub',
+                        parent_id='t3_' + name, created_utc=created)
+
+        session = Mock()
+        new = session.redditor.return_value.comments.new
+        new.return_value = iter([comment('t1_b', 2), comment('t1_a', 1)])
+
+        with patch('subber.reddit.graph_store', store):
+            first = reddit._get_user_comments(session, 'user')
+
+            # Fresh listings are read from the store
+            self.assertEqual(first, reddit._get_user_comments(session, 'user'))
+            self.assertEqual(1, new.call_count)
+
+            # Stale listings only fetch newer comments
+            now[0] += reddit.graph_ttl
+            new.return_value = iter([comment('t1_c', 3)])
+            second = reddit._get_user_comments(session, 'user')
+
+        self.assertEqual(['t1_b', 't1_a'], [c.fullname for c in first])
+        self.assertEqual(['t1_c', 't1_b', 't1_a'],
+                         [c.fullname for c in second])
+        new.assert_called_with(limit=reddit.listing_limit,
+                               params={'before': 't1_b'})
+
+        # A full page of newer comments replaces the listing from the top
+        with patch('subber.reddit.graph_store', store), \
+                patch('subber.reddit.listing_limit', 2):
+            now[0] += reddit.graph_ttl
+            new.side_effect = [iter([comment('t1_e', 5), comment('t1_d', 4)]),
+                               iter([comment('t1_f', 6), comment('t1_e', 5)])]
+            third = reddit._get_user_comments(session, 'user')
+
+        self.assertEqual(['t1_f', 't1_e'], [c.fullname for c in third])
+        new.assert_has_calls([call(limit=2, params={'before': 't1_c'}),
+                              call(limit=2)])
+
+        # The refetch is charged on its own, and the stored listing is kept
+        # if the budget doesn't cover it
+        with patch('subber.reddit.graph_store', store), \
+                patch('subber.reddit.listing_limit', 2), \
+                reddit._crawl_budget(reddit.CrawlBudget(calls=1)) as budget:
+            now[0] += reddit.graph_ttl
+            new.side_effect = [iter([comment('t1_h', 8), comment('t1_g', 7)])]
+            fourth = reddit._get_user_comments(session, 'user')
+
+        self.assertEqual(1, budget.calls)
+        self.assertEqual(third, fourth)
+
+    @patch('subber.reddit._get_user_comments')
+    def test_get_parent_authors(self, mock_comments):
+        mock_comments.return_value = [graph.Post('t1_a', 'r/sub', 't3_x'),
+                                      graph.Post('t1_b', 'r/sub', 't1_y'),
+                                      graph.Post('t1_c', 'r/sub', 't1_z'),
+                                      graph.Post('t1_d', 'r/sub', 't3_x')]
+
+        def parent(fullname, author):
+            post = Mock(fullname=fullname)
+            post.author.name = author
+
+            return post
+
+        # The parent of b is deleted and the parent of c is missing
+        session = Mock()
+        session.info.return_value = [parent('t3_x', 'op'),
+                                     Mock(fullname='t1_y', author=None)]
+
+        with patch('subber.reddit.SUB_BATCH_SIZE', 2):
+            authors = reddit._get_parent_authors.__wrapped__(session, 'user')
+
+        # Every comment is kept past a deleted parent, and parents are
+        # looked up once each in batches
+        self.assertEqual(['op', 'op'], authors)
+        session.info.assert_has_calls([call(['t3_x', 't1_y']),
+                                       call(['t1_z'])])
+
+    @patch('subber.reddit._get_user_comments')
+    def test_get_parent_authors_stored(self, mock_comments):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        store = graph.GraphStore(os.path.join(tmp, 'graph.db'))
+
+        mock_comments.return_value = [graph.Post('t1_a', 'r/sub', 't3_x'),
+                                      graph.Post('t1_b', 'r/sub', 't1_y')]
+        store.add_posts('user', 'comments',
+                        [(post, i) for i, post in
+                         enumerate(mock_comments.return_value)], 't1_a')
+
+        op = Mock(fullname='t3_x')
+        op.author.name = 'op'
+
+        # The reply's parent comment is deleted
+        session = Mock()
+        session.info.return_value = [op, Mock(fullname='t1_y', author=None)]
+
+        with patch('subber.reddit.graph_store', store):
+            first = reddit._get_parent_authors.__wrapped__(session, 'user')
+            second = reddit._get_parent_authors.__wrapped__(session, 'user')
+
+        self.assertEqual(['op'], first)
+        self.assertEqual(first, second)
+        session.info.assert_called_once_with(['t3_x', 't1_y'])
+
+    @patch('subber.reddit._get_user_submissions')
+    def test_get_submission_commenters_stale(self, mock_submissions):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        now = [1000.0]
+        store = graph.GraphStore(os.path.join(tmp, 'graph.db'),
+                                 clock=lambda: now[0])
+
+        mock_submissions.return_value = [graph.Post('t3_a', 'r/sub', None)]
+
+        def commenter(name):
+            return praw.models.Comment(None, _data={'id': name,
+                                                    'author': name})
+
+        session = Mock()
+        session.submission.return_value.comments = [commenter('first')]
+        commenters = reddit._get_submission_commenters.__wrapped__
+
+        with patch('subber.reddit.graph_store', store):
+            first = commenters(session, 'user')
+
+            # Fresh edges are read from the store
+            session.submission.return_value.comments = [commenter('second')]
+            self.assertEqual(first, commenters(session, 'user'))
+
+            # Stale edges are fetched again
+            now[0] += reddit.graph_ttl
+            second = commenters(session, 'user')
+
+        self.assertEqual(['first'], first)
+        self.assertEqual(['second'], second)
+        self.assertEqual(2, session.submission.call_count)
+
+    @patch('subber.reddit._get_user_comments')
+    def test_get_parent_authors_stale(self, mock_comments):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        now = [1000.0]
+        store = graph.GraphStore(os.path.join(tmp, 'graph.db'),
+                                 clock=lambda: now[0])
+
+        mock_comments.return_value = [graph.Post('t1_a', 'r/sub', 't3_x')]
+        store.add_edges('user', {'t1_a': ['op']})
+
+        # Stale edges are kept when their lookup fails
+        now[0] += reddit.graph_ttl
+        session = Mock()
+        session.info.side_effect = ValueError()
+
+        with patch('subber.reddit.graph_store', store):
+            authors = reddit._get_parent_authors.__wrapped__(session, 'user')
+
+        self.assertEqual(['op'], authors)
+        session.info.assert_called_once_with(['t3_x'])
+
 
 if __name__ == '__main__':
     unittest.main()
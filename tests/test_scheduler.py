@@ -0,0 +1,236 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import unittest
+
+from subber import scheduler
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class StubAPI(object):
+    """Records the order requests reach Reddit"""
+
+    def __init__(self):
+        self.requests = []
+
+    def get(self, path):
+        self.requests.append(path)
+        return path
+
+
+class TestTokenBucket(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.bucket = scheduler.TokenBucket(rate=1.0, capacity=2,
+                                            clock=self.clock)
+
+    def test_take(self):
+        self.assertTrue(self.bucket.take())
+        self.assertTrue(self.bucket.take())
+        self.assertFalse(self.bucket.take())
+        self.assertEqual(1.0, self.bucket.wait_time())
+
+        self.clock.now += 1
+        self.assertTrue(self.bucket.take())
+
+    def test_update_from_headers(self):
+        # 10 requests left with 100 seconds until the window resets
+        self.bucket.update(10, 100)
+
+        self.assertEqual(0.1, self.bucket.rate)
+        self.assertEqual(2, self.bucket.tokens)
+
+        self.bucket.update(0, 100)
+        self.assertFalse(self.bucket.take())
+
+    def test_give_within_capacity(self):
+        self.bucket.give()
+        self.assertEqual(2, self.bucket.tokens)
+
+        self.assertTrue(self.bucket.take())
+        self.bucket.give()
+        self.assertEqual(2, self.bucket.tokens)
+
+    def test_update_window_reset(self):
+        bucket_scheduler = scheduler.Scheduler(self.bucket, max_wait=5,
+                                               clock=self.clock)
+
+        # No requests left until the window resets in 100 seconds
+        bucket_scheduler.update(0, 100)
+        self.assertRaises(scheduler.RateLimited, bucket_scheduler.run,
+                          scheduler.LISTING, lambda: None)
+
+        self.clock.now += 100
+
+        # The configured budget is restored once the window resets
+        self.assertEqual('ok', bucket_scheduler.run(scheduler.LISTING,
+                                                    lambda: 'ok'))
+        self.assertEqual(1.0, self.bucket.rate)
+        self.assertTrue(self.bucket.take())
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.api = StubAPI()
+        self.scheduler = scheduler.Scheduler(
+            scheduler.TokenBucket(rate=1.0, capacity=1, clock=self.clock),
+            max_wait=5, max_queue=3, clock=self.clock, dispatcher=False)
+
+    def test_priority_lanes(self):
+        # Use up the budget so requests queue
+        self.scheduler.run(scheduler.LISTING, self.api.get, '/first')
+
+        metadata = self.scheduler.acquire(scheduler.METADATA)
+        listing = self.scheduler.acquire(scheduler.LISTING)
+
+        self.assertEqual(0, self.scheduler.dispatch())
+
+        self.clock.now += 1
+        self.assertEqual(1, self.scheduler.dispatch())
+        self.assertTrue(listing.done())
+        self.assertFalse(metadata.done())
+
+        self.clock.now += 1
+        self.scheduler.dispatch()
+        self.assertTrue(metadata.done())
+
+    def test_shed_over_budget(self):
+        self.scheduler.max_wait = 3
+        self.scheduler.run(scheduler.LISTING, self.api.get, '/first')
+
+        # A fourth queued request would wait longer than max_wait, so it
+        # is shed without waiting
+        for i in range(3):
+            self.scheduler.acquire(scheduler.LISTING)
+
+        self.assertRaises(scheduler.RateLimited, self.scheduler.run,
+                          scheduler.METADATA, self.api.get, '/')
+        self.assertEqual(1, self.scheduler.stats()['shed'][
+            scheduler.METADATA])
+        self.assertEqual(['/first'], self.api.requests)
+
+    def test_shed_full_queue(self):
+        self.scheduler.max_wait = 100
+        self.scheduler.run(scheduler.LISTING, self.api.get, '/first')
+
+        for i in range(3):
+            self.scheduler.acquire(scheduler.BACKGROUND)
+
+        self.assertRaises(scheduler.RateLimited, self.scheduler.acquire,
+                          scheduler.BACKGROUND)
+
+        # Other lanes still accept requests
+        self.scheduler.acquire(scheduler.LISTING)
+
+    def test_shed_on_update(self):
+        self.scheduler.run(scheduler.LISTING, self.api.get, '/first')
+        first = self.scheduler.acquire(scheduler.LISTING)
+        second = self.scheduler.acquire(scheduler.METADATA)
+
+        # Only one more request fits before the window resets
+        self.scheduler.update(1, 4)
+
+        self.assertFalse(first.done())
+        self.assertRaises(scheduler.RateLimited, second.result, 0)
+        self.assertEqual(1, self.scheduler.stats()['shed'][
+            scheduler.METADATA])
+
+    def test_idle(self):
+        self.assertTrue(self.scheduler.idle(reserve=0))
+        self.assertFalse(self.scheduler.idle(reserve=1))
+
+        self.scheduler.run(scheduler.LISTING, self.api.get, '/first')
+        self.scheduler.acquire(scheduler.LISTING)
+
+        # Waiting requests keep the scheduler busy
+        self.clock.now += 10
+        self.assertFalse(self.scheduler.idle(reserve=0))
+
+        self.scheduler.dispatch()
+        self.clock.now += 1
+        self.assertTrue(self.scheduler.idle(reserve=0))
+
+    def test_cancelled_request(self):
+        self.scheduler.run(scheduler.LISTING, self.api.get, '/first')
+
+        future = self.scheduler.acquire(scheduler.LISTING)
+        future.cancel()
+
+        self.clock.now += 1
+        self.assertEqual(0, self.scheduler.dispatch())
+
+        # The token is still available
+        self.scheduler.run(scheduler.LISTING, self.api.get, '/second')
+        self.assertEqual(['/first', '/second'], self.api.requests)
+
+    def test_runs_on_calling_thread(self):
+        api_scheduler = scheduler.Scheduler(
+            scheduler.TokenBucket(rate=50.0, capacity=1), max_wait=5)
+        self.addCleanup(api_scheduler.stop)
+
+        release = threading.Event()
+        threads = {}
+
+        def call(name):
+            threads[name] = threading.current_thread()
+
+            # A slow call doesn't hold up calls queued behind it
+            if name == 'slow':
+                release.wait(5)
+
+        slow = threading.Thread(target=api_scheduler.run,
+                                args=(scheduler.BACKGROUND, call, 'slow'))
+        slow.start()
+
+        callers = [threading.Thread(target=api_scheduler.run,
+                                    args=(scheduler.LISTING, call, i))
+                   for i in range(3)]
+        for caller in callers:
+            caller.start()
+        for caller in callers:
+            caller.join(5)
+
+        self.assertFalse(release.is_set())
+        release.set()
+        slow.join(5)
+
+        for i, caller in enumerate(callers):
+            self.assertIs(caller, threads[i])
+        self.assertIs(slow, threads['slow'])
+        self.assertEqual(4, sum(api_scheduler.stats()['dispatched']
+                                .values()))
+
+    def test_try_acquire(self):
+        self.assertEqual(0, self.scheduler.try_acquire(scheduler.LISTING))
+        self.assertEqual(1.0, self.scheduler.try_acquire(scheduler.LISTING))
+
+        self.clock.now += 1
+        self.assertEqual(0, self.scheduler.try_acquire(scheduler.LISTING))
+
+        # Give up once the wait exceeds the scheduler's max wait
+        self.scheduler.update(0, 100)
+        with self.assertRaises(scheduler.RateLimited):
+            self.scheduler.try_acquire(scheduler.LISTING)
+
+
+if __name__ == '__main__':
+    unittest.main()
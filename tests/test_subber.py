@@ -11,11 +11,42 @@
 # You should have received a copy of the GNU General Public License along with
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import time
 import unittest
-from unittest.mock import patch
+from unittest.mock import Mock, patch
 
 import flask_testing
 
+from subber import config, reddit
+
+log_dir = None
+log_file = None
+
+
+def setUpModule():
+    global log_dir, log_file
+
+    # Apps created by the tests log to a temporary directory rather than
+    # the working directory
+    log_dir = tempfile.mkdtemp()
+    log_file = patch.dict(config.defaults,
+                          log_file=os.path.join(log_dir, 'subber.log'))
+    log_file.start()
+
+
+def tearDownModule():
+    log_file.stop()
+    shutil.rmtree(log_dir)
+
+
+def sub_info(name):
+    return reddit.SubInfo(name, 'sub', 3, 8692, False, 'a desc')
+
 
 class TestSubber(flask_testing.TestCase):
 
@@ -29,7 +60,8 @@ class TestSubber(flask_testing.TestCase):
 
         from subber import subber
 
-        return subber.app
+        # Start each test without pages cached by earlier ones
+        return subber.create_app()
 
     def test_get_form(self):
         self.client.get('/')
@@ -41,12 +73,7 @@ class TestSubber(flask_testing.TestCase):
                                      mock_session,
                                      mock_recommendations):
         # Mock sub recommendations
-        mock_recommendations.return_value = [{'name': 'r/test',
-                                              'title': 'sub',
-                                              'age': 3,
-                                              'subscribers': 8692,
-                                              'over18': False,
-                                              'desc': 'a desc'}]
+        mock_recommendations.return_value = [sub_info('r/test')]
 
         # Submit username
         form_data = {'username': 'test_username'}
@@ -57,17 +84,17 @@ class TestSubber(flask_testing.TestCase):
         self.assert_template_used('results.html')
 
         for sub in mock_recommendations():
-            assert sub['name'].encode('utf-8') in test_result.data
-            assert sub['title'].encode('utf-8') in test_result.data
+            assert sub.name.encode('utf-8') in test_result.data
+            assert sub.title.encode('utf-8') in test_result.data
 
             assert 'Community for {} years'.format(
-                    sub['age']).encode('utf-8') in test_result.data
+                    sub.age).encode('utf-8') in test_result.data
 
             assert '{:,} subscribers'.format(
-                    sub['subscribers']).encode('utf-8') in test_result.data
+                    sub.subscribers).encode('utf-8') in test_result.data
 
             assert 'Over 18 community'.encode('utf-8') not in test_result.data
-            assert sub['desc'].encode('utf-8') in test_result.data
+            assert sub.desc.encode('utf-8') in test_result.data
 
     @patch('subber.reddit.get_user_recommendations')
     @patch('subber.subber.session')
@@ -75,12 +102,8 @@ class TestSubber(flask_testing.TestCase):
                                                         mock_session,
                                                         mock_recommendations):
         # Mock sub recommendations
-        mock_recommendations.return_value = [{'name': 'r/test',
-                                              'title': 'sub',
-                                              'age': 0,
-                                              'subscribers': 8692,
-                                              'over18': False,
-                                              'desc': 'a desc'}]
+        mock_recommendations.return_value = [
+            sub_info('r/test')._replace(age=0)]
 
         # Submit username
         form_data = {'username': 'test_username'}
@@ -91,17 +114,17 @@ class TestSubber(flask_testing.TestCase):
         self.assert_template_used('results.html')
 
         for sub in mock_recommendations():
-            assert sub['name'].encode('utf-8') in test_result.data
-            assert sub['title'].encode('utf-8') in test_result.data
+            assert sub.name.encode('utf-8') in test_result.data
+            assert sub.title.encode('utf-8') in test_result.data
 
             assert 'Community for less than one year'.encode(
                    'utf-8') in test_result.data
 
             assert '{:,} subscribers'.format(
-                    sub['subscribers']).encode('utf-8') in test_result.data
+                    sub.subscribers).encode('utf-8') in test_result.data
 
             assert 'Over 18 community'.encode('utf-8') not in test_result.data
-            assert sub['desc'].encode('utf-8') in test_result.data
+            assert sub.desc.encode('utf-8') in test_result.data
 
     @patch('subber.reddit.get_user_recommendations')
     @patch('subber.subber.session')
@@ -109,12 +132,8 @@ class TestSubber(flask_testing.TestCase):
                                              mock_session,
                                              mock_recommendations):
         # Mock sub recommendations
-        mock_recommendations.return_value = [{'name': 'r/test',
-                                              'title': 'sub',
-                                              'age': 3,
-                                              'subscribers': 8692,
-                                              'over18': True,
-                                              'desc': 'a desc'}]
+        mock_recommendations.return_value = [
+            sub_info('r/test')._replace(over18=True)]
 
         # Submit username
         form_data = {'username': 'test_username'}
@@ -125,17 +144,480 @@ class TestSubber(flask_testing.TestCase):
         self.assert_template_used('results.html')
 
         for sub in mock_recommendations():
-            assert sub['name'].encode('utf-8') in test_result.data
-            assert sub['title'].encode('utf-8') in test_result.data
+            assert sub.name.encode('utf-8') in test_result.data
+            assert sub.title.encode('utf-8') in test_result.data
 
             assert 'Community for {} years'.format(
-                    sub['age']).encode('utf-8') in test_result.data
+                    sub.age).encode('utf-8') in test_result.data
 
             assert '{:,} subscribers'.format(
-                    sub['subscribers']).encode('utf-8') in test_result.data
+                    sub.subscribers).encode('utf-8') in test_result.data
 
             assert 'Over 18 community'.encode('utf-8') in test_result.data
-            assert sub['desc'].encode('utf-8') in test_result.data
+            assert sub.desc.encode('utf-8') in test_result.data
+
+    @patch('subber.reddit.get_user_recommendations')
+    @patch('subber.subber.session')
+    def test_get_sub_recommendations_async(self,
+                                           mock_session,
+                                           mock_recommendations):
+        sub = sub_info('r/test')
+
+        def recommend(session, user, on_result=None):
+            on_result(sub)
+            return [sub]
+
+        mock_recommendations.side_effect = recommend
+
+        # Start job
+        form_data = {'username': 'test_username', 'mode': 'async'}
+        test_result = self.client.post('/user', data=form_data)
+
+        self.assertEqual(202, test_result.status_code)
+        job = test_result.json
+
+        # Poll job until finished
+        deadline = time.time() + 5
+        while job['status'] in ('pending', 'running'):
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.01)
+
+            test_result = self.client.get('/jobs/{}'.format(job['id']))
+            self.assert200(test_result)
+            job = test_result.json
+
+        self.assertEqual('done', job['status'])
+        self.assertEqual([sub._asdict()], job['results'])
+        self.assertEqual(form_data['username'],
+                         mock_recommendations.call_args[0][1])
+
+    @patch('subber.subber.backend', 'async')
+    @patch('subber.aioreddit.loop_thread')
+    @patch('subber.aioreddit.get_user_recommendations')
+    @patch('subber.reddit.get_user_recommendations')
+    @patch('subber.subber.session')
+    def test_get_sub_recommendations_async_backend(self,
+                                                   mock_session,
+                                                   mock_recommendations,
+                                                   mock_async_recommendations,
+                                                   mock_loop_thread):
+        sub = sub_info('r/test')
+        mock_loop_thread.run.return_value = [sub]
+
+        # Jobs crawl through the async client
+        job = self.client.post('/user', data={
+            'username': 'test_username', 'mode': 'async'}).json
+        deadline = time.time() + 5
+        while job['status'] in ('pending', 'running'):
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.01)
+            job = self.client.get('/jobs/{}'.format(job['id'])).json
+
+        self.assertEqual([sub._asdict()], job['results'])
+        self.assertEqual('test_username',
+                         mock_async_recommendations.call_args[0][1])
+        self.assertFalse(mock_recommendations.called)
+
+        # Fast mode is only served by the sync client
+        test_result = self.client.post('/user', data={
+            'username': 'test_username', 'mode': 'fast'})
+        self.assert400(test_result)
+
+    @patch('subber.reddit.iter_user_recommendations')
+    @patch('subber.subber.session')
+    def test_get_sub_recommendations_stream(self,
+                                            mock_session,
+                                            mock_recommendations):
+        subs = [sub_info('r/test{}'.format(i)) for i in range(2)]
+
+        consumed = []
+
+        def recommend(session, user):
+            for sub in subs:
+                consumed.append(sub)
+                yield sub
+
+        mock_recommendations.side_effect = recommend
+
+        form_data = {'username': 'test_username', 'mode': 'stream'}
+        test_result = self.client.post('/user', data=form_data,
+                                       buffered=False)
+
+        # Page header is sent before any recommendation is requested
+        chunks = iter(test_result.response)
+        data = b''
+        while b'Results for test_username' not in data:
+            data += next(chunks)
+
+        self.assertEqual([], consumed)
+
+        data += b''.join(chunks)
+        self.assertEqual(subs, consumed)
+
+        for sub in subs:
+            assert sub.name.encode('utf-8') in data
+
+        mock_recommendations.assert_called_with(mock_session,
+                                                form_data['username'])
+
+    @patch('subber.subber.timing_header', True)
+    @patch('subber.reddit.get_user_recommendations')
+    @patch('subber.subber.session')
+    def test_get_sub_recommendations_timing(self,
+                                            mock_session,
+                                            mock_recommendations):
+        mock_recommendations.return_value = []
+
+        form_data = {'username': 'test_username'}
+        test_result = self.client.post('/user', data=form_data)
+
+        self.assertIn('render;dur=', test_result.headers['Server-Timing'])
+
+        # Request is counted in metrics
+        test_result = self.client.get('/metrics')
+        self.assert200(test_result)
+        self.assertIn(b'subber_request_duration_seconds_count'
+                      b'{endpoint="get_sub_recommendations"}',
+                      test_result.data)
+
+    @patch('subber.reddit.get_user_recommendations')
+    @patch('subber.subber.session')
+    def test_get_sub_recommendations_cached(self, mock_session,
+                                            mock_recommendations):
+        mock_recommendations.return_value = [sub_info('r/test')]
+
+        form_data = {'username': 'test_username'}
+        first = self.client.post('/user', data=form_data)
+        second = self.client.post('/user', data={'username': 'Test_Username'})
+
+        # The page is rendered once
+        self.assertEqual(1, mock_recommendations.call_count)
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(first.headers['ETag'], second.headers['ETag'])
+        self.assertIn('Last-Modified', second.headers)
+
+        # Clients holding the page are told it hasn't changed
+        test_result = self.client.get(
+            '/user', query_string=form_data,
+            headers={'If-None-Match': first.headers['ETag']})
+        self.assertEqual(304, test_result.status_code)
+
+    @patch('subber.subber.job_manager')
+    @patch('subber.reddit.get_user_recommendations')
+    @patch('subber.subber.session')
+    def test_get_sub_recommendations_stale(self, mock_session,
+                                           mock_recommendations,
+                                           mock_job_manager):
+        from subber import subber
+
+        sub = sub_info('r/test')
+        mock_recommendations.return_value = [sub]
+
+        form_data = {'username': 'test_username'}
+
+        with patch.object(subber.response_cache, 'fresh', 0):
+            first = self.client.post('/user', data=form_data)
+            self.assertFalse(mock_job_manager.submit.called)
+
+            # The stale page is served while it is refreshed
+            mock_recommendations.return_value = [sub._replace(name='r/new')]
+            second = self.client.post('/user', data=form_data)
+
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(1, mock_recommendations.call_count)
+
+        user, run = mock_job_manager.submit.call_args[0]
+        cache = subber.response_cache
+        results = []
+
+        # The page goes to the cache it was read from, even if create_app
+        # replaced it meanwhile
+        with patch('subber.subber.response_cache') as replaced:
+            run(user, results.append)
+
+        self.assertEqual(['r/new'], [r['name'] for r in results])
+        self.assertIn(b'r/new', cache.get(user)['body'].encode('utf-8'))
+        self.assertFalse(replaced.set.called)
+
+    @patch('subber.subber.job_manager')
+    @patch('subber.reddit.get_user_recommendations')
+    @patch('subber.subber.session')
+    def test_get_sub_recommendations_refresh_failed(self, mock_session,
+                                                    mock_recommendations,
+                                                    mock_job_manager):
+        from subber import subber
+
+        mock_recommendations.return_value = [sub_info('r/test')]
+        form_data = {'username': 'test_username'}
+
+        with patch.object(subber.response_cache, 'fresh', 0):
+            self.client.post('/user', data=form_data)
+            self.client.post('/user', data=form_data)
+
+            # The refresh crawl finds nothing
+            mock_recommendations.return_value = []
+            user, run = mock_job_manager.submit.call_args[0]
+            run(user, lambda result: None)
+
+            # Later stale hits don't crawl again until the retry delay
+            third = self.client.post('/user', data=form_data)
+
+        self.assert200(third)
+        self.assertEqual(1, mock_job_manager.submit.call_count)
+
+    @patch('subber.reddit.get_user_recommendations')
+    @patch('subber.subber.session')
+    def test_get_batch_recommendations(self, mock_session,
+                                       mock_recommendations):
+        mock_recommendations.side_effect = lambda session, user: [
+            sub_info('r/' + user)]
+
+        test_result = self.client.post('/batch', data=json.dumps(
+            {'users': ['a', 'b', 'a']}), content_type='application/json')
+
+        self.assert200(test_result)
+        self.assertEqual('application/x-ndjson', test_result.mimetype)
+
+        results = [json.loads(line) for line in
+                   test_result.data.decode('utf-8').splitlines()]
+        self.assertEqual(['a', 'b'], [r['user'] for r in results])
+        self.assertEqual([sub_info('r/b')._asdict()],
+                         results[1]['recommendations'])
+
+        # Usernames may also be sent one per line
+        test_result = self.client.post('/batch', data='a\nc\n',
+                                       content_type='text/plain')
+        self.assertEqual(2, len(test_result.data.splitlines()))
+
+    def test_get_batch_recommendations_invalid(self):
+        test_result = self.client.post('/batch', data='{"users": "a"}',
+                                       content_type='application/json')
+        self.assert400(test_result)
+
+        with patch('subber.subber.batch_max_users', 1):
+            test_result = self.client.post('/batch', data='a\nb\n',
+                                           content_type='text/plain')
+        self.assert400(test_result)
+
+    def test_get_missing_job(self):
+        test_result = self.client.get('/jobs/missing')
+        self.assert404(test_result)
+
+    @patch('subber.config.get_config')
+    @patch('subber.reddit.Reddit')
+    def test_create_app_lazy_session(self, mock_reddit, mock_config):
+        from subber import subber
+
+        mock_config.return_value = {'id': 'ID', 'secret': 'SECRET',
+                                    'password': 'PASSWORD',
+                                    'username': 'USERNAME'}
+
+        app = subber.create_app()
+        session = subber.session
+
+        # Reddit is only contacted once the session is used
+        self.assertIs(subber.app, app)
+        self.assertFalse(mock_reddit.called)
+
+        session.redditor('user')
+        mock_reddit.assert_called_once_with('ID', 'SECRET', 'PASSWORD',
+                                            'USERNAME',
+                                            http=subber.http_session,
+                                            timeout=(5.0, 16.0),
+                                            token_backend=None,
+                                            scheduled=True)
+
+    @patch('subber.config.get_config')
+    @patch('subber.reddit.Reddit')
+    def test_create_app_closes_pipeline(self, mock_reddit, mock_config):
+        from subber import subber
+
+        mock_config.return_value = {'id': 'ID', 'secret': 'SECRET',
+                                    'password': 'PASSWORD',
+                                    'username': 'USERNAME'}
+
+        # Left over from an earlier call
+        api_scheduler = Mock()
+        prefetcher = Mock()
+        graph_store = Mock()
+
+        with patch('subber.reddit.api_scheduler', api_scheduler), \
+                patch('subber.reddit.prefetcher', prefetcher), \
+                patch('subber.reddit.graph_store', graph_store), \
+                patch('subber.reddit.cooccurrence_index', Mock()):
+            subber.create_app()
+
+            # Features the config leaves out are disabled
+            self.assertIsNot(api_scheduler, reddit.api_scheduler)
+            self.assertIsNone(reddit.prefetcher)
+            self.assertIsNone(reddit.graph_store)
+            self.assertIsNone(reddit.cooccurrence_index)
+
+        api_scheduler.stop.assert_called_once_with()
+        prefetcher.stop.assert_called_once_with()
+        graph_store.close.assert_called_once_with()
+
+
+class TestASGI(unittest.TestCase):
+    @classmethod
+    @patch('subber.config.get_config')
+    @patch('subber.reddit.Reddit')
+    def setUpClass(cls, mock_session, mock_config):
+        from subber import asgi
+
+        cls.asgi = asgi
+
+    def request(self, method, path, body=b'', headers=(), query=b''):
+        messages = [{'type': 'http.request', 'body': body}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(self.asgi.app(
+            {'type': 'http', 'method': method, 'path': path,
+             'query_string': query, 'headers': list(headers)},
+            receive, send))
+        loop.close()
+
+        self.chunks = [m['body'] for m in sent[1:] if m['body']]
+
+        return (sent[0]['status'], dict(sent[0]['headers']),
+                b''.join(self.chunks))
+
+    def test_get_form(self):
+        status, headers, body = self.request('GET', '/')
+
+        self.assertEqual(200, status)
+        self.assertIn(b'username', body)
+
+    def test_static(self):
+        self.assertEqual(404, self.request('GET', '/static/../subber.py')[0])
+
+    @patch('subber.subber.user_exists', lambda user: True)
+    @patch('subber.aioreddit.get_user_recommendations')
+    def test_user_json(self, mock_recommendations):
+        async def recommendations(client, user):
+            return [sub_info('r/sub')]
+
+        mock_recommendations.side_effect = recommendations
+
+        # JSON requests start a job, as on the Flask app
+        with patch('subber.subber.backend', 'async'):
+            status, headers, body = self.request(
+                'POST', '/user', b'username=user',
+                [(b'accept', b'application/json'),
+                 (b'content-type', b'application/x-www-form-urlencoded')])
+            self.assertEqual(202, status)
+
+            job = json.loads(body.decode())
+            deadline = time.time() + 5
+            while job['status'] in ('pending', 'running'):
+                self.assertLess(time.time(), deadline)
+                time.sleep(0.01)
+
+                job = json.loads(self.request(
+                    'GET', '/jobs/' + job['id'])[2].decode())
+
+        self.assertEqual([sub_info('r/sub')._asdict()], job['results'])
+
+    @patch('subber.subber.user_exists', lambda user: True)
+    @patch('subber.reddit.get_user_recommendations')
+    def test_cached_page(self, mock_recommendations):
+        mock_recommendations.return_value = [sub_info('r/sub')]
+        self.addCleanup(self.asgi.subber.response_cache.clear)
+
+        first = self.request('GET', '/user', query=b'username=cached')
+        self.assertEqual(200, first[0])
+        self.assertIn(b'r/sub', first[2])
+
+        # The Flask app's response cache answers conditional requests
+        status, headers, body = self.request(
+            'GET', '/user', query=b'username=cached',
+            headers=[(b'if-none-match', first[1][b'etag'])])
+
+        self.assertEqual(304, status)
+        self.assertEqual(1, mock_recommendations.call_count)
+
+    @patch('subber.subber.user_exists', lambda user: True)
+    @patch('subber.reddit.iter_user_recommendations')
+    def test_stream(self, mock_recommendations):
+        mock_recommendations.return_value = iter(
+            [sub_info('r/test{}'.format(i)) for i in range(2)])
+
+        status, headers, body = self.request(
+            'GET', '/user', query=b'username=streamed&mode=stream')
+
+        self.assertEqual(200, status)
+        self.assertIn(b'r/test1', body)
+
+        # Chunks are sent as they are rendered
+        self.assertGreater(len(self.chunks), 1)
+
+
+class TestBatchCLI(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    @patch('subber.config.get_config')
+    @patch('subber.reddit.Reddit')
+    def test_main(self, mock_session, mock_config):
+        from subber import batch, subber
+
+        users = os.path.join(self.dir, 'users.txt')
+        output = os.path.join(self.dir, 'results.jsonl')
+        with open(users, 'w') as f:
+            f.write('a\nb\n')
+
+        def recommend(user):
+            return [sub_info('r/' + user)]
+
+        with patch.object(subber, 'create_app'), \
+                patch.object(subber, 'get_recommendations', recommend), \
+                patch.object(subber, 'user_exists', lambda u: True):
+            batch.main([users, '-o', output])
+
+        with open(output) as f:
+            results = [json.loads(line) for line in f]
+
+        self.assertEqual(['r/a', 'r/b'],
+                         [r['recommendations'][0]['name'] for r in results])
+
+    @patch('subber.reddit.Reddit')
+    def test_main_config(self, mock_session):
+        from subber import batch, reddit, subber
+
+        # Run where there is no subber.cfg
+        cwd = os.getcwd()
+        os.chdir(self.dir)
+        self.addCleanup(os.chdir, cwd)
+
+        config_file = os.path.join(self.dir, 'my.cfg')
+        log_file = os.path.join(self.dir, 'subber.log')
+        with open(config_file, 'w') as f:
+            f.write('[reddit-api]\nid=ID\nsecret=SECRET\npassword=PASSWORD\n'
+                    'username=USERNAME\n[subber]\nlisting_limit=7\n'
+                    'log_file={}\n'.format(log_file))
+
+        users = os.path.join(self.dir, 'users.txt')
+        with open(users, 'w') as f:
+            f.write('a\n')
+
+        with patch.object(subber, 'get_recommendations', lambda u: []), \
+                patch.object(subber, 'user_exists', lambda u: True), \
+                patch.object(reddit, 'listing_limit'):
+            batch.main([users, '-o', os.path.join(self.dir, 'out.jsonl'),
+                        '-c', config_file])
+
+            # The app is configured from the given config file
+            self.assertEqual(7, reddit.listing_limit)
+
+        mock_session.assert_not_called()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,189 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import http.server
+import threading
+import unittest
+from unittest.mock import Mock, patch
+
+import requests
+
+from subber import cache, metrics, transport
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """Keep-alive server failing the first request to /flaky"""
+
+    protocol_version = 'HTTP/1.1'
+    failures = 0
+
+    def do_GET(self):
+        if self.path == '/flaky' and Handler.failures < 1:
+            Handler.failures += 1
+            status = 503
+        else:
+            status = 200
+
+        self.send_response(status)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, *args):
+        pass
+
+
+class TestSession(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.HTTPServer(('127.0.0.1', 0), Handler)
+        cls.url = 'http://127.0.0.1:{}'.format(cls.server.server_port)
+
+        thread = threading.Thread(target=cls.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.session = transport.build_session(pool_size=2, retries=2,
+                                               backoff=0)
+        self.addCleanup(self.session.close)
+
+    def test_keep_alive(self):
+        for i in range(3):
+            self.assertEqual(200, self.session.get(self.url + '/').status_code)
+
+        # One handshake served every request
+        self.assertEqual({'connections': 1, 'requests': 3},
+                         transport.stats(self.session))
+
+    def test_server_error_not_retried(self):
+        Handler.failures = 0
+
+        # Server errors are retried by PRAW, not the connection pool
+        self.assertEqual(503,
+                         self.session.get(self.url + '/flaky').status_code)
+        self.assertEqual(1, Handler.failures)
+        self.assertEqual(200,
+                         self.session.get(self.url + '/flaky').status_code)
+
+    def test_retry_connection_error(self):
+        retries = metrics.registry.get('subber_http_retries_total')
+
+        # Nothing listens on port 1
+        self.assertRaises(requests.ConnectionError, self.session.get,
+                          'http://127.0.0.1:1/')
+        self.assertEqual(retries + 3,
+                         metrics.registry.get('subber_http_retries_total'))
+
+    def test_jitter(self):
+        retry = transport.JitterRetry(total=5, backoff_factor=1)
+        for i in range(3):
+            retry = retry.increment(method='GET', url='/')
+
+        for i in range(20):
+            self.assertTrue(0 <= retry.get_backoff_time() <= 4)
+
+
+class TestRequestor(unittest.TestCase):
+    def test_timeout(self):
+        session = Mock(headers={})
+        requestor = transport.Requestor('test agent', session=session,
+                                        timeout=(1, 2))
+
+        requestor.request('GET', 'https://oauth.reddit.com')
+        session.request.assert_called_once_with('GET',
+                                                'https://oauth.reddit.com',
+                                                timeout=(1, 2))
+
+
+class TestScheduledRateLimiter(unittest.TestCase):
+    def test_no_delay(self):
+        limiter = transport.ScheduledRateLimiter()
+        limiter.update({'x-ratelimit-remaining': '0',
+                        'x-ratelimit-reset': '600',
+                        'x-ratelimit-used': '600'})
+
+        # Headers are tracked for the scheduler, which does the waiting
+        with patch('time.sleep') as mock_sleep:
+            limiter.delay()
+
+        self.assertEqual(0, limiter.remaining)
+        self.assertFalse(mock_sleep.called)
+
+
+class FakeAuthorizer(object):
+    def __init__(self, name, clock):
+        self.name = name
+        self.clock = clock
+        self.requested = 0
+        self.access_token = None
+
+    def refresh(self):
+        self.requested += 1
+        self.access_token = '{}{}'.format(self.name, self.requested)
+        self._expiration_timestamp = self.clock() + 3600
+        self.scopes = {'*'}
+
+
+class TestShareToken(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.backend = cache.MemoryBackend(clock=lambda: self.now)
+
+        self.workers = [FakeAuthorizer(name, lambda: self.now)
+                        for name in ('a', 'b')]
+        for authorizer in self.workers:
+            transport.share_token(authorizer, self.backend, 'token',
+                                  clock=lambda: self.now)
+
+    def test_shared(self):
+        first, second = self.workers
+
+        first.refresh()
+        second.refresh()
+
+        # The second worker reuses the first worker's token
+        self.assertEqual(1, first.requested)
+        self.assertEqual(0, second.requested)
+        self.assertEqual('a1', second.access_token)
+        self.assertEqual({'*'}, second.scopes)
+
+        # Tokens about to expire are renewed
+        self.now += 3590
+        second.refresh()
+        self.assertEqual(1, second.requested)
+
+    def test_rejected(self):
+        first, second = self.workers
+
+        first.refresh()
+        second.refresh()
+
+        # Reddit rejected the token, so the next refresh requests a new one
+        second.refresh()
+        self.assertEqual(1, second.requested)
+        self.assertEqual('b1', second.access_token)
+
+        # Other workers pick up the replacement
+        first.refresh()
+        self.assertEqual(1, first.requested)
+        self.assertEqual('b1', first.access_token)
+
+
+if __name__ == '__main__':
+    unittest.main()
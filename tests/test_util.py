@@ -0,0 +1,39 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import unittest
+
+from subber import util
+
+
+class TestUtil(unittest.TestCase):
+    def test_utc_epoch_sec_to_years(self):
+        three_years = 3 * 365 * 86400 + 86400
+
+        self.assertEqual(3, util.utc_epoch_sec_to_years(time.time() -
+                                                        three_years))
+        self.assertEqual(0, util.utc_epoch_sec_to_years(time.time()))
+
+    def test_sample(self):
+        self.assertEqual('[a, b]', str(util.sample(['a', 'b'])))
+        self.assertEqual('[0, 1, ... (3 more)]',
+                         str(util.sample(range(5), limit=2)))
+
+        items = util.sample(str(i) for i in range(3))
+        self.assertEqual('[0, 1, 2]', str(items))
+        self.assertEqual('[0, 1, 2]', str(items))
+
+
+if __name__ == '__main__':
+    unittest.main()